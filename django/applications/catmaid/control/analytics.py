@@ -1,6 +1,7 @@
 import json
 
 from collections import namedtuple, defaultdict
+from contextlib import closing
 from itertools import chain, islice
 from functools import partial
 from networkx import Graph, single_source_shortest_path
@@ -9,6 +10,8 @@ from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import lazy_load_rows
 from catmaid.models import UserRole
 
 @requires_user_role(UserRole.Browse)
@@ -67,8 +70,20 @@ def analyze_skeletons(request, project_id=None):
       AND r.relation_name = 'model_of'
     ''' % ",".join(map(str, skids)))
 
-    blob = {'issues': tuple((skid, _analyze_skeleton(project_id, skid, adjacents)) for skid in skids),
-            'names': dict(cursor.fetchall()),
+    names = dict(cursor.fetchall())
+
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to', 'labeled_as'), cursor)
+
+    # Treenodes are streamed, one skeleton at a time
+    issues = []
+    with closing(lazy_load_rows(set(skids), ('id', 'parent_id'))) as skeletons:
+        for skid, rows in skeletons:
+            issues.append((skid, _analyze_skeleton(project_id, skid,
+                    adjacents, rows, relations)))
+
+    blob = {'issues': issues,
+            'names': names,
             0: "Autapse",
             1: "Two or more times postsynaptic to the same connector",
             2: "Connector without postsynaptic targets",
@@ -80,35 +95,19 @@ def analyze_skeletons(request, project_id=None):
 
     return HttpResponse(json.dumps(blob))
 
-def _analyze_skeleton(project_id, skeleton_id, adjacents):
+def _analyze_skeleton(project_id, skeleton_id, adjacents, rows, relations):
     """ Takes a skeleton and returns a list of potentially problematic issues,
     as a list of tuples of two values: issue type and treenode ID.
     adjacents: the number of nodes in the paths starting at a node when checking for duplicated connectors.
+    rows: an iterable of (treenode ID, parent ID) tuples of all nodes of the skeleton.
+    relations: a map of relation names to IDs.
     """
     project_id = int(project_id)
     skeleton_id = int(skeleton_id)
     cursor = connection.cursor()
 
-    PRE = 'presynaptic_to'
-    POST = 'postsynaptic_to'
-
-    # Retrieve relation IDs vs names
-    cursor.execute('''
-    SELECT id, relation_name
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = '%s'
-           OR relation_name = '%s')
-    ''' % (project_id, PRE, POST))
-
-    relations = {} # both ways
-    for row in cursor.fetchall():
-        relations[row[0]] = row[1]
-        relations[row[1]] = row[0]
-
-    # Transform strings to integer IDs
-    PRE = relations[PRE]
-    POST = relations[POST]
+    PRE = relations['presynaptic_to']
+    POST = relations['postsynaptic_to']
 
     # Retrieve all connectors and their associated pre- or postsynaptic treenodes,
     # plus the parent treenodes of these.
@@ -177,34 +176,33 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
             else:
                 pre_connector_ids.add(connector_id)
 
-    # Fetch data for type 4 and 5: all treenode, with tags if any
-    cursor.execute('''
-    SELECT treenode.id,
-           treenode.parent_id,
-           class_instance.name
-    FROM treenode
-             LEFT OUTER JOIN
-                 (treenode_class_instance INNER JOIN relation ON (treenode_class_instance.relation_id = relation.id AND relation.relation_name = 'labeled_as') INNER JOIN class_instance ON (treenode_class_instance.class_instance_id = class_instance.id))
-             ON (treenode_class_instance.treenode_id = treenode.id)
-    WHERE treenode.skeleton_id = %s
-    ''' % skeleton_id)
-
-    # Collapse repeated rows into nodes with none or more tags
+    # Fetch data for type 4 and 5: all treenodes, with tags if any
+    tags = defaultdict(list)
+    if 'labeled_as' in relations:
+        cursor.execute('''
+        SELECT tci.treenode_id, ci.name
+        FROM treenode_class_instance tci
+        JOIN treenode t
+            ON t.id = tci.treenode_id
+        JOIN class_instance ci
+            ON ci.id = tci.class_instance_id
+        WHERE t.skeleton_id = %s
+          AND tci.relation_id = %s
+        ''', (skeleton_id, relations['labeled_as']))
+        for treenode_id, name in cursor.fetchall():
+            tags[treenode_id].append(name)
+
+    # Nodes with none or more tags
     nodes = {}
     parents = set()
     root = None
-    for row in cursor.fetchall():
-        node = nodes.get(row[0])
-        if node:
-            # Append tag
-            node[1].append(row[2])
-        else:
-            nodes[row[0]] = (row[1], [row[2]])
+    for node_id, parent_id in rows:
+        nodes[node_id] = (parent_id, tags.get(node_id, ()))
 
-        if row[1]:
-            parents.add(row[1])
+        if parent_id:
+            parents.add(parent_id)
         else:
-            root = row[0]
+            root = node_id
 
 
     # Type 4: potentially duplicated synapses (or triplicated, etc):
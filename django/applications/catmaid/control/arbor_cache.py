@@ -0,0 +1,333 @@
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.tree_util import Arbor
+
+
+# Arbors of recently used skeletons are kept per process, most recently used
+# last. Keys are skeleton IDs, values are (version, arbor, size) tuples. A
+# version is the skeleton's entry in catmaid_skeleton_summary, whose version
+# column database triggers change on every edit. Cached arbors are therefore
+# validated with a single primary key lookup, regardless of which process made
+# an edit. Edits lock the versions of the skeletons they change with
+# lock_versions() first and pass them to the on_* functions, which patch a
+# cached arbor only if it is the version the edit was made on.
+_arbors = OrderedDict()
+_arbors_size = 0
+_arbors_lock = Lock()
+_arbor_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'patches': 0,
+    'evictions': 0,
+}
+
+# An arbor needs six integer arrays of one element per node once its children
+# and depths have been computed.
+BYTES_PER_NODE = 6 * 8
+
+
+def is_enabled():
+    return getattr(settings, 'ARBOR_CACHE_SIZE', 0) > 0
+
+
+def _get_versions(skeleton_ids, cursor=None):
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+        SELECT skeleton_id, num_nodes, num_branches, num_ends, root_node_id,
+               version
+        FROM catmaid_skeleton_summary
+        WHERE skeleton_id = ANY(%s::integer[])
+    ''', (list(skeleton_ids),))
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def lock_versions(node_ids, cursor=None):
+    """Return the versions of the skeletons of the passed in treenodes, before
+    they are edited. Their summaries are locked until the end of the
+    transaction, so that no other transaction can change them in the meantime.
+    Returns an empty dictionary if the cache is disabled.
+    """
+    if not is_enabled():
+        return {}
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+        SELECT skeleton_id, num_nodes, num_branches, num_ends, root_node_id,
+               version
+        FROM catmaid_skeleton_summary
+        WHERE skeleton_id IN (
+            SELECT skeleton_id FROM treenode WHERE id = ANY(%s::bigint[]))
+        ORDER BY skeleton_id
+        FOR UPDATE
+    ''', ([int(n) for n in node_ids],))
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def _structure(arbor):
+    """Return the part of a version that can be computed from an arbor alone:
+    number of nodes, branch nodes and end nodes as well as the root ID.
+    """
+    degrees = arbor.child_counts() + (arbor.parents != -1)
+    return (len(arbor), int((degrees > 2).sum()), int((degrees == 1).sum()),
+            arbor.find_root())
+
+
+def _store(skeleton_id, version, arbor):
+    global _arbors_size
+    size = len(arbor) * BYTES_PER_NODE
+    max_size = settings.ARBOR_CACHE_SIZE
+    with _arbors_lock:
+        old = _arbors.pop(skeleton_id, None)
+        if old:
+            _arbors_size -= old[2]
+        if size > max_size:
+            return
+        _arbors[skeleton_id] = (version, arbor, size)
+        _arbors_size += size
+        while _arbors_size > max_size:
+            _, (_, _, evicted_size) = _arbors.popitem(last=False)
+            _arbors_size -= evicted_size
+            _arbor_cache_stats['evictions'] += 1
+
+
+def _lookup(skeleton_id):
+    with _arbors_lock:
+        entry = _arbors.get(skeleton_id)
+        if entry:
+            # Mark as most recently used
+            del _arbors[skeleton_id]
+            _arbors[skeleton_id] = entry
+        return entry
+
+
+def get_arbor(skeleton_id, cursor=None):
+    """Return the Arbor of a skeleton, which has to be treated as read-only.
+    It is taken from the cache if it is still current and loaded from the
+    database otherwise.
+    """
+    skeleton_id = int(skeleton_id)
+    cursor = cursor or connection.cursor()
+    if is_enabled():
+        version = _get_versions([skeleton_id], cursor).get(skeleton_id)
+        entry = _lookup(skeleton_id)
+        if entry and version and entry[0] == version:
+            _arbor_cache_stats['hits'] += 1
+            return entry[1]
+        _arbor_cache_stats['misses'] += 1
+    else:
+        version = None
+
+    cursor.execute('''
+        SELECT id, parent_id
+        FROM treenode
+        WHERE skeleton_id=%s''', [skeleton_id])
+    arbor = Arbor.from_rows(cursor.fetchall())
+    if version and version[0] == len(arbor):
+        _store(skeleton_id, version, arbor)
+    return arbor
+
+
+def invalidate(skeleton_ids):
+    """Remove the passed in skeletons from the cache of this process. Other
+    processes notice the change through the skeleton summary.
+    """
+    global _arbors_size
+    with _arbors_lock:
+        for skeleton_id in skeleton_ids:
+            entry = _arbors.pop(int(skeleton_id), None)
+            if entry:
+                _arbors_size -= entry[2]
+
+
+def _current(skeleton_id, versions):
+    """Return the cached arbor of a skeleton if it is the version from before
+    the edit, as returned by lock_versions(), or None otherwise.
+    """
+    entry = _lookup(int(skeleton_id))
+    version = versions.get(int(skeleton_id)) if versions else None
+    if entry and version and entry[0] == version:
+        return entry[1]
+    return None
+
+
+def _patch(patches, versions, cursor=None):
+    """Replace cached arbors with patched versions after an edit. <patches> is
+    a list of (skeleton ID, function) tuples, each function is called with the
+    cached arbor of the skeleton from before the edit (or None if it isn't
+    cached or outdated) and returns the new arbor of this skeleton or None if
+    it can't be patched. <versions> are the skeleton versions from before the
+    edit. As a safeguard, a patched arbor is only kept if its node, branch and
+    end count and its root match the skeleton summary after the edit.
+    """
+    if not is_enabled():
+        return
+    patched = {}
+    for skid, fn in patches:
+        skid = int(skid)
+        try:
+            arbor = fn(_current(skid, versions))
+        except ValueError:
+            # The cached arbor doesn't contain the edited nodes
+            arbor = None
+        patched[skid] = arbor
+    invalidate(patched.keys())
+
+    patched = {skid: arbor for skid, arbor in patched.iteritems() if arbor}
+    if not patched:
+        return
+    versions = _get_versions(patched.keys(), cursor)
+    for skid, arbor in patched.iteritems():
+        version = versions.get(skid)
+        if version and version[:4] == _structure(arbor):
+            _store(skid, version, arbor)
+            _arbor_cache_stats['patches'] += 1
+
+
+def _with_parents(arbor, node_ids, parent_ids):
+    """Return a new arbor with the parents of the passed in nodes changed."""
+    patched = arbor.copy()
+    indices = arbor.indices(node_ids)
+    parent_ids = np.asarray(parent_ids, dtype=np.int64).reshape(-1)
+    if len(parent_ids) == 1:
+        parent_ids = np.repeat(parent_ids, len(indices))
+    has_parent = parent_ids != -1
+    patched.parents[indices[~has_parent]] = -1
+    patched.parents[indices[has_parent]] = arbor.indices(parent_ids[has_parent])
+    return patched
+
+
+def _add_node(arbor, node_id, parent_id):
+    if parent_id not in arbor:
+        raise ValueError("Parent not part of arbor")
+    return Arbor(np.append(arbor.node_ids, node_id),
+            np.append(arbor.parent_ids(), parent_id))
+
+
+def _remove_node(arbor, node_id):
+    """Remove a node and make its children children of its parent, like
+    deleting a treenode does.
+    """
+    index = arbor.index(node_id)
+    parent_ids = arbor.parent_ids()
+    parent_ids[arbor.parents == index] = parent_ids[index]
+    keep = np.arange(len(arbor)) != index
+    return Arbor(arbor.node_ids[keep], parent_ids[keep])
+
+
+def _reroot(arbor, node_id):
+    rerooted = arbor.copy()
+    rerooted.reroot(node_id)
+    return rerooted
+
+
+def _split(arbor, node_id):
+    """Return a tuple of the upstream and the downstream arbor if the edge
+    between the passed in node and its parent is removed.
+    """
+    downstream = arbor.downstream(node_id)
+    parent_ids = arbor.parent_ids()
+    parent_ids[arbor.index(node_id)] = -1
+    return (Arbor(arbor.node_ids[~downstream], parent_ids[~downstream]),
+            Arbor(arbor.node_ids[downstream], parent_ids[downstream]))
+
+
+def _join(from_arbor, from_node_id, to_arbor, to_node_id):
+    """Return a new arbor that contains the nodes of both arbors, with the
+    to-arbor rerooted at to_node_id, which becomes a child of from_node_id.
+    """
+    if from_node_id not in from_arbor:
+        raise ValueError("Node not part of arbor")
+    to_arbor = _reroot(to_arbor, to_node_id)
+    to_parent_ids = to_arbor.parent_ids()
+    to_parent_ids[to_arbor.index(to_node_id)] = from_node_id
+    return Arbor(np.concatenate([from_arbor.node_ids, to_arbor.node_ids]),
+            np.concatenate([from_arbor.parent_ids(), to_parent_ids]))
+
+
+def _if_cached(fn):
+    def patch(arbor):
+        return fn(arbor) if arbor is not None else None
+    return patch
+
+
+def on_add_node(skeleton_id, node_id, parent_id, child_ids=None,
+        versions=None, cursor=None):
+    """Update the cached arbor of a skeleton after a node has been added as
+    child of <parent_id>. Optionally, the passed in children take the new node
+    as their parent. <versions> are the skeleton versions from before the edit,
+    as returned by lock_versions(), which all on_* functions expect.
+    """
+    def patch(arbor):
+        arbor = _add_node(arbor, node_id, parent_id)
+        if child_ids:
+            arbor = _with_parents(arbor, child_ids, [node_id])
+        return arbor
+    _patch([(skeleton_id, _if_cached(patch))], versions, cursor)
+
+
+def on_update_parent(skeleton_id, node_id, parent_id, versions=None,
+        cursor=None):
+    _patch([(skeleton_id, _if_cached(
+        lambda arbor: _with_parents(arbor, [node_id], [parent_id])))],
+        versions, cursor)
+
+
+def on_remove_node(skeleton_id, node_id, versions=None, cursor=None):
+    _patch([(skeleton_id, _if_cached(
+        lambda arbor: _remove_node(arbor, node_id)))], versions, cursor)
+
+
+def on_reroot(skeleton_id, node_id, versions=None, cursor=None):
+    _patch([(skeleton_id, _if_cached(
+        lambda arbor: _reroot(arbor, node_id)))], versions, cursor)
+
+
+def on_split(skeleton_id, new_skeleton_id, node_id, versions=None,
+        cursor=None):
+    """Update the cache after the part of a skeleton downstream of <node_id>
+    (inclusive) was moved to a new skeleton.
+    """
+    arbor = _current(skeleton_id, versions)
+    parts = (None, None)
+    if arbor is not None:
+        try:
+            parts = _split(arbor, node_id)
+        except ValueError:
+            pass
+    _patch([(skeleton_id, lambda arbor: parts[0]),
+            (new_skeleton_id, lambda arbor: parts[1])], versions, cursor)
+
+
+def on_join(from_skeleton_id, from_node_id, to_skeleton_id, to_node_id,
+        versions=None, cursor=None):
+    """Update the cache after the skeleton of <to_node_id> was merged into the
+    skeleton of <from_node_id>, with to_node_id becoming a child of
+    from_node_id.
+    """
+    from_arbor = _current(from_skeleton_id, versions)
+    to_arbor = _current(to_skeleton_id, versions)
+    joined = None
+    if from_arbor is not None and to_arbor is not None:
+        try:
+            joined = _join(from_arbor, from_node_id, to_arbor, to_node_id)
+        except ValueError:
+            pass
+    invalidate([to_skeleton_id])
+    _patch([(from_skeleton_id, lambda arbor: joined)], versions, cursor)
+
+
+def get_arbor_cache_stats():
+    """Return the number of hits, misses, patches and evictions of the arbor
+    cache of this process, along with the number of cached skeletons and their
+    estimated size in bytes.
+    """
+    stats = dict(_arbor_cache_stats)
+    with _arbors_lock:
+        stats['skeletons'] = len(_arbors)
+        stats['size'] = _arbors_size
+    return stats
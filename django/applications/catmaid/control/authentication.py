@@ -1,5 +1,7 @@
 import re
 import json
+import threading
+import time
 
 from functools import wraps
 from itertools import groupby
@@ -16,7 +18,9 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import authenticate, logout, login
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
-from django.db import connection
+from django.core.signals import request_started
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.core.exceptions import ObjectDoesNotExist
 from django.shortcuts import _get_queryset, render
@@ -86,31 +90,123 @@ def user_context_response(user, additional_fields=None):
     return JsonResponse(context)
 
 
-def check_user_role(user, project, roles):
-    """Check that a user has one of a set of roles for a project.
+# The project permissions that define user roles
+ROLE_PERMISSIONS = frozenset(('can_administer', 'can_annotate', 'can_browse'))
 
-    Administrator role satisfies any requirement.
-    """
+# Role permissions of users in projects are cached for
+# PERMISSION_CACHE_TIMEOUT seconds. Keys are (user ID, project ID) tuples,
+# values are (expiration time, permission set) tuples. The whole cache is
+# cleared if permissions, group memberships or users change.
+_permission_cache = {}
+_permission_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'invalidations': 0,
+}
+
+# Permissions that are changed in a transaction aren't cached until the
+# transaction is committed.
+_uncommitted_permissions = threading.local()
 
-    # Prefetch all user permissions for project.
+
+def get_user_project_permissions(user, project_id):
+    """Return the set of role permissions (see ROLE_PERMISSIONS) a user has in
+    a project. Results are cached.
+    """
+    project_id = int(project_id)
+    key = (user.id, project_id)
+    timeout = settings.PERMISSION_CACHE_TIMEOUT
+
+    if timeout:
+        entry = _permission_cache.get(key)
+        if entry and entry[0] > time.time():
+            _permission_cache_stats['hits'] += 1
+            return entry[1]
+    _permission_cache_stats['misses'] += 1
+
+    project = Project.objects.get(pk=project_id)
     checker = ObjectPermissionChecker(user)
+    permissions = ROLE_PERMISSIONS.intersection(checker.get_perms(project))
+
+    if timeout and not getattr(_uncommitted_permissions, 'changed', False):
+        _permission_cache[key] = (time.time() + timeout, permissions)
+
+    return permissions
+
+
+def get_permission_cache_stats():
+    """Return the number of hits, misses and invalidations of the permission
+    cache of this process, along with its current size and hit rate.
+    """
+    stats = dict(_permission_cache_stats)
+    n_requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / n_requests if n_requests else 0.0
+    stats['size'] = len(_permission_cache)
+    return stats
+
+
+def clear_permission_cache():
+    _permission_cache.clear()
+    _permission_cache_stats['invalidations'] += 1
+
+
+def on_permissions_changed(sender, **kwargs):
+    """Clear the permission cache and keep it from caching results until the
+    current transaction is committed.
+    """
+    clear_permission_cache()
+    _uncommitted_permissions.changed = True
+
+    def on_commit():
+        clear_permission_cache()
+        _uncommitted_permissions.changed = False
+    transaction.on_commit(on_commit)
+
+
+def on_request_started(sender, **kwargs):
+    _uncommitted_permissions.changed = False
 
+
+post_save.connect(on_permissions_changed, sender=UserObjectPermission)
+post_delete.connect(on_permissions_changed, sender=UserObjectPermission)
+post_save.connect(on_permissions_changed, sender=GroupObjectPermission)
+post_delete.connect(on_permissions_changed, sender=GroupObjectPermission)
+post_save.connect(on_permissions_changed, sender=User)
+post_delete.connect(on_permissions_changed, sender=User)
+post_delete.connect(on_permissions_changed, sender=Group)
+post_delete.connect(on_permissions_changed, sender=Project)
+m2m_changed.connect(on_permissions_changed, sender=User.groups.through)
+request_started.connect(on_request_started)
+
+
+def has_user_role(permissions, roles):
+    """Check whether a set of role permissions (see
+    get_user_project_permissions()) includes one of the passed in roles.
+
+    Administrator role satisfies any requirement.
+    """
     # Check for admin privs in all cases.
-    has_role = checker.has_perm('can_administer', project)
-
-    if not has_role:
-        # Check the indicated role(s)
-        if isinstance(roles, str):
-            roles = [roles]
-        for role in roles:
-            if role == UserRole.Annotate:
-                has_role = checker.has_perm('can_annotate', project)
-            elif role == UserRole.Browse:
-                has_role = checker.has_perm('can_browse', project)
-            if has_role:
-                break
+    if 'can_administer' in permissions:
+        return True
+
+    # Check the indicated role(s)
+    if isinstance(roles, str):
+        roles = [roles]
+    for role in roles:
+        if role == UserRole.Annotate and 'can_annotate' in permissions:
+            return True
+        elif role == UserRole.Browse and 'can_browse' in permissions:
+            return True
+
+    return False
+
+
+def check_user_role(user, project, roles):
+    """Check that a user has one of a set of roles for a project.
 
-    return has_role
+    Administrator role satisfies any requirement.
+    """
+    return has_user_role(get_user_project_permissions(user, project.id), roles)
 
 
 def requires_user_role(roles):
@@ -121,10 +217,10 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
 
-            has_role = check_user_role(u, p, roles)
+            has_role = has_user_role(get_user_project_permissions(u,
+                    kwargs['project_id']), roles)
 
             if has_role:
                 # The user can execute the function.
@@ -270,6 +366,15 @@ def user_project_permissions(request):
 
     return HttpResponse(json.dumps((result, groups)))
 
+def permission_cache_stats(request):
+    """ Return hit and miss counts of the permission cache of the process
+    serving this request. Only available to superusers.
+    """
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Only superusers can access permission '
+                'cache statistics', 'permission_error': True})
+    return JsonResponse(get_permission_cache_stats())
+
 def get_object_permissions(request, ci_id):
     """ Tests editing permissions of a user on a class_instance and returns the
     result as JSON object."""
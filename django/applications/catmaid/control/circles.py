@@ -10,31 +10,37 @@ from django.http import HttpResponse
 
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.skeleton import _neuronnames
 
 def _next_circle(skeleton_set, relations, cursor):
     """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
     pre = relations['presynaptic_to']
     post = relations['postsynaptic_to']
+    # Synapse counts between skeletons are precomputed in skeleton_adjacency
     cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
-      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-      AND (tc2.relation_id = %s OR tc2.relation_id = %s)
-    ''' % (','.join(map(str, skeleton_set)), pre, post, pre, post))
+    SELECT pre_skeleton_id, %(pre)s, post_skeleton_id,
+           (SELECT sum(n) FROM unnest(confidence_histogram) n)
+    FROM skeleton_adjacency
+    WHERE pre_skeleton_id = ANY(%(skids)s::integer[])
+      AND pre_skeleton_id != post_skeleton_id
+      AND relation_id = %(pre)s
+    UNION ALL
+    SELECT post_skeleton_id, %(post)s, pre_skeleton_id,
+           (SELECT sum(n) FROM unnest(confidence_histogram) n)
+    FROM skeleton_adjacency
+    WHERE post_skeleton_id = ANY(%(skids)s::integer[])
+      AND pre_skeleton_id != post_skeleton_id
+      AND relation_id = %(pre)s
+    ''', {'skids': map(int, skeleton_set), 'pre': pre, 'post': post})
     connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
     for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
+        connections[row[0]][row[1]][row[2]] += int(row[3])
     return connections
 
 def _relations(cursor, project_id):
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
-    return dict(cursor.fetchall())
+    return get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'), cursor)
 
 def _clean_mins(request, cursor, project_id):
     min_pre  = int(request.POST.get('min_pre',  -1))
@@ -1,16 +1,19 @@
 import string
 import random
 import json
+import threading
+import time
 
 from collections import defaultdict
 
 from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
 from django.http import HttpResponse
 
 from catmaid.fields import Double3D
 from catmaid.models import Log, NeuronSearch, CELL_BODY_CHOICES, \
-        SORT_ORDERS_DICT, Relation, Class, ClassInstance, \
-        ClassInstanceClassInstance
+        SORT_ORDERS_DICT, ClassInstance, ClassInstanceClassInstance
 
 def identity(x):
     """Simple identity."""
@@ -268,45 +271,123 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
+# A process-wide cache of relation and class name to ID maps. Keys are
+# generated by _id_map_cache_key(), values are (expiration time, map) tuples.
+# If ID_MAP_CACHE names a cache in CACHES, maps are stored there instead, so
+# that all processes share them.
+_id_map_cache = {}
+
+# Keys of maps that were changed in the current, not yet committed transaction
+# of a thread. These maps are not cached until the transaction is committed.
+_uncommitted_id_maps = threading.local()
+
+
+def _id_map_cache_key(table, project_id):
+    return 'catmaid-idmap:%s:%d' % (table, project_id)
+
+
+def _get_uncommitted_id_map_keys():
+    if not hasattr(_uncommitted_id_maps, 'keys'):
+        _uncommitted_id_maps.keys = set()
+    return _uncommitted_id_maps.keys
+
+
+def _get_shared_id_map_cache():
+    if settings.ID_MAP_CACHE:
+        return caches[settings.ID_MAP_CACHE]
+    return None
+
+
+def _get_id_map(table, name_column, project_id, name_constraints=None,
+        cursor=None):
+    """Return a mapping of names to IDs of all entries in a table for a
+    project. The mapping is retrieved from the cache, if possible. If names are
+    requested that are not part of a cached map, the map is reloaded, because
+    they might have been created by another process.
+    """
+    project_id = int(project_id)
+    key = _id_map_cache_key(table, project_id)
+    shared_cache = _get_shared_id_map_cache()
+    cacheable = key not in _get_uncommitted_id_map_keys()
+
+    id_map = None
+    if cacheable:
+        if shared_cache:
+            id_map = shared_cache.get(key)
+        else:
+            entry = _id_map_cache.get(key)
+            if entry and entry[0] > time.time():
+                id_map = entry[1]
+
+    if id_map is None or (name_constraints and
+            any(n not in id_map for n in name_constraints)):
+        cursor = cursor or connection.cursor()
+        cursor.execute("SELECT %s, id FROM %s WHERE project_id = %%s" %
+                (name_column, table), (project_id,))
+        id_map = dict(cursor.fetchall())
+        if cacheable:
+            timeout = settings.ID_MAP_CACHE_TIMEOUT
+            if shared_cache:
+                shared_cache.set(key, id_map, timeout)
+            else:
+                _id_map_cache[key] = (time.time() + timeout, id_map)
+
+    if name_constraints:
+        return {n: id_map[n] for n in name_constraints if n in id_map}
+    return dict(id_map)
+
+
+def _invalidate_id_map(key):
+    _id_map_cache.pop(key, None)
+    shared_cache = _get_shared_id_map_cache()
+    if shared_cache:
+        shared_cache.delete(key)
+
+
+def invalidate_id_map_cache(table, project_id):
+    """Remove the cached name to ID map of the passed in table and project. The
+    map isn't cached again until the current transaction is committed.
+    """
+    key = _id_map_cache_key(table, int(project_id))
+    _invalidate_id_map(key)
+    _get_uncommitted_id_map_keys().add(key)
+
+    def on_commit():
+        _invalidate_id_map(key)
+        _get_uncommitted_id_map_keys().discard(key)
+    transaction.on_commit(on_commit)
+
+
+def reset_uncommitted_id_maps():
+    """Allow caching of all name to ID maps again that were changed in this
+    thread's last transaction. This is used when a new transaction starts.
+    """
+    _get_uncommitted_id_map_keys().clear()
+
+
+def clear_id_map_cache():
+    """Remove all cached name to ID maps of this process."""
+    _id_map_cache.clear()
+    reset_uncommitted_id_maps()
+
+
 def get_relation_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of relation names to relation IDs. If a list of names is
     provided, only relations with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Results are cached.
     """
-    if cursor:
-        query = "SELECT relation_name, id  FROM relation WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('relation_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Relation.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(relation_name__in=name_constraints)
-        return {rname: ID for rname, ID in query.values_list("relation_name", "id")}
+    return _get_id_map('relation', 'relation_name', project_id,
+            name_constraints, cursor)
 
 def get_class_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of class names to relation IDs. If a list of names is
     provided, only classes with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Results are cached.
     """
-    if cursor:
-        query = "SELECT class_name, id  FROM class WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('class_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Class.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(class_name__in=name_constraints)
-        return {cname: ID for cname, ID in query.values_list("class_name", "id")}
+    return _get_id_map('class', 'class_name', project_id, name_constraints,
+            cursor)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
@@ -5,7 +5,6 @@ from itertools import imap
 from datetime import datetime, timedelta
 
 from django.db import connection
-from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse, JsonResponse, Http404
 
@@ -14,11 +13,11 @@ from rest_framework.decorators import api_view
 from catmaid import state
 from catmaid.fields import Double3D
 from catmaid.models import Project, Stack, ProjectStack, Connector, \
-        ConnectorClassInstance, Treenode, TreenodeConnector, UserRole
+        TreenodeConnector, UserRole
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.link import create_treenode_links
-from catmaid.control.common import cursor_fetch_dictionary, \
-        get_relation_to_id_map, get_request_list
+from catmaid.control import node_list_cache
+from catmaid.control.common import get_relation_to_id_map, get_request_list
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def graphedge_list(request, project_id=None):
@@ -146,8 +145,86 @@ def _many_to_many_synapses(skids1, skids2, relation_name, project_id):
                   (row[15], row[16], row[17])) for row in cursor.fetchall())
 
 
+# Links of a skeleton with the requested relation, paired with all partner
+# links of the inverse relation. Connectors without partners are listed once,
+# with the first link of the skeleton.
+CONNECTOR_TABLE_LINKS = '''
+    this_link AS (
+        SELECT connector_id, treenode_id, confidence
+        FROM treenode_connector
+        WHERE skeleton_id = %(skeleton_id)s
+          AND relation_id = %(relation_id)s
+    ), link AS (
+        SELECT t.connector_id, t.treenode_id AS this_treenode_id,
+               t.confidence, o.treenode_id AS other_treenode_id,
+               o.skeleton_id AS other_skeleton_id,
+               o.confidence AS target_confidence
+        FROM this_link t
+        JOIN treenode_connector o
+          ON o.connector_id = t.connector_id
+         AND o.relation_id = %(inverse_relation_id)s
+        UNION ALL
+        (SELECT DISTINCT ON (t.connector_id) t.connector_id, t.treenode_id,
+               t.confidence, NULL, NULL, NULL
+        FROM this_link t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM treenode_connector o
+            WHERE o.connector_id = t.connector_id
+              AND o.relation_id = %(inverse_relation_id)s)
+        ORDER BY t.connector_id, t.treenode_id)
+    )
+'''
+
+# Details of connector table rows, in join order. Each entry is a table alias
+# and the join that adds it to the links (l).
+CONNECTOR_TABLE_JOINS = (
+    ('c', 'JOIN connector c ON c.id = l.connector_id'),
+    ('tn', 'LEFT JOIN treenode tn ON tn.id = l.other_treenode_id'),
+    ('u', 'JOIN auth_user u ON u.id = COALESCE(tn.user_id, c.user_id)'),
+    ('css', '''LEFT JOIN catmaid_skeleton_summary css
+                 ON css.skeleton_id = l.other_skeleton_id'''),
+    ('lb', '''LEFT JOIN LATERAL (
+                 SELECT string_agg(ci.name, ', ' ORDER BY upper(ci.name)) AS labels
+                 FROM connector_class_instance cci
+                 JOIN class_instance ci ON ci.id = cci.class_instance_id
+                 WHERE cci.connector_id = l.connector_id
+                   AND cci.relation_id = %(labeled_as)s
+                   AND cci.project_id = %(project_id)s
+             ) lb ON TRUE'''),
+)
+
+# Sort expressions of the connector table columns: an expression that is true
+# for missing values, which sort last in ascending order, the sort value and
+# the details it needs to be joined.
+CONNECTOR_TABLE_SORT_COLUMNS = (
+    ('FALSE', 'l.connector_id', ()),
+    ('l.other_skeleton_id IS NULL', 'COALESCE(l.other_skeleton_id, 0)', ()),
+    ('FALSE', 'COALESCE(tn.location_x, c.location_x)', ('c', 'tn')),
+    ('FALSE', 'COALESCE(tn.location_y, c.location_y)', ('c', 'tn')),
+    ('FALSE', 'COALESCE(tn.location_z, c.location_z)', ('c', 'tn')),
+    ('FALSE', 'l.confidence', ()),
+    ('l.target_confidence IS NULL', 'COALESCE(l.target_confidence, 0)', ()),
+    ('FALSE', "upper(COALESCE(lb.labels, ''))", ('lb',)),
+    ('FALSE', 'COALESCE(css.num_nodes, 0)', ('css',)),
+    ('FALSE', 'upper(u.username)', ('c', 'tn', 'u')),
+    ('l.other_treenode_id IS NULL', 'COALESCE(l.other_treenode_id, 0)', ()),
+    ('FALSE', 'c.edition_time', ('c',)),
+)
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def list_connector(request, project_id=None):
+    """List the connectors of a skeleton for the connector table.
+
+    Rows are sorted and paged in the database and only the rows of the
+    requested page are joined with the details of connectors, partner nodes,
+    partner skeletons and labels. Pages are selected with iDisplayStart and
+    iDisplayLength (-1 for all rows). Alternatively, a page_key can be passed
+    in, in which case iDisplayStart is ignored and the page starts after the
+    row the key refers to. An empty page_key selects the first page. In this
+    mode, the response contains the key of the next page as next_page_key, or
+    null if there are no more rows.
+    """
     skeleton_id = request.POST.get('skeleton_id', None)
 
     def empty_result():
@@ -170,6 +247,16 @@ def list_connector(request, project_id=None):
     if sorting_column > 4:
         sorting_column = sorting_column - 1
     sort_descending = upper(request.POST.get('sSortDir_0', 'DESC')) != 'ASC'
+    if sorting_column < 0 or sorting_column >= len(CONNECTOR_TABLE_SORT_COLUMNS):
+        raise ValueError('Unknown sorting column: %s' % sorting_column)
+
+    with_page_key = 'page_key' in request.POST
+    page_key = request.POST.get('page_key')
+    if page_key:
+        page_key = json.loads(page_key)
+        if len(page_key) != 5:
+            raise ValueError('The page key needs to have five elements')
+        display_start = 0
 
     response_on_error = ''
     try:
@@ -187,195 +274,109 @@ def list_connector(request, project_id=None):
             relation_type_id = relation_map['postsynaptic_to']
             inverse_relation_type_id = relation_map['presynaptic_to']
 
-        response_on_error = 'Failed to select connectors.'
-        cursor.execute(
-            '''
-            SELECT
-            connector.id AS connector_id,
-            tn_other.user_id AS connector_user_id,
-            treenode_user.username AS connector_username,
-            connector.location_x AS connector_x,
-            connector.location_y AS connector_y,
-            connector.location_z AS connector_z,
-            tn_other.id AS other_treenode_id,
-            tn_other.location_x AS other_treenode_x,
-            tn_other.location_y AS other_treenode_y,
-            tn_other.location_z AS other_treenode_z,
-            tn_other.skeleton_id AS other_skeleton_id,
-            tn_this.location_x AS this_treenode_x,
-            tn_this.location_y AS this_treenode_y,
-            tn_this.location_z AS this_treenode_z,
-            tn_this.id AS this_treenode_id,
-            tc_this.relation_id AS this_to_connector_relation_id,
-            tc_this.confidence AS confidence,
-            tc_other.relation_id AS connector_to_other_relation_id,
-            tc_other.confidence AS target_confidence,
-            connector.edition_time AS last_modified
-            FROM
-            treenode tn_other,
-            treenode_connector tc_other,
-            connector,
-            "auth_user" treenode_user,
-            treenode_connector tc_this,
-            treenode tn_this
-            WHERE
-            treenode_user.id = tn_other.user_id AND
-            tn_other.id = tc_other.treenode_id AND
-            tc_other.connector_id = connector.id AND
-            tc_other.relation_id = %s AND
-            tc_this.connector_id = connector.id AND
-            tn_this.id = tc_this.treenode_id AND
-            tn_this.skeleton_id = %s AND
-            tc_this.relation_id = %s
-            ORDER BY
-            connector_id, other_treenode_id, this_treenode_id
-            ''',  [inverse_relation_type_id, skeleton_id, relation_type_id])
-
-        connectors = cursor_fetch_dictionary(cursor)
-        connected_skeletons = map(lambda con: con['other_skeleton_id'], connectors)
-        connector_ids = map(lambda con: con['connector_id'], connectors)
-
-        response_on_error = 'Failed to find counts of treenodes in skeletons.'
-        skel_tn_count = Treenode.objects.filter(skeleton__in=connected_skeletons)\
-        .values('skeleton').annotate(treenode_count=Count('skeleton'))
-        # .values to group by skeleton_id. See http://tinyurl.com/dj-values-annotate
-
-        skeleton_to_treenode_count = {}
-        for s in skel_tn_count:
-            skeleton_to_treenode_count[s['skeleton']] = s['treenode_count']
-
-        # Rather than do a LEFT OUTER JOIN to also include the connectors
-        # with no partners, just do another query to find the connectors
-        # without the conditions:
-
-        response_on_error = 'Failed to select all connectors.'
-        cursor.execute(
-            '''
-            SELECT
-            connector.id AS connector_id,
-            connector.user_id AS connector_user_id,
-            connector_user.username AS connector_username,
-            connector.location_x AS connector_x,
-            connector.location_y AS connector_y,
-            connector.location_z AS connector_z,
-            tn_this.id AS this_treenode_id,
-            tc_this.relation_id AS this_to_connector_relation_id,
-            tc_this.confidence AS confidence,
-            connector.edition_time AS last_modified
-            FROM
-            connector,
-            "auth_user" connector_user,
-            treenode_connector tc_this,
-            treenode tn_this
-            WHERE
-            connector_user.id = connector.user_id AND
-            tc_this.connector_id = connector.id AND
-            tn_this.id = tc_this.treenode_id AND
-            tn_this.skeleton_id = %s AND
-            tc_this.relation_id = %s
-            ORDER BY
-            connector_id, this_treenode_id
-            ''',  [skeleton_id, relation_type_id])
-        for row in cursor_fetch_dictionary(cursor):
-            connector_id = row['connector_id']
-            if connector_id not in connector_ids:
-                connectors.append(row)
-                connector_ids.append(connector_id)
-
-        # For each of the connectors, find all of its labels:
-        response_on_error = 'Failed to find the labels for connectors'
-        if (connector_ids > 0):
-            connector_labels = ConnectorClassInstance.objects.filter(
-                project=project_id,
-                connector__in=connector_ids,
-                relation=relation_map['labeled_as']).values(
-                'connector',
-                'class_instance__name')
-
-            labels_by_connector = {}  # Key: Connector ID, Value: List of labels.
-            for label in connector_labels:
-                if label['connector'] not in labels_by_connector:
-                    labels_by_connector[label['connector']] = [label['class_instance__name']]
-                else:
-                    labels_by_connector[label['connector']].append(label['class_instance__name'])
-                # Sort labels by name
-            for labels in labels_by_connector.values():
-                labels.sort(key=upper)
-
-        total_result_count = len(connectors)
+        params = {
+            'project_id': int(project_id),
+            'skeleton_id': skeleton_id,
+            'relation_id': relation_type_id,
+            'inverse_relation_id': inverse_relation_type_id,
+            'labeled_as': relation_map['labeled_as'],
+            'offset': display_start,
+            # Fetch one more row to know whether there is a next page
+            'limit': None if display_length == -1 else display_length + 1,
+            'page_key': tuple(page_key) if page_key else None,
+        }
+
+        response_on_error = 'Failed to count connectors.'
+        cursor.execute('''
+            WITH {}
+            SELECT count(*) FROM link
+        '''.format(CONNECTOR_TABLE_LINKS), params)
+        total_result_count = cursor.fetchone()[0]
 
         if 0 == total_result_count:
             return empty_result()
 
-        # Paging
-        if display_length == -1:
-            connectors = connectors[display_start:]
-            connector_ids = connector_ids[display_start:]
-        else:
-            connectors = connectors[display_start:display_start + display_length]
-            connector_ids = connector_ids[display_start:display_start + display_length]
+        null_expr, sort_expr, sort_joins = CONNECTOR_TABLE_SORT_COLUMNS[sorting_column]
+        sort_key = (null_expr, sort_expr, 'l.connector_id',
+                'COALESCE(l.other_treenode_id, 0)', 'l.this_treenode_id')
+        direction = 'DESC' if sort_descending else 'ASC'
+        page_order = ', '.join('{} {}'.format(e, direction) for e in sort_key)
+        page_filter = 'WHERE ({}) {} %(page_key)s'.format(
+                ', '.join(sort_key), '<' if sort_descending else '>') \
+                if page_key else ''
+        page_joins = '\n'.join(join for alias, join in CONNECTOR_TABLE_JOINS
+                if alias in sort_joins)
+        all_joins = '\n'.join(join for alias, join in CONNECTOR_TABLE_JOINS)
 
-        # Format output
+        response_on_error = 'Failed to select connectors.'
+        cursor.execute('''
+            WITH {links}, page AS (
+                SELECT l.*, {null_expr} AS sort_null, {sort_expr} AS sort_value
+                FROM link l
+                {page_joins}
+                {page_filter}
+                ORDER BY {page_order}
+                LIMIT %(limit)s OFFSET %(offset)s
+            )
+            SELECT l.connector_id, l.other_skeleton_id,
+                   COALESCE(tn.location_x, c.location_x),
+                   COALESCE(tn.location_y, c.location_y),
+                   COALESCE(tn.location_z, c.location_z),
+                   l.confidence, l.target_confidence,
+                   COALESCE(lb.labels, ''), COALESCE(css.num_nodes, 0),
+                   u.username, l.other_treenode_id, c.edition_time,
+                   l.sort_null, l.sort_value, l.connector_id,
+                   COALESCE(l.other_treenode_id, 0), l.this_treenode_id
+            FROM page l
+            {all_joins}
+            ORDER BY l.sort_null {direction}, l.sort_value {direction},
+                     l.connector_id {direction},
+                     COALESCE(l.other_treenode_id, 0) {direction},
+                     l.this_treenode_id {direction}
+        '''.format(links=CONNECTOR_TABLE_LINKS, null_expr=null_expr,
+                sort_expr=sort_expr, page_joins=page_joins,
+                page_filter=page_filter, page_order=page_order,
+                all_joins=all_joins, direction=direction), params)
+        rows = cursor.fetchall()
+
+        next_page_key = None
+        if display_length != -1 and len(rows) > display_length:
+            rows = rows[:display_length]
+            next_page_key = [v.isoformat() if isinstance(v, datetime) else v
+                    for v in rows[-1][12:]]
+
+        # Format output, missing partner information is represented by empty
+        # strings and coordinates with excessive decimal precision are rounded.
+        response_on_error = 'Failed to format output.'
         aaData_output = []
-        for c in connectors:
-            response_on_error = 'Failed to format output for connector with ID %s.' % c['connector_id']
-            if 'other_skeleton_id' in c:
-                connected_skeleton_treenode_count = skeleton_to_treenode_count[c['other_skeleton_id']]
-            else:
-                c['other_skeleton_id'] = ''
-                c['other_treenode_id'] = ''
-                c['other_treenode_x'] = c['connector_x']
-                c['other_treenode_y'] = c['connector_y']
-                c['other_treenode_z'] = c['connector_z']
-                c['target_confidence'] = ''
-                connected_skeleton_treenode_count = 0
-
-            if c['connector_id'] in labels_by_connector:
-                labels = ', '.join(map(str, labels_by_connector[c['connector_id']]))
-            else:
-                labels = ''
-
-            row = []
-            row.append(c['connector_id'])
-            row.append(c['other_skeleton_id'])
-            row.append(c['other_treenode_x']) #('%.2f' % )
-            row.append(c['other_treenode_y'])
-            z = c['other_treenode_z']
-            row.append(z)
-            row.append(c['confidence'])
-            row.append(c['target_confidence'])
-            row.append(labels)
-            row.append(connected_skeleton_treenode_count)
-            row.append(c['connector_username'])
-            row.append(c['other_treenode_id'])
-            row.append(str(c['last_modified'].isoformat()))
-            aaData_output.append(row)
-
-        # Sort output
-        def fetch_value_for_sorting(row):
-            value = row[sorting_column]
-            if isinstance(value, str) or isinstance(value, unicode):
-                return upper(value)
-            return value
-        aaData_output.sort(key=fetch_value_for_sorting)
-
-        # Fix excessive decimal precision in coordinates
-        for row in aaData_output:
-            row[2] = float('%.2f' % row[2])
-            row[3] = float('%.2f' % row[3])
-            row[4] = float('%.2f' % row[4])
-
-        if sort_descending:
-            aaData_output.reverse()
-
-        return HttpResponse(json.dumps({
+        for row in rows:
+            aaData_output.append([
+                row[0],
+                '' if row[1] is None else row[1],
+                float('%.2f' % row[2]),
+                float('%.2f' % row[3]),
+                float('%.2f' % row[4]),
+                row[5],
+                '' if row[6] is None else row[6],
+                row[7],
+                row[8],
+                row[9],
+                '' if row[10] is None else row[10],
+                str(row[11].isoformat())])
+
+        result = {
             'iTotalRecords': total_result_count,
             'iTotalDisplayRecords': total_result_count,
-            'aaData': aaData_output}))
+            'aaData': aaData_output}
+        if with_page_key:
+            result['next_page_key'] = next_page_key
+
+        return HttpResponse(json.dumps(result))
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
+
 def _connector_skeletons(connector_ids, project_id):
     """ Return a dictionary of connector ID as keys and a dictionary as value
     containing two entries: 'presynaptic_to' with a skeleton ID or None,
@@ -506,6 +507,8 @@ def create_connector(request, project_id=None):
     else:
         created_links = []
 
+    node_list_cache.invalidate_nodes(project_id, [new_connector.id], cursor=cursor)
+
     return JsonResponse({
         'connector_id': new_connector.id,
         'connector_edition_time': new_connector.edition_time,
@@ -539,6 +542,7 @@ def delete_connector(request, project_id=None):
         'confidence': p.confidence,
         'link_id': p.id
     } for p in connector.treenodeconnector_set.all()]
+    node_list_cache.invalidate_nodes(project_id, [connector_id], cursor=cursor)
     connector.delete()
     return JsonResponse({
         'message': 'Removed connector and class_instances',
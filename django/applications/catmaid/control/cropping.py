@@ -6,19 +6,25 @@ from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
 
 from catmaid.models import Stack, Project, ProjectStack, Message, User
+from catmaid.control import tile_cache
 from catmaid.control.common import id_generator, json_error_response
 
 import urllib2 as urllib
+import os
 import os.path
 import glob
+import struct
+import requests
+import numpy as np
+from collections import deque
+from fractions import Fraction
+from io import BytesIO
+from itertools import imap, islice
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
 from time import time
 from math import cos, sin, radians
-
-# The libuuid import is a workaround for a bug with GraphicsMagick
-# which expects the library to be loaded already. Therefore, it
-# has to be loaded before pgmagick.
-from pgmagick import Blob, Image, ImageList, Geometry, ChannelType, \
-        CompositeOperator as co
+from PIL import Image
 
 from celery.task import task
 
@@ -159,6 +165,86 @@ class ImageRetrievalError(IOError):
         self.path = path
         self.error = error
 
+# Tiles are fetched by a pool of TILE_FETCH_THREADS threads per process, each
+# of which reuses its HTTP connections.
+_fetch_pool = None
+_fetch_pool_pid = None
+_fetch_pool_lock = Lock()
+_sessions = local()
+
+def get_fetch_pool():
+    """ Returns the tile fetching thread pool of the current process or None
+    if TILE_FETCH_THREADS is lower than two. The pool is created on first use,
+    so that forked worker processes each get their own.
+    """
+    global _fetch_pool, _fetch_pool_pid
+    size = getattr(settings, 'TILE_FETCH_THREADS', 0)
+    if size < 2:
+        return None
+    with _fetch_pool_lock:
+        if _fetch_pool is None or _fetch_pool_pid != os.getpid():
+            _fetch_pool = ThreadPool(size)
+            _fetch_pool_pid = os.getpid()
+        return _fetch_pool
+
+def get_session():
+    """ Returns the HTTP session of the current thread, which keeps
+    connections to tile servers alive.
+    """
+    pid = os.getpid()
+    if getattr(_sessions, 'pid', None) != pid:
+        _sessions.session = requests.Session()
+        _sessions.pid = pid
+    return _sessions.session
+
+def fetch_tile(path):
+    """ Returns the data of the tile at the passed in path, which is taken
+    from the tile cache if possible.
+    """
+    img_data = tile_cache.get(path)
+    if img_data is not None:
+        return img_data
+    if path.startswith(('http://', 'https://')):
+        try:
+            response = get_session().get(path)
+            response.raise_for_status()
+            img_data = response.content
+        except requests.HTTPError as e:
+            raise ImageRetrievalError(path, "Error code: %s" % \
+                    e.response.status_code)
+        except requests.RequestException as e:
+            raise ImageRetrievalError(path, str(e))
+    else:
+        try:
+            img_data = urllib.urlopen(path).read()
+        except urllib.HTTPError as e:
+            raise ImageRetrievalError(path, "Error code: %s" % e.code)
+        except urllib.URLError as e:
+            raise ImageRetrievalError(path, e.reason)
+    tile_cache.put(path, img_data)
+    return img_data
+
+def fetch_tiles(paths):
+    """ Returns an iterator over the data of the tiles at the passed in
+    paths, in the order of the paths. If a fetch pool is available, tiles are
+    fetched concurrently, at most four tiles per thread ahead of the tile that
+    is currently consumed. Errors are raised when the tile is consumed.
+    """
+    pool = get_fetch_pool()
+    if pool is None:
+        for path in paths:
+            yield fetch_tile(path)
+        return
+    paths = iter(paths)
+    window = 4 * settings.TILE_FETCH_THREADS
+    pending = deque(pool.apply_async(fetch_tile, (path,))
+            for path in islice(paths, window))
+    while pending:
+        img_data = pending.popleft().get()
+        for path in islice(paths, 1):
+            pending.append(pool.apply_async(fetch_tile, (path,)))
+        yield img_data
+
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
@@ -179,32 +265,36 @@ class ImagePart:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
-    def get_image( self ):
-        # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
+    def get_image( self, img_data=None, mode=None ):
+        """ Returns the image part as NumPy array, optionally based on already
+        fetched tile data. The tile is converted to the passed in mode ('L' or
+        'RGB'). By default, grayscale tiles are kept and all others are
+        converted to RGB.
+        """
+        if img_data is None:
+            img_data = fetch_tile( self.path )
+        bytes_read = len(img_data)
 
-        blob = Blob( img_data )
-        image = Image( blob )
-        # Check if the whole image should be used and cropped if necessary.
-        src_width = image.size().width()
-        src_height = image.size().height()
-        if self.width != src_width or self.height != src_height:
-            box = Geometry( self.width, self.height, self.x_min_src, self.y_min_src )
-            image.crop( box )
+        try:
+            image = Image.open( BytesIO(img_data) )
+            if mode is None:
+                mode = 'L' if image.mode == 'L' else 'RGB'
+            if image.mode != mode:
+                image = image.convert( mode )
+            data = np.asarray( image )
+        except IOError as e:
+            raise ImageRetrievalError(self.path, str(e))
+        # Crop the tile if only a part of it is used.
+        src_height, src_width = data.shape[:2]
+        data = data[self.y_min_src:self.y_min_src + self.height,
+                    self.x_min_src:self.x_min_src + self.width]
 
         # Estimates the size in Bytes of this image part by scaling the number
         # of Bytes read with the ratio between the needed part of the image and
         # its actual size.
         self.estimated_size = bytes_read * abs(float(self.width * self.height) /
                                                float(src_width * src_height))
-        return image
+        return data
 
 def to_x_index( x, job, enforce_bounds=True ):
     """ Converts a real world position to a x pixel position.
@@ -233,26 +323,109 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use a separate tool called exiftool to write
-    meta data. Currently, there seems no better solution than this. If the
-    tool is not found, no meta data is produced and no error is raised.
+class TiffWriter:
+    """ Writes images to a multi-page TIFF file, one page at a time, so that
+    only the current image needs to be kept in memory. Images are 2D
+    (grayscale) or 3D (RGB) NumPy arrays of 8 bit values, which are stored
+    uncompressed. Optionally, resolution (in pixels per unit), description and
+    software tags are added to each page.
+    """
+    def __init__( self, path, x_resolution=None, y_resolution=None,
+            description=None, software=None ):
+        self.file = open( path, 'wb' )
+        self.x_resolution = x_resolution
+        self.y_resolution = y_resolution
+        self.description = description
+        self.software = software
+        # Little endian header, the first IFD offset is written with the first
+        # page.
+        self.file.write( b'II' + struct.pack('<HI', 42, 0) )
+        self.next_ifd_pointer = 4
+
+    def _append( self, data ):
+        """ Appends data at a word boundary and returns its offset.
+        """
+        offset = self.file.tell()
+        if offset % 2:
+            self.file.write( b'\0' )
+            offset += 1
+        self.file.write( data )
+        return offset
+
+    def write( self, image ):
+        image = np.asarray( image )
+        if image.dtype != np.uint8 or image.ndim not in (2, 3):
+            raise ValueError( "Only 8 bit grayscale and RGB images are supported" )
+        height, width = image.shape[:2]
+        samples = image.shape[2] if image.ndim == 3 else 1
+        pixels = np.ascontiguousarray( image ).tobytes()
+
+        self.file.seek( 0, os.SEEK_END )
+        strip_offset = self._append( pixels )
+        # Tags as (tag, type, values), types are 2: ASCII, 3: SHORT, 4: LONG,
+        # 5: RATIONAL
+        tags = [
+            (256, 4, [width]),
+            (257, 4, [height]),
+            (258, 3, [8] * samples),
+            (259, 3, [1]),
+            (262, 3, [2 if samples == 3 else 1]),
+            (273, 4, [strip_offset]),
+            (277, 3, [samples]),
+            (278, 4, [height]),
+            (279, 4, [len(pixels)]),
+            (284, 3, [1]),
+        ]
+        if self.description:
+            tags.append( (270, 2, self.description) )
+        if self.x_resolution and self.y_resolution:
+            tags.append( (282, 5, [self.x_resolution]) )
+            tags.append( (283, 5, [self.y_resolution]) )
+            tags.append( (296, 3, [1]) )
+        if self.software:
+            tags.append( (305, 2, self.software) )
+        tags.sort()
+
+        entries = []
+        for tag, tag_type, values in tags:
+            if tag_type == 2:
+                value = values.encode('ascii') + b'\0'
+                count = len(value)
+            elif tag_type == 5:
+                value = b''.join( struct.pack('<II', f.numerator, f.denominator)
+                        for f in (Fraction(v).limit_denominator(2**31)
+                            for v in values) )
+                count = len(values)
+            else:
+                value = struct.pack( '<%s%s' % (len(values),
+                        'H' if tag_type == 3 else 'I'), *values )
+                count = len(values)
+            # Values that don't fit into an entry are stored separately
+            if len(value) > 4:
+                value = struct.pack( '<I', self._append(value) )
+            entries.append( struct.pack('<HHI', tag, tag_type, count) +
+                    value.ljust(4, b'\0') )
+
+        ifd_offset = self._append( struct.pack('<H', len(entries)) +
+                b''.join(entries) + struct.pack('<I', 0) )
+        # Link the new IFD from the previous one
+        self.file.seek( self.next_ifd_pointer )
+        self.file.write( struct.pack('<I', ifd_offset) )
+        self.next_ifd_pointer = ifd_offset + 2 + 12 * len(entries)
+
+    def close( self ):
+        self.file.close()
+
+def get_tiff_metadata( job, n_images ):
+    """ Returns the meta data of a cropped stack, written to every page, as
+    keyword arguments for a TiffWriter: the resolution in pixel per nanometer
+    and ImageJ specific meta data to allow easy embedding of units and display
+    options.
     """
-    # Add resolution information in pixel per nanometer. The stack info
-    # available is nm/px and refers to a zoom-level of zero.
+    # The stack info available is nm/px and refers to a zoom-level of zero.
     res_x_scaled = job.ref_stack.resolution.x * 2**job.zoom_level
     res_y_scaled = job.ref_stack.resolution.y * 2**job.zoom_level
-    res_x_nm_px = 1.0 / res_x_scaled
-    res_y_nm_px = 1.0 / res_y_scaled
-    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
-            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
-
-    # ImageJ specific meta data to allow easy embedding of units and
-    # display options.
-    n_images = len( result )
+
     ij_version= "1.45p"
     unit = "nm"
     newline = "\n"
@@ -267,58 +440,45 @@ def addMetaData( path, job, result ):
                     "modulo the channel count is not zero" )
         n_slices = n_images / n_channels
         ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
-    ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
-
-    # Information about the software used
-    sw_args = "-EXIF:Software=\"Created with CATMAID and GraphicsMagic, " \
-            "processed with exiftool.\""
-    # Build up the final tag changing arguments for each slice
-    tag_args = "{0} {1} {2}".format( res_args, ij_args, sw_args )
-    per_slice_tag_args = []
-    for i in range(0, n_images):
-        # the string EXIF gets replaced for every image with IFD<N>
-        slice_args = tag_args.replace( "EXIF", "IFD" + str(i) )
-        per_slice_tag_args.append( slice_args  )
-    final_tag_args = " ".join( per_slice_tag_args )
-    # Create the final call and execute
-    call = "exiftool -overwrite_original {0} {1}".format( final_tag_args, path )
-    os.system( call )
-
-    # Re-save the image with GraphicsMagick, otherwise ImageJ won't read the
-    # images directly.
-    images = ImageList()
-    images.readImages( path )
-    images.writeImages( path )
 
-def extract_substack( job ):
+    return {
+        'x_resolution': 1.0 / res_x_scaled,
+        'y_resolution': 1.0 / res_y_scaled,
+        'description': ij_data,
+        'software': "Created with CATMAID",
+    }
+
+def iter_substack( job ):
     """ Extracts a sub-stack as specified in the passed job while respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+    rotation requests. A tuple of the number of images and an iterator over
+    the images is returned. Images are NumPy arrays -- one for each slice and
+    stack, starting on top -- which are created while iterating. This way only
+    one of them needs to be kept in memory.
     """
 
     # Make sure tile source getters have been initialized on the job
     if job.needs_initialization:
         job.initialize()
 
-    # Treat rotation requests special
+    # Treat rotation requests special. Rotations are given clockwise, NumPy and
+    # Pillow rotate counterclockwise. Rotating the view clockwise means rotating
+    # the image content counterclockwise.
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        slices = get_substack_parts( job )
+        transform = None
     elif abs(job.rotation_cw - 90.0) < 0.00001:
         # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(270.0)
+        slices = get_substack_parts( job )
+        transform = lambda img: np.rot90(img, 1)
     elif abs(job.rotation_cw - 180.0) < 0.00001:
         # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(180.0)
+        slices = get_substack_parts( job )
+        transform = lambda img: np.rot90(img, 2)
     elif abs(job.rotation_cw - 270.0) < 0.00001:
         # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(90.0)
+        slices = get_substack_parts( job )
+        transform = lambda img: np.rot90(img, 3)
     else:
         # Some methods do counter-clockwise rotation
         rotation_ccw = 360.0 - job.rotation_cw
@@ -346,17 +506,13 @@ def extract_substack( job ):
         job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
         job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        # Plan the enlarged sub-stack
+        slices = get_substack_parts( job )
 
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        for img in cropped_stack:
-            img.rotate(rotation_ccw)
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
+        # Each image of the enlarged sub-stack will be rotated to have the
+        # actual ROI axis aligned. Then a second crop removes the not needed
+        # parts. The region to crop is defined by the relative original
+        # crop-box coordinates to to the rotated bounding box.
         rot_bb_p1 = rotate2d(rotation_ccw,
             [job.x_min, job.y_min], center)
         rot_bb_p2 = rotate2d(rotation_ccw,
@@ -381,13 +537,14 @@ def extract_substack( job ):
         crop_y_min_px = to_y_index(crop_y_min, job, False)
         crop_x_max_px = to_x_index(crop_x_max, job, False)
         crop_y_max_px = to_y_index(crop_y_max, job, False)
-        crop_width_px = crop_x_max_px - crop_x_min_px
-        crop_height_px = crop_y_max_px - crop_y_min_px
-        # Crop all images (Geometry: width, height, xOffset, yOffset)
-        crop_geometry = Geometry(crop_width_px, crop_height_px,
-            crop_x_min_px, crop_y_min_px)
-        for img in cropped_stack:
-            img.crop(crop_geometry)
+
+        def transform(img):
+            # Rotate with bilinear resampling, the canvas is enlarged to
+            # contain the whole rotated image.
+            rotated = Image.fromarray(img).rotate(-rotation_ccw,
+                    resample=Image.BILINEAR, expand=True)
+            return np.asarray(rotated)[crop_y_min_px:crop_y_max_px,
+                                       crop_x_min_px:crop_x_max_px]
 
         # Reset the original job parameters
         job.x_min = real_x_min
@@ -395,12 +552,25 @@ def extract_substack( job ):
         job.y_min = real_y_min
         job.y_max = real_y_max
 
-    return cropped_stack
+    n_images = sum(1 for bb, image_parts in slices if image_parts)
+    images = compose_substack( job, slices )
+    if transform:
+        images = imap( transform, images )
+
+    return n_images, images
+
+def extract_substack( job ):
+    """ Extracts a sub-stack as specified in the passed job while respecting
+    rotation requests. A list of NumPy arrays is returned -- one for each
+    slice and stack, starting on top.
+    """
+    n_images, images = iter_substack( job )
+    return list(images)
 
-def extract_substack_no_rotation( job ):
-    """ Extracts a sub-stack as specified in the passed job without respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+def get_substack_parts( job ):
+    """ Returns the image parts of the sub-stack specified in the passed job
+    without respecting rotation requests. A list of (bounding box, image parts)
+    tuples is returned -- one for each slice and stack, starting on top.
     """
 
     # The actual bounding boxes used for creating the images of each stack
@@ -462,10 +632,10 @@ def extract_substack_no_rotation( job ):
 
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
-    # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
-    # Accumulator for estimated result size
-    estimated_total_size = 0
+    # one slice are exported, then the next slice follows, etc. First, the
+    # image parts of each slice are collected, so that tiles can be fetched
+    # ahead of composing the slices.
+    slices = []
     # Iterate over all slices
     for nz in range(n_slices):
         for stack in job.stacks:
@@ -517,46 +687,56 @@ def extract_substack_no_rotation( job ):
                 # Update x component of destination position
                 x_dst += cur_px_x_max - cur_px_x_min
 
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor("black")
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-
-            if cropped_slice:
-                # Optionally, use only a single channel
-                if job.single_channel:
-                    cropped_slice.channel( ChannelType.RedChannel )
-                # Add the image to the cropped stack
-                cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+            slices.append( (bb, image_parts) )
+
+    return slices
+
+def compose_substack( job, slices ):
+    """ Yields the images of the passed in sub-stack parts as NumPy arrays.
+    Tiles are fetched ahead and decoded into an array of the size of the
+    image they are part of. All tiles of an image are converted to the type
+    of its first tile.
+    """
+    tiles = fetch_tiles([ip.path for bb, image_parts in slices
+            for ip in image_parts])
+
+    # Accumulator for estimated result size
+    estimated_total_size = 0
+    for bb, image_parts in slices:
+        # Write out the image parts and make sure the maximum allowed file
+        # size isn't exceeded.
+        cropped_slice = None
+        mode = None
+        for ip in image_parts:
+            # Get (correctly cropped) image
+            image = ip.get_image( next(tiles), mode )
+
+            # Estimate total file size and abort if this exceeds the
+            # maximum allowed file size.
+            estimated_total_size = estimated_total_size + ip.estimated_size
+            if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+                raise ValueError("The estimated size of the requested image "
+                                 "region is larger than the maximum allowed "
+                                 "file size: %0.2f > %s Bytes" % \
+                                 (estimated_total_size,
+                                  settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+            if cropped_slice is None:
+                mode = 'L' if image.ndim == 2 else 'RGB'
+                cropped_slice = np.zeros( (bb.height, bb.width) + image.shape[2:],
+                        dtype=image.dtype )
+            # Draw the image onto result image, clipped at its border
+            height = min( image.shape[0], bb.height - ip.y_dst )
+            width = min( image.shape[1], bb.width - ip.x_dst )
+            if height > 0 and width > 0:
+                cropped_slice[ip.y_dst:ip.y_dst + height,
+                              ip.x_dst:ip.x_dst + width] = image[:height, :width]
+
+        if cropped_slice is not None:
+            # Optionally, use only a single channel
+            if job.single_channel and cropped_slice.ndim == 3:
+                cropped_slice = cropped_slice[:, :, 0]
+            yield cropped_slice
 
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
@@ -578,22 +758,21 @@ def process_crop_job(job, create_message=True):
     and the creation of the sub-stack. It can be executed as Celery task.
     """
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
+        # Create the sub-stack, its images are created one at a time
+        n_images, cropped_stack = iter_substack( job )
 
         # Save the resulting micro_stack to a temporary location
         no_error_occured = True
         error_message = ""
         # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
+        if n_images > 0:
+            writer = TiffWriter( job.output_path,
+                    **get_tiff_metadata(job, n_images) )
+            try:
+                for img in cropped_stack:
+                    writer.write( img )
+            finally:
+                writer.close()
         else:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
@@ -4,6 +4,7 @@ import urllib2
 from collections import defaultdict
 
 from catmaid.models import Stack
+from catmaid.control import metadata_cache
 
 # These DVID instance types are supported by CATMAID
 SUPPORTED_INSTANCE_TYPES = ('imagetile', 'imageblk')
@@ -143,8 +144,14 @@ class DVIDClient:
 
 
 def get_server_info(url):
-    """Return the parsed JSON result of a DVID server's info endpoint.
+    """Return the parsed JSON result of a DVID server's info endpoint. Results
+    are cached and must not be modified.
     """
+    return metadata_cache.get('remote', 'dvid:' + url,
+            lambda: _load_server_info(url))
+
+
+def _load_server_info(url):
     try:
         info_url = '%s/api/repos/info' % url
         req = urllib2.Request(info_url, headers={'Content-Type': 'application/json'})
@@ -3,8 +3,18 @@ import urllib2
 
 from django.conf import settings
 
+from catmaid.control import metadata_cache
+
 
 def load_json(url):
+    """Return the parsed JSON response of a render service URL. Responses are
+    cached and must not be modified.
+    """
+    return metadata_cache.get('remote', 'flytem:' + url,
+            lambda: _load_json(url))
+
+
+def _load_json(url):
     try:
         json_text = urllib2.urlopen(url).read()
     except urllib2.HTTPError as e:
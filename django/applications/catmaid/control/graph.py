@@ -3,55 +3,129 @@ import logging
 import sys
 
 import networkx as nx
-from networkx.algorithms import weakly_connected_component_subgraphs
+import numpy as np
 from collections import defaultdict
-from itertools import chain, ifilter
+from contextlib import closing
+from itertools import chain, ifilter, izip
 from functools import partial
+from hashlib import sha1
+from operator import itemgetter
 from synapseclustering import  tree_max_density
 from numpy import subtract
 from numpy.linalg import norm
 from math import sqrt
 
+from django.conf import settings
+from django.core.cache import caches
 from django.db import connection
 from django.http import HttpResponse
 
-from catmaid.models import Relation, UserRole
+from rest_framework.decorators import api_view
+
+from catmaid.models import ClassInstance, Relation, UserRole
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, get_request_list
+from catmaid.control.process_pool import imap_tasks
 from catmaid.control.review import get_treenodes_to_reviews
-from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
+from catmaid.control.tree_util import Arbor, lazy_load_arbors, simplify, \
         spanning_tree, cable_length
 
-def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
-    """ dipgrahs is a dictionary of skeleton IDs as keys and DiGraph instances as values,
-    where the DiGraph does not have any edges yet.
-    WARNING: side effect on contents of digraph: will add the edges
+class ArborFragments(object):
+    """ Membership of treenodes in the arbors (fragments) that skeletons were
+    split into. node_ids is a sorted array of treenode IDs and fragments[i] is
+    the index in graphs of the DiGraph that contains node_ids[i], or -1 if the
+    treenode isn't part of any arbor. """
+
+    def __init__(self, node_ids, fragments, graphs):
+        self.node_ids = node_ids
+        self.fragments = fragments
+        self.graphs = graphs
+
+    def assign(self, graphs):
+        """ Make the treenodes of the passed in graphs members of them, e.g.
+        after an arbor was split further into synapse domains. Treenodes that
+        are part of more than one graph are assigned to the first one. """
+        for graph in reversed(graphs):
+            node_ids = np.array(graph.nodes(), dtype=np.int64)
+            indices = np.searchsorted(self.node_ids, node_ids)
+            self.fragments[indices] = len(self.graphs)
+            self.graphs.append(graph)
+
+    def lookup(self, treenode_ids):
+        """ Return a dictionary of treenode ID vs the DiGraph it is part of,
+        for all passed in treenodes that are part of an arbor. """
+        treenode_ids = np.array(list(treenode_ids), dtype=np.int64)
+        if 0 == len(self.node_ids):
+            return {}
+        indices = np.minimum(np.searchsorted(self.node_ids, treenode_ids), len(self.node_ids) - 1)
+        fragments = np.where(self.node_ids[indices] == treenode_ids, self.fragments[indices], -1)
+        graphs = self.graphs
+        return {treenode_id: graphs[fragment] for treenode_id, fragment
+                in izip(treenode_ids.tolist(), fragments.tolist()) if -1 != fragment}
+
+def split_by_confidence_and_add_edges(confidence_threshold, rows, reviews):
+    """ rows: tuples of treenode ID, parent ID, confidence and skeleton ID
+        reviews: dictionary of treenode ID vs list of reviewer IDs
+    Split skeletons at edges with a confidence below the threshold. Each treenode
+    is labeled with the fragment it belongs to by a union-find over the parent
+    array, which doesn't need an intermediate graph of the whole skeleton.
+    Returns a dictionary of skeleton ID vs list of DiGraph instances, one for
+    each fragment, and the ArborFragments that map treenodes to them.
     """
-    arbors = {}
-    # Define edges, which may result in multiple subgraphs for each skeleton
-    # when splitting at low-confidence edges:
-    if 0 == confidence_threshold:
-        # Do not split skeletons
-        for row in rows:
-            if row[1]:
-                digraphs[row[3]].add_edge(row[1], row[0])
-        for skid, digraph in digraphs.iteritems():
-            arbors[skid] = [digraph]
-    else:
-        # The DiGraph representing the skeleton may be disconnected at a low-confidence edge
-        to_split = set()
-        for row in rows:
-            if row[2] < confidence_threshold:
-                to_split.add(row[3])
-            elif row[1]:
-                digraphs[row[3]].add_edge(row[1], row[0])
-        for skid, digraph in digraphs.iteritems():
-            if skid in to_split:
-                arbors[skid] = weakly_connected_component_subgraphs(digraph)
-            else:
-                arbors[skid] = [digraph]
-
-    return arbors
+    if not rows:
+        return {}, ArborFragments(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), [])
+
+    rows = sorted(rows, key=itemgetter(0))
+    node_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    parent_ids = np.array([row[1] or -1 for row in rows], dtype=np.int64)
+    confidences = np.array([row[2] for row in rows], dtype=np.int64)
+    skeleton_ids = np.array([row[3] for row in rows], dtype=np.int64)
+
+    # Each node links to its parent, unless the edge is of low confidence
+    has_parent = parent_ids != -1
+    parents = np.arange(len(node_ids))
+    parents[has_parent] = np.searchsorted(node_ids, parent_ids[has_parent])
+    linked = has_parent & (confidences >= confidence_threshold)
+    roots = np.where(linked, parents, np.arange(len(node_ids)))
+
+    # Find the root of each node's fragment by pointer jumping, which halves
+    # the remaining path length on every pass
+    while True:
+        jumped = roots[roots]
+        if np.array_equal(jumped, roots):
+            break
+        roots = jumped
+
+    # Number fragments by the position of their root node
+    fragment_roots, fragments = np.unique(roots, return_inverse=True)
+    members = np.split(np.argsort(fragments, kind='mergesort'),
+            np.cumsum(np.bincount(fragments))[:-1])
+
+    graphs = []
+    arbors = defaultdict(list)
+    for root, indices in izip(fragment_roots.tolist(), members):
+        g = nx.DiGraph()
+        ids = node_ids[indices].tolist()
+        g.add_nodes_from((node_id, {'reviewer_ids': reviews.get(node_id, [])}) for node_id in ids)
+        children = indices[linked[indices]]
+        g.add_edges_from(izip(node_ids[parents[children]].tolist(), node_ids[children].tolist()))
+        graphs.append(g)
+        arbors[int(skeleton_ids[root])].append(g)
+
+    return dict(arbors), ArborFragments(node_ids, fragments, graphs)
+
+def _synapse_domains(task):
+    """ Cluster the synapses of an arbor with tree_max_density. Runs in worker
+    processes if a process pool is configured, which is why the task is a
+    tuple of node IDs, parent IDs, child IDs and edge lengths as arrays and the
+    synapses' treenode IDs, connector IDs and relations, followed by the
+    bandwidth. Returns a list of (node IDs, local max) tuples, one per domain. """
+    node_ids, parent_ids, child_ids, weights, treenode_ids, connector_ids, relation_ids, bandwidth = task
+    graph = nx.Graph()
+    graph.add_nodes_from(node_ids.tolist())
+    graph.add_weighted_edges_from(izip(parent_ids.tolist(), child_ids.tolist(), weights.tolist()))
+    synapse_group = tree_max_density(graph, treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
+    return [(domain.node_ids, domain.local_max) for domain in synapse_group.itervalues()]
 
 def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, minis):
     """ locations: dictionary of treenode ID vs tuple with x,y,z
@@ -59,9 +133,11 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
         treenode_connectors: dictionary of treenode ID vs list of tuples of connector_id, string of 'presynaptic_to' or 'postsynaptic_to'
     """
     arbors2 = {} # Some arbors will be split further
+    pending = [] # (skeleton_id, list of subdomains, graph) of each graph to split by synapse domain
+    tasks = []
     for skeleton_id, graphs in arbors.iteritems():
-        subdomains = []
-        arbors2[skeleton_id] = subdomains
+        parts = []
+        arbors2[skeleton_id] = parts
         for graph in graphs:
             treenode_ids = []
             connector_ids =[]
@@ -74,7 +150,7 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                     relation_ids.append(relation)
 
             if not connector_ids:
-                subdomains.append(graph)
+                parts.append([graph])
                 continue
 
             for parent_id, treenode_id in graph.edges_iter():
@@ -82,32 +158,50 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 loc1 = locations[parent_id]
                 graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
 
-            # Invoke Casey's magic
-            synapse_group = tree_max_density(graph.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
-            # The list of nodes of each synapse_group contains only nodes that have connectors
-            # A local_max is the skeleton node most central to a synapse_group
-            anchors = {}
-            for domain in synapse_group.itervalues():
-                g = nx.DiGraph()
-                g.add_nodes_from(domain.node_ids) # bogus graph, containing treenodes that point to connectors
+            # Tasks are run in other processes, pass only arrays
+            parent_ids, child_ids, weights = [], [], []
+            for parent_id, treenode_id, d in graph.edges_iter(data=True):
+                parent_ids.append(parent_id)
+                child_ids.append(treenode_id)
+                weights.append(d['weight'])
+            tasks.append((np.array(graph.nodes(), dtype=np.int64),
+                          np.array(parent_ids, dtype=np.int64),
+                          np.array(child_ids, dtype=np.int64),
+                          np.array(weights, dtype=np.float64),
+                          treenode_ids, connector_ids, relation_ids, bandwidth))
+            subdomains = []
+            parts.append(subdomains)
+            pending.append((skeleton_id, subdomains, graph))
+
+    # Invoke Casey's magic, in parallel if a process pool is configured
+    for (skeleton_id, subdomains, graph), synapse_group in izip(pending, imap_tasks(_synapse_domains, tasks)):
+        # The list of nodes of each synapse_group contains only nodes that have connectors
+        # A local_max is the skeleton node most central to a synapse_group
+        anchors = {}
+        for node_ids, local_max in synapse_group:
+            g = nx.DiGraph()
+            g.add_nodes_from(node_ids) # bogus graph, containing treenodes that point to connectors
+            subdomains.append(g)
+            anchors[local_max] = g
+        # Define edges between domains: create a simplified graph
+        mini = simplify(graph, anchors.keys())
+        # Replace each node by the corresponding graph, or a graph of a single node
+        for node in mini.nodes_iter():
+            g = anchors.get(node)
+            if not g:
+                # A branch node that was not an anchor, i.e. did not represent a synapse group
+                g = nx.Graph()
+                g.add_node(node, {'branch': True})
                 subdomains.append(g)
-                anchors[domain.local_max] = g
-            # Define edges between domains: create a simplified graph
-            mini = simplify(graph, anchors.keys())
-            # Replace each node by the corresponding graph, or a graph of a single node
-            for node in mini.nodes_iter():
-                g = anchors.get(node)
-                if not g:
-                    # A branch node that was not an anchor, i.e. did not represent a synapse group
-                    g = nx.Graph()
-                    g.add_node(node, {'branch': True})
-                    subdomains.append(g)
-                # Associate the Graph with treenodes that have connectors
-                # with the node in the minified tree
-                mini.node[node]['g'] = g
-            # Put the mini into a map of skeleton_id and list of minis,
-            # to be used later for defining intra-neuron edges in the circuit graph
-            minis[skeleton_id].append(mini)
+            # Associate the Graph with treenodes that have connectors
+            # with the node in the minified tree
+            mini.node[node]['g'] = g
+        # Put the mini into a map of skeleton_id and list of minis,
+        # to be used later for defining intra-neuron edges in the circuit graph
+        minis[skeleton_id].append(mini)
+
+    for skeleton_id, parts in arbors2.iteritems():
+        arbors2[skeleton_id] = list(chain.from_iterable(parts))
 
     return arbors2, minis
 
@@ -125,18 +219,12 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
     WHERE skeleton_id IN (%s)
     ''' % skeletons_string)
     rows = tuple(cursor.fetchall())
-    # Each skeleton is represented with a DiGraph
-    arbors = defaultdict(nx.DiGraph)
 
     # Get reviewers for the requested skeletons
     reviews = get_treenodes_to_reviews(skeleton_ids=skeleton_ids)
 
-    # Create a DiGraph for every skeleton
-    for row in rows:
-        arbors[row[3]].add_node(row[0], {'reviewer_ids': reviews.get(row[0], [])})
-
     # Dictionary of skeleton IDs vs list of DiGraph instances
-    arbors = split_by_confidence_and_add_edges(confidence_threshold, arbors, rows)
+    arbors, fragments = split_by_confidence_and_add_edges(confidence_threshold, rows, reviews)
 
     # Fetch all synapses
     relations = get_relation_to_id_map(project_id, cursor=cursor)
@@ -167,6 +255,12 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
         arbors_to_expand = {skid: ls for skid, ls in arbors.iteritems() if skid in expand}
         expanded_arbors, minis = split_by_synapse_domain(bandwidth, locations, arbors_to_expand, treenode_connector, minis)
         arbors.update(expanded_arbors)
+        # Treenodes of expanded skeletons are only part of their synapse domains
+        for skid, graphs in arbors_to_expand.iteritems():
+            for g in graphs:
+                fragments.fragments[np.searchsorted(fragments.node_ids, g.nodes())] = -1
+        for graphs in expanded_arbors.itervalues():
+            fragments.assign(graphs)
 
 
     # Obtain neuron names
@@ -203,24 +297,27 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
             i += 1
 
     # Define edges between arbors, with number of synapses as an edge property
+    arbor_of = fragments.lookup(chain.from_iterable(
+            (treenode_id for treenode_id, skeleton_id in links)
+            for c in connectors.itervalues() for links in c.itervalues()))
     for c in connectors.itervalues():
         for pre_treenode, pre_skeleton in c[relations['presynaptic_to']]:
-            for pre_arbor in arbors.get(pre_skeleton, ()):
-                if pre_treenode in pre_arbor:
-                    # Found the DiGraph representing an arbor derived from the skeleton to which the presynaptic treenode belongs.
-                    for post_treenode, post_skeleton in c[relations['postsynaptic_to']]:
-                        for post_arbor in arbors.get(post_skeleton, ()):
-                            if post_treenode in post_arbor:
-                                # Found the DiGraph representing an arbor derived from the skeleton to which the postsynaptic treenode belongs.
-                                edge_props = circuit.get_edge_data(pre_arbor, post_arbor)
-                                if edge_props:
-                                    edge_props['c'] += 1
-                                    edge_props['pre_treenodes'].append(pre_treenode)
-                                    edge_props['post_treenodes'].append(post_treenode)
-                                else:
-                                    circuit.add_edge(pre_arbor, post_arbor, {'c': 1, 'pre_treenodes': [pre_treenode], 'post_treenodes': [post_treenode], 'arrow': 'triangle', 'directed': True})
-                                break
-                    break
+            # The DiGraph representing an arbor derived from the skeleton to which the presynaptic treenode belongs.
+            pre_arbor = arbor_of.get(pre_treenode)
+            if pre_arbor is None:
+                continue
+            for post_treenode, post_skeleton in c[relations['postsynaptic_to']]:
+                # The DiGraph representing an arbor derived from the skeleton to which the postsynaptic treenode belongs.
+                post_arbor = arbor_of.get(post_treenode)
+                if post_arbor is None:
+                    continue
+                edge_props = circuit.get_edge_data(pre_arbor, post_arbor)
+                if edge_props:
+                    edge_props['c'] += 1
+                    edge_props['pre_treenodes'].append(pre_treenode)
+                    edge_props['post_treenodes'].append(post_treenode)
+                else:
+                    circuit.add_edge(pre_arbor, post_arbor, {'c': 1, 'pre_treenodes': [pre_treenode], 'post_treenodes': [post_treenode], 'arrow': 'triangle', 'directed': True})
 
     if compute_risk and bandwidth <= 0:
         # Compute synapse risk:
@@ -231,23 +328,12 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
             post = synapses[relations['postsynaptic_to']]
             for arbor in arbors:
                 # The subset of synapses that belong to the fraction of the original arbor
-                pre_sub = tuple(treenodeID for treenodeID in pre if treenodeID in arbor)
-                post_sub = tuple(treenodeID for treenodeID in post if treenodeID in arbor)
-
-                totalInputs = len(pre_sub)
-                totalOutputs = len(post_sub)
-                tc = {treenodeID: Counts() for treenodeID in arbor}
+                a = Arbor.from_digraph(arbor)
+                outputs = np.bincount(a.indices([t for t in pre if t in arbor]), minlength=len(a))
+                inputs = np.bincount(a.indices([t for t in post if t in arbor]), minlength=len(a))
 
-                for treenodeID in pre_sub:
-                    tc[treenodeID].outputs += 1
-
-                for treenodeID in post_sub:
-                    tc[treenodeID].inputs += 1
-
-                # Update the nPossibleIOPaths field in the Counts instance of each treenode
-                _node_centrality_by_synapse(arbor, tc, totalOutputs, totalInputs)
-
-                arbor.treenode_synapse_counts = tc
+                flow, centrality = _synapse_centrality(a, inputs, outputs)
+                arbor.synapse_centrality = dict(zip(a.node_ids.tolist(), centrality.tolist()))
 
         if not locations:
             locations = {row[0]: (row[4], row[5], row[6]) for row in rows}
@@ -264,15 +350,12 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
 
             try:
                 spanning = spanning_tree(post_arbor, edge_props['post_treenodes'])
-                #for arbor in whole_arbors[circuit[post_arbor]['skeleton_id']]:
-                #    if post_arbor == arbor:
-                #        tc = arbor.treenode_synapse_counts
-                tc = post_arbor.treenode_synapse_counts
+                centrality = post_arbor.synapse_centrality
                 count = spanning.number_of_nodes()
                 if count < 3:
-                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes_iter()) / count
+                    median_synapse_centrality = sum(centrality[treenodeID] for treenodeID in spanning.nodes_iter()) / count
                 else:
-                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes_iter())[count / 2]
+                    median_synapse_centrality = sorted(centrality[treenodeID] for treenodeID in spanning.nodes_iter())[count / 2]
                 cable = cable_length(spanning, locations)
                 if -1 == median_synapse_centrality:
                     # Signal not computable
@@ -337,87 +420,174 @@ def skeleton_graph(request, project_id=None):
 
     return HttpResponse(json.dumps(package))
 
-class Counts():
-    def __init__(self):
-        self.inputs = 0
-        self.outputs = 0
-        self.seenInputs = 0
-        self.seenOutputs = 0
-        self.nPossibleIOPaths = 0
-        self.synapse_centrality = 0
-
-def _node_centrality_by_synapse_db(skeleton_id):
-    """ Compute the synapse centrality of every node in a tree.
-    Return the dictionary of node ID keys and Count values.
-    This function is meant for TESTING. """
-    cursor = connection.cursor()
-    cursor.execute('''
-    SELECT t.id, t.parent_id, r.relation_name
-    FROM treenode t LEFT OUTER JOIN (treenode_connector tc INNER JOIN relation r ON tc.relation_id = r.id) ON t.skeleton_id = tc.skeleton_id
-    WHERE t.skeleton_id = %s
-    ''' % skeleton_id)
-
-    nodes = {} # node ID vs Counts
-    tree = nx.DiGraph()
-    root = None
-    totalInputs = 0
-    totalOutputs = 0
-
-    for row in cursor.fetchall():
-        counts = nodes.get(row[0])
-        if not counts:
-            counts = Counts()
-            nodes[row[0]] = counts
-        if row[2]:
-            if 'presynaptic_to' == row[2]:
-                counts.outputs += 1
-                totalOutputs += 1
-            elif 'postsynaptic_to' == row[2]:
-                counts.inputs += 1
-                totalInputs += 1
-        if row[1]:
-            tree.add_edge(row[0], row[1])
-        else:
-            root = row[0]
-
-    _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs)
-
-    return nodes
-
-def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
-    """ tree: a DiGraph
-        nodes: a dictionary of treenode ID vs Counts instance
-        totalOutputs: the total number of output synapses of the tree
-        totalInputs: the total number of input synapses of the tree
-        Returns nothing, the results are an update to the Counts instance of each treenode entry in nodes, namely the nPossibleIOPaths. """
-    # 1. Ensure the root is an end by checking that it has only one child; otherwise reroot at the first end node found
+def _synapse_centrality(arbor, inputs, outputs):
+    """ arbor: an Arbor
+        inputs: array with the number of input (postsynaptic) synapses of each node of the arbor
+        outputs: array with the number of output (presynaptic) synapses of each node of the arbor
+        Returns two arrays, with values for each node of the arbor: the flow centrality,
+        i.e. the number of paths between an input and an output synapse that pass
+        through the node (nPossibleIOPaths), and the synapse centrality, which is the
+        flow centrality divided by the number of outputs, or -1 if there are no outputs. """
+    inputs = np.asarray(inputs, dtype=np.float64)
+    outputs = np.asarray(outputs, dtype=np.float64)
+    totalInputs = inputs.sum()
+    totalOutputs = outputs.sum()
 
     if 0 == totalOutputs:
         # Not computable
-        for counts in nodes.itervalues():
-            counts.synapse_centrality = -1
-        return
-
-    if len(tree.successors(find_root(tree))) > 1:
-        # Reroot at the first end node found
-        tree = tree.copy()
-        endNode = (nodeID for nodeID in nodes.iterkeys() if not tree.successors(nodeID)).next()
-        reroot(tree, endNode)
-
-    # 2. Partition into sequences, sorted from small to large
-    sequences = sorted(partition(tree), key=len)
-
-    # 3. Traverse all partitions counting synapses seen
-    for seq in sequences:
-        # Each seq runs from an end node towards the root or a branch node
-        seenI = 0
-        seenO = 0
-        for nodeID in seq:
-            counts = nodes[nodeID]
-            seenI += counts.inputs + counts.seenInputs
-            seenO += counts.outputs + counts.seenOutputs
-            counts.seenInputs = seenI
-            counts.seenOutputs = seenO
-            counts.nPossibleIOPaths = counts.seenInputs * (totalOutputs - counts.seenOutputs) + counts.seenOutputs * (totalInputs - counts.seenInputs)
-            counts.synapse_centrality = counts.nPossibleIOPaths / float(totalOutputs)
+        return np.zeros(len(arbor)), np.full(len(arbor), -1.0)
+
+    # Ensure the root is an end by checking that it has only one child; otherwise reroot at the first end node found
+    n_children = arbor.child_counts()
+    root = arbor.find_root()
+    if n_children[arbor.index(root)] > 1:
+        arbor = arbor.copy()
+        arbor.reroot(int(arbor.node_ids[np.flatnonzero(0 == n_children)[0]]))
+
+    # Synapses seen downstream of each node, the node itself included
+    seenInputs = arbor.subtree_sums(inputs)
+    seenOutputs = arbor.subtree_sums(outputs)
+
+    flow = seenInputs * (totalOutputs - seenOutputs) + seenOutputs * (totalInputs - seenInputs)
+    return flow, flow / totalOutputs
+
+
+def _synapse_centrality_cache():
+    """ Return the cache configured in SYNAPSE_CENTRALITY_CACHE or None if
+    results aren't persisted. """
+    name = getattr(settings, 'SYNAPSE_CENTRALITY_CACHE', None)
+    return caches[name] if name else None
+
+
+def _synapse_centralities(project_id, skeleton_ids):
+    """ Compute flow and synapse centrality of every node of all passed in
+    skeletons. Returns a dictionary of skeleton ID vs a tuple of three lists:
+    node IDs, flow centrality and synapse centrality. If a cache is configured,
+    results are kept until the skeleton or its synapses are edited. """
+    skeleton_ids = set(ClassInstance.objects.filter(project_id=project_id,
+            id__in=skeleton_ids).values_list('id', flat=True))
+    if not skeleton_ids:
+        return {}
 
+    cursor = connection.cursor()
+    relations = get_relation_to_id_map(project_id, ('presynaptic_to', 'postsynaptic_to'), cursor)
+
+    # Number of input and output synapses of every node that has any
+    cursor.execute('''
+    SELECT skeleton_id, treenode_id,
+           count(*) FILTER (WHERE relation_id = %(pre)s),
+           count(*) FILTER (WHERE relation_id = %(post)s)
+    FROM treenode_connector
+    WHERE skeleton_id = ANY(%(skids)s::integer[])
+      AND relation_id IN (%(pre)s, %(post)s)
+    GROUP BY skeleton_id, treenode_id
+    ORDER BY skeleton_id, treenode_id
+    ''', {
+        'skids': list(skeleton_ids),
+        'pre': relations['presynaptic_to'],
+        'post': relations['postsynaptic_to'],
+    })
+    synapse_counts = defaultdict(list)
+    for skid, treenode_id, n_outputs, n_inputs in cursor.fetchall():
+        synapse_counts[skid].append((treenode_id, n_outputs, n_inputs))
+
+    cache = _synapse_centrality_cache()
+    keys = {}
+    results = {}
+    if cache:
+        # Cached results are valid as long as neither the skeleton (as seen by
+        # its summary entry) nor its synapses change.
+        cursor.execute('''
+        SELECT skeleton_id, num_nodes, last_edition_time
+        FROM catmaid_skeleton_summary
+        WHERE skeleton_id = ANY(%s::integer[])
+        ''', (list(skeleton_ids),))
+        for skid, num_nodes, last_edition_time in cursor.fetchall():
+            if last_edition_time is None:
+                # Without an edit time, edits can't be detected reliably
+                continue
+            version = sha1(repr((num_nodes, last_edition_time.isoformat(),
+                    synapse_counts.get(skid)))).hexdigest()
+            keys[skid] = 'catmaid-synapse-centrality:%d:%s' % (skid, version)
+        cached = cache.get_many(keys.values())
+        for skid, key in keys.iteritems():
+            if key in cached:
+                results[skid] = cached[key]
+
+    computed = {}
+    with closing(lazy_load_arbors(skeleton_ids.difference(results))) as arbors:
+        for skid, arbor in arbors:
+            inputs = np.zeros(len(arbor))
+            outputs = np.zeros(len(arbor))
+            counts = synapse_counts.get(skid)
+            if counts:
+                treenode_ids, n_outputs, n_inputs = zip(*counts)
+                indices = arbor.indices(treenode_ids)
+                outputs[indices] = n_outputs
+                inputs[indices] = n_inputs
+            flow, centrality = _synapse_centrality(arbor, inputs, outputs)
+            computed[skid] = (arbor.node_ids.tolist(), flow.tolist(), centrality.tolist())
+
+    if cache:
+        cache.set_many({keys[skid]: result for skid, result in computed.iteritems() if skid in keys},
+                settings.SYNAPSE_CENTRALITY_CACHE_TIMEOUT)
+
+    results.update(computed)
+    return results
+
+
+@api_view(['POST'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def synapse_centrality(request, project_id=None):
+    """Compute the flow and synapse centrality of all nodes of a set of skeletons.
+
+    The flow centrality of a node is the number of paths between an input and an
+    output synapse of its skeleton that pass through it. The synapse centrality
+    is the flow centrality divided by the number of outputs, or -1 if the
+    skeleton has no outputs.
+    ---
+    parameters:
+        - name: skeleton_ids[]
+          description: IDs of the skeletons to compute centralities for
+          required: true
+          type: array
+          items:
+            type: integer
+          paramType: form
+    models:
+      synapse_centrality_skeleton:
+        id: synapse_centrality_skeleton
+        properties:
+          node_ids:
+            description: IDs of all nodes of the skeleton
+            type: array
+            items:
+              type: integer
+            required: true
+          flow_centrality:
+            description: Flow centrality of each node in node_ids
+            type: array
+            items:
+              type: number
+            required: true
+          synapse_centrality:
+            description: Synapse centrality of each node in node_ids
+            type: array
+            items:
+              type: number
+            required: true
+    type:
+      '{skeleton_id}':
+        $ref: synapse_centrality_skeleton
+        required: true
+    """
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+
+    results = _synapse_centralities(int(project_id), skeleton_ids)
+    return HttpResponse(json.dumps({skid: {
+        'node_ids': node_ids,
+        'flow_centrality': flow,
+        'synapse_centrality': centrality
+    } for skid, (node_ids, flow, centrality) in results.iteritems()}))
@@ -1,12 +1,12 @@
 import json
 import networkx as nx
 from networkx.algorithms import weakly_connected_component_subgraphs
+import numpy as np
 from collections import defaultdict
-from itertools import izip, count
+from itertools import chain, count, groupby, izip
 from functools import partial
+from operator import itemgetter
 from synapseclustering import tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
 
 from django.db import connection
 from django.http import HttpResponse
@@ -16,36 +16,31 @@ from rest_framework.decorators import api_view
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
-from catmaid.control.tree_util import simplify
+from catmaid.control.process_pool import imap_tasks
+from catmaid.control.tree_util import Arbor, simplify
 
 def basic_graph(project_id, skeleton_ids):
-    def newSynapseCounts():
-        return [0, 0, 0, 0, 0]
-
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
     cursor = connection.cursor()
 
-    relations = get_relation_to_id_map(project_id, ('presynaptic_to', 'postsynaptic_to'), cursor)
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
+    relations = get_relation_to_id_map(project_id, ('presynaptic_to',), cursor)
+    preID = relations['presynaptic_to']
 
+    # Synapse counts per confidence are precomputed in skeleton_adjacency
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%(skids)s)
-      AND t1.relation_id = %(pre)s
-      AND t1.connector_id = t2.connector_id
-      AND t2.skeleton_id IN (%(skids)s)
-      AND t2.relation_id = %(post)s
-    ''' % {'skids': ','.join(map(str, skeleton_ids)),
-           'pre': preID,
-           'post': postID})
-
-    edges = defaultdict(partial(defaultdict, newSynapseCounts))
+    SELECT pre_skeleton_id, post_skeleton_id, confidence_histogram
+    FROM skeleton_adjacency
+    WHERE pre_skeleton_id = ANY(%(skids)s::integer[])
+      AND post_skeleton_id = ANY(%(skids)s::integer[])
+      AND relation_id = %(pre)s
+    ''', {'skids': map(int, skeleton_ids),
+          'pre': preID})
+
+    edges = defaultdict(dict)
     for row in cursor.fetchall():
-        edges[row[0]][row[1]][row[2] - 1] += 1
+        edges[row[0]][row[1]] = row[2]
 
     return {'edges': tuple((pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems())}
 
@@ -114,27 +109,11 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
     # All nodes of the graph
     nodeIDs = []
 
-    # Read out into memory only one skeleton at a time
-    current_skid = None
-    tree = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+    # Split all skeletons, in parallel if a process pool is configured
+    tasks = _skeleton_tasks(cursor.fetchall(), stc, confidence_threshold)
+    for nodes, _, links, _ in imap_tasks(_split_skeleton, tasks):
+        nodeIDs.extend(nodes)
+        _add_links(connectors, links)
 
     # Create the edges of the graph from the connectors, which was populated as a side effect of 'split_by_confidence'
     edges = defaultdict(partial(defaultdict, newSynapseCounts)) # pre vs post vs count
@@ -198,28 +177,9 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
         ORDER BY skeleton_id
         ''' % (project_id, ",".join(str(int(skid)) for skid in not_to_expand)))
 
-        # Read out into memory only one skeleton at a time
-        current_skid = None
-        tree = None
-        for row in cursor.fetchall():
-            if row[0] == current_skid:
-                # Build the tree, breaking it at the low-confidence edges
-                if row[2] and row[3] >= confidence_threshold:
-                        tree.add_edge(row[2], row[1])
-                continue
-
-            if tree:
-                nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-            # Start the next tree
-            current_skid = row[0]
-            tree = nx.DiGraph()
-            if row[2] and row[3] > confidence_threshold:
-                tree.add_edge(row[2], row[1])
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+        tasks = _skeleton_tasks(cursor.fetchall(), stc, confidence_threshold)
     else:
+        tasks = []
         # No need to split.
         # Populate connectors from the connections among them
         for skid in not_to_expand:
@@ -243,36 +203,15 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
     # list of branch nodes, merely structural
     branch_nodeIDs = []
 
-    # reset
-    current_skid = None
-    tree = None
-    locations = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            locations[row[1]] = row[4:]
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-        nodeIDs.extend(ns)
-        branch_nodeIDs.extend(bs)
+    tasks = chain(tasks, _skeleton_tasks(cursor.fetchall(), stc,
+            confidence_threshold, bandwidth))
 
+    # Split all skeletons, in parallel if a process pool is configured
+    for nodes, branch_nodes, links, domain_edges in imap_tasks(_split_skeleton, tasks):
+        nodeIDs.extend(nodes)
+        branch_nodeIDs.extend(branch_nodes)
+        intraedges.extend(domain_edges)
+        _add_links(connectors, links)
 
     # Create the edges of the graph
     edges = defaultdict(partial(defaultdict, newSynapseCounts)) # pre vs post vs count
@@ -287,6 +226,62 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
             'intraedges': intraedges}
 
 
+def _skeleton_tasks(rows, stc, confidence_threshold, bandwidth=None):
+    """ Create a compact task for _split_skeleton from the treenode rows of each
+    skeleton. Rows are (skeleton_id, id, parent_id, confidence) tuples, sorted
+    by skeleton, and include the location if a bandwidth is given. """
+    for skid, skeleton_rows in groupby(rows, itemgetter(0)):
+        skeleton_rows = list(skeleton_rows)
+        node_ids = np.array([row[1] for row in skeleton_rows], dtype=np.int64)
+        parent_ids = np.array([row[2] or -1 for row in skeleton_rows], dtype=np.int64)
+        confidences = np.array([row[3] for row in skeleton_rows], dtype=np.int8)
+        if bandwidth:
+            locations = np.array([row[4:7] for row in skeleton_rows], dtype=np.float64)
+        else:
+            locations = None
+        yield (skid, node_ids, parent_ids, confidences, locations, stc[skid],
+               confidence_threshold, bandwidth)
+
+
+def _split_skeleton(task):
+    """ Split a skeleton at edges below the confidence threshold and, if a
+    bandwidth is given, by synapse domain. Runs in worker processes if a
+    process pool is configured, which is why the task is a tuple of arrays
+    created by _skeleton_tasks and the result is a tuple of plain lists:
+    graph node IDs, branch node IDs, (connector_id, relation_id, (graph node ID,
+    confidence)) tuples to add to connectors and intraedges. """
+    skid, node_ids, parent_ids, confidences, locations, cs, \
+            confidence_threshold, bandwidth = task
+
+    # Build the tree, breaking it at the low-confidence edges
+    tree = nx.DiGraph()
+    keep = (parent_ids != -1) & (confidences >= confidence_threshold)
+    tree.add_edges_from(izip(parent_ids[keep].tolist(), node_ids[keep].tolist()))
+    if 0 == len(tree):
+        return [], [], [], []
+
+    connectors = defaultdict(partial(defaultdict, list))
+    intraedges = []
+    if locations is None:
+        nodes = split_by_confidence(skid, tree, cs, connectors)
+        branch_nodes = []
+    else:
+        locations = dict(izip(node_ids.tolist(), locations.tolist()))
+        nodes, branch_nodes = split_by_both(skid, tree, locations, bandwidth,
+                cs, connectors, intraedges)
+
+    links = [(connector_id, relation_id, link)
+             for connector_id, relations in connectors.iteritems()
+             for relation_id, entries in relations.iteritems()
+             for link in entries]
+    return list(nodes), branch_nodes, links, intraedges
+
+
+def _add_links(connectors, links):
+    for connector_id, relation_id, link in links:
+        connectors[connector_id][relation_id].append(link)
+
+
 def populate_connectors(chunkIDs, chunks, cs, connectors):
     # Build up edges via the connectors
     IDchunks = zip(chunkIDs, chunks)
@@ -322,10 +317,6 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
     chunks, chunkIDs = subgraphs(digraph, skeleton_id)
 
     for i, chunkID, chunk in izip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
         blob = tuple(c for c in cs if c[0] in chunk)
         if 0 == len(blob):
@@ -339,7 +330,8 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
             continue
 
         # Invoke Casey's magic: split by synapse domain
-        domains = tree_max_density(chunk.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
+        arbor = Arbor.from_digraph(chunk, locations)
+        domains = tree_max_density(arbor, treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
 
         # domains is a dictionary of index vs SynapseGroup instance
 
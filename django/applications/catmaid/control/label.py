@@ -12,6 +12,7 @@ from catmaid.models import Project, Class, ClassInstance, Relation, Connector, \
         ConnectorClassInstance, UserRole, Treenode, TreenodeClassInstance, \
         ChangeRequest
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control import node_list_cache
 from catmaid.fields import Double3D
 
 
@@ -268,6 +269,9 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
                 }
                 ChangeRequest(**change_request_params).save()
 
+    if new_labels or deleted_labels:
+        node_list_cache.invalidate_nodes(project_id, [location_id])
+
     response = {
         'message': 'success',
         'new_labels': new_labels,
@@ -350,6 +354,7 @@ def remove_label_link(request, project_id, ntype, location_id):
                          (location_id, label))
 
     if remove_label(link_id, ntype):
+        node_list_cache.invalidate_nodes(project_id, [location_id])
         return JsonResponse({
             'deleted_link': link_id,
             'message': 'success'
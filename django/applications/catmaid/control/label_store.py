@@ -0,0 +1,270 @@
+import atexit
+import logging
+import os
+
+from collections import OrderedDict
+from contextlib import closing
+from threading import Condition, Lock, Thread
+from time import time
+
+import numpy as np
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h5py
+except ImportError, e:
+    logger.warning("CATMAID was unable to load the h5py library. "
+          "HDF5 label storage is therefore disabled.")
+
+
+# Labels painted into a stack are stored in the 3D datasets
+# /labels/scale/<scale>/data of the HDF5 file of the stack, with axes y, x and
+# z. Painted strokes aren't written right away, but queued per file and
+# written by a single writer thread per process, at the latest every
+# LABEL_WRITE_INTERVAL seconds or once more than LABEL_WRITE_BUFFER_SIZE bytes
+# are queued. Strokes are coalesced into one write per touched dataset chunk.
+# Strokes of slices that can't be written stay queued and are written with the
+# next batch, unless their dataset doesn't exist. Queued strokes are only known
+# to the process they were queued in and are lost if it is killed before they
+# are written.
+_stores = {}
+_stores_lock = Lock()
+_writer = None
+_writer_pid = None
+_writer_condition = Condition(_stores_lock)
+
+
+def get_label_path(project_id, stack_id):
+    return os.path.join(settings.HDF5_STORAGE_PATH,
+            '{0}_{1}.hdf'.format(project_id, stack_id))
+
+
+def get_dataset_path(scale):
+    return '/labels/scale/' + str(int(scale)) + '/data'
+
+
+class LabelStore(object):
+    """ Queued strokes of a single HDF5 label file. Access to the file is
+    serialized by a lock, which readers hold while they read the file and
+    take the strokes to overlay. This way, queued strokes and file contents
+    are always consistent within a process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file_lock = Lock()
+        self.pending_lock = Lock()
+        # Keys are (scale, z) tuples, values lists of (y, x, data) tuples
+        self.pending = OrderedDict()
+        self.pending_size = 0
+        self.oldest = None
+
+    def put(self, scale, z, y, x, data):
+        with self.pending_lock:
+            self.pending.setdefault((scale, z), []).append((y, x, data))
+            self.pending_size += data.nbytes
+            if self.oldest is None:
+                self.oldest = time()
+            return self.pending_size
+
+    def is_due(self, now):
+        with self.pending_lock:
+            return self.oldest is not None and \
+                (now - self.oldest >= settings.LABEL_WRITE_INTERVAL or
+                 self.pending_size > settings.LABEL_WRITE_BUFFER_SIZE)
+
+    def flush(self):
+        """ Write all queued strokes to the file. Failures are logged per
+        slice and strokes that couldn't be written are queued again, in front
+        of strokes queued in the meantime. Strokes of scale levels without a
+        dataset can't be written at all and are dropped.
+        """
+        with self.file_lock:
+            with self.pending_lock:
+                pending = self.pending
+                self.pending = OrderedDict()
+                self.pending_size = 0
+                self.oldest = None
+            if not pending:
+                return
+            written, dropped = set(), set()
+            try:
+                with closing(h5py.File(self.path, 'a')) as hfile:
+                    for (scale, z), strokes in pending.iteritems():
+                        dataset_path = get_dataset_path(scale)
+                        if dataset_path not in hfile:
+                            logger.error("Dropped %s label strokes of slice %s: "
+                                    "%s has no dataset %s" % (len(strokes), z,
+                                    self.path, dataset_path))
+                            dropped.add((scale, z))
+                            continue
+                        try:
+                            write_strokes(hfile[dataset_path], z, strokes)
+                            written.add((scale, z))
+                        except Exception:
+                            logger.exception("Couldn't write labels of slice "
+                                    "%s to %s in %s" % (z, dataset_path,
+                                    self.path))
+            except Exception:
+                # If the file can't be opened or closed, none of the writes
+                # may have made it into the file.
+                logger.exception("Couldn't write labels to %s" % self.path)
+                written = set()
+            failed = OrderedDict((k, v) for k, v in pending.iteritems()
+                    if k not in written and k not in dropped)
+            if failed:
+                self._requeue(failed)
+
+    def _requeue(self, failed):
+        """ Queue strokes again, in front of the currently queued ones. """
+        with self.pending_lock:
+            for key, strokes in self.pending.iteritems():
+                failed.setdefault(key, []).extend(strokes)
+            self.pending = failed
+            self.pending_size = sum(stroke[2].nbytes
+                    for strokes in failed.itervalues() for stroke in strokes)
+            # Retry after LABEL_WRITE_INTERVAL at the earliest
+            self.oldest = time()
+
+    def get_queued(self, scale, z):
+        """ Return the queued strokes of a slice, oldest first. """
+        with self.pending_lock:
+            return list(self.pending.get((scale, z), ()))
+
+    def read(self, scale, z, y, x, height, width):
+        """ Return a region of a label slice as NumPy array of the requested
+        size, including queued strokes, or None if the file has no dataset for
+        this scale level. Parts outside of the dataset are zero.
+        """
+        with self.file_lock:
+            if not os.path.exists(self.path):
+                return None
+            with closing(h5py.File(self.path, 'r')) as hfile:
+                dataset_path = get_dataset_path(scale)
+                if dataset_path not in hfile:
+                    return None
+                dataset = hfile[dataset_path]
+                region = np.zeros((height, width), dtype=dataset.dtype)
+                y0, x0 = max(y, 0), max(x, 0)
+                y1 = min(y + height, dataset.shape[0])
+                x1 = min(x + width, dataset.shape[1])
+                if y1 > y0 and x1 > x0 and 0 <= z < dataset.shape[2]:
+                    region[y0 - y:y1 - y, x0 - x:x1 - x] = \
+                            dataset[y0:y1, x0:x1, z]
+            with self.pending_lock:
+                strokes = list(self.pending.get((scale, z), ()))
+        for stroke in strokes:
+            apply_stroke(region, y, x, stroke)
+        return region
+
+
+def apply_stroke(region, y, x, stroke):
+    """ Copy the part of a (y, x, data) stroke that intersects with a region
+    at position (y, x) into the region. """
+    stroke_y, stroke_x, data = stroke
+    y0, x0 = max(y, stroke_y), max(x, stroke_x)
+    y1 = min(y + region.shape[0], stroke_y + data.shape[0])
+    x1 = min(x + region.shape[1], stroke_x + data.shape[1])
+    if y1 > y0 and x1 > x0:
+        region[y0 - y:y1 - y, x0 - x:x1 - x] = \
+                data[y0 - stroke_y:y1 - stroke_y, x0 - stroke_x:x1 - stroke_x]
+
+
+def write_strokes(dataset, z, strokes):
+    """ Write a list of (y, x, data) strokes, in order, to a slice of a 3D
+    dataset. Each chunk touched by strokes is read and written once. Datasets
+    without chunks are written in a single block covering all strokes. """
+    y0 = max(min(s[0] for s in strokes), 0)
+    x0 = max(min(s[1] for s in strokes), 0)
+    y1 = min(max(s[0] + s[2].shape[0] for s in strokes), dataset.shape[0])
+    x1 = min(max(s[1] + s[2].shape[1] for s in strokes), dataset.shape[1])
+    if y1 <= y0 or x1 <= x0:
+        return
+
+    if dataset.chunks:
+        chunk_height, chunk_width = dataset.chunks[:2]
+    else:
+        chunk_height, chunk_width = y1 - y0, x1 - x0
+
+    for cy in xrange(y0 - y0 % chunk_height, y1, chunk_height):
+        for cx in xrange(x0 - x0 % chunk_width, x1, chunk_width):
+            by0, by1 = max(cy, y0), min(cy + chunk_height, y1)
+            bx0, bx1 = max(cx, x0), min(cx + chunk_width, x1)
+            touching = [s for s in strokes
+                    if s[0] < by1 and s[0] + s[2].shape[0] > by0 and
+                       s[1] < bx1 and s[1] + s[2].shape[1] > bx0]
+            if not touching:
+                continue
+            block = dataset[by0:by1, bx0:bx1, z]
+            for stroke in touching:
+                apply_stroke(block, by0, bx0, stroke)
+            dataset[by0:by1, bx0:bx1, z] = block
+
+
+def get_store(project_id, stack_id):
+    path = get_label_path(project_id, stack_id)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = LabelStore(path)
+            _stores[path] = store
+        return store
+
+
+def _write_due_stores():
+    while True:
+        with _writer_condition:
+            _writer_condition.wait(settings.LABEL_WRITE_INTERVAL)
+            stores = _stores.values()
+        now = time()
+        for store in stores:
+            if store.is_due(now):
+                try:
+                    store.flush()
+                except Exception:
+                    logger.exception("Couldn't write labels to %s" % store.path)
+
+
+def _start_writer():
+    """ Start the writer thread of this process, if not already running. A
+    forked process doesn't inherit the thread and starts its own.
+    """
+    global _writer, _writer_pid
+    with _stores_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = Thread(target=_write_due_stores,
+                    name='catmaid-label-writer')
+            _writer.daemon = True
+            _writer_pid = os.getpid()
+            _writer.start()
+
+
+def flush_all():
+    """ Write all queued strokes of this process. """
+    with _stores_lock:
+        stores = _stores.values()
+    for store in stores:
+        store.flush()
+
+atexit.register(flush_all)
+
+
+def put(project_id, stack_id, scale, z, y, x, data):
+    """ Queue a stroke of labels to be written to slice <z> of a scale level
+    of a stack, at position (y, x). """
+    _start_writer()
+    store = get_store(project_id, stack_id)
+    if store.put(int(scale), z, y, x, data) > settings.LABEL_WRITE_BUFFER_SIZE:
+        # Wake up the writer
+        with _writer_condition:
+            _writer_condition.notify()
+
+
+def read(project_id, stack_id, scale, z, y, x, height, width):
+    """ Return a region of a label slice, including strokes queued in this
+    process, or None if the stack has no labels of this scale level. """
+    return get_store(project_id, stack_id).read(int(scale), z, y, x,
+            height, width)
@@ -8,6 +8,7 @@ from catmaid import state
 from catmaid.models import UserRole, Project, Relation, Treenode, Connector, \
         TreenodeConnector, ClassInstance
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control import node_list_cache
 
 @requires_user_role(UserRole.Annotate)
 def create_link(request, project_id=None):
@@ -93,6 +94,7 @@ def create_link(request, project_id=None):
         connector=to_connector  # connector_id = to_id
     )
     link.save()
+    node_list_cache.invalidate_nodes(project_id, [from_id, to_id], cursor=cursor)
 
     result['message'] = 'success'
     result['link_id'] = link.id
@@ -127,6 +129,8 @@ def delete_link(request, project_id=None):
 
     deleted_link_id = link.id
     link.delete()
+    node_list_cache.invalidate_nodes(project_id, [treenode_id, connector_id],
+            cursor=cursor)
     return HttpResponse(json.dumps({
         'link_id': deleted_link_id,
         'link_type_id': link.relation.id,
@@ -2,7 +2,6 @@ from __future__ import print_function
 
 from django.db import connection
 from collections import defaultdict
-from itertools import chain
 
 def find_empty_neurons():
     """ Returns a set of empty neurons. Also prints the total
@@ -76,11 +75,11 @@ def neuron_treenode_counts(neuron_ids):
     neurons_with_treenodes = set()
     if skeleton_neuron:
         cursor.execute("""
-        SELECT count(*), skeleton_id
-        FROM treenode
-        WHERE skeleton_id IN (%s)
-        GROUP BY skeleton_id
-        """ % ','.join(chain.from_iterable(skeleton_neuron.keys()))) # flatten list of lists
+        SELECT num_nodes, skeleton_id
+        FROM catmaid_skeleton_summary
+        WHERE skeleton_id = ANY(%s::integer[])
+          AND num_nodes > 0
+        """, (skeleton_neuron.keys(),))
         for row in cursor.fetchall():
             # counts of skeleton treenodes vs list of neuron IDs
             neuronID = skeleton_neuron[row[1]]
@@ -0,0 +1,159 @@
+import logging
+import time
+
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+# A cache of stack and project metadata, both of metadata stored in the
+# database and of metadata retrieved from remote services (tile source
+# metadata, the FlyTEM render service and DVID servers). Entries are grouped in
+# namespaces and stored as (loading time, value) tuples. Entries older than
+# METADATA_CACHE_TIMEOUT seconds are still returned, but reloaded in a
+# background thread, so that requests only wait for a load if an entry is
+# missing or older than METADATA_CACHE_MAX_AGE seconds. Entries whose background
+# reload fails, e.g. because a stack has been deleted, are dropped, so that the
+# next request loads them again and sees the error. Namespaces can be
+# invalidated as a whole, which is done by incrementing their generation, which
+# is part of the keys of their entries. Entries are kept in the cache named by
+# METADATA_CACHE, if set, so that all processes share them and see
+# invalidations. Otherwise they are kept in a process-wide dictionary of at most
+# METADATA_CACHE_MAX_ENTRIES entries, from which the least recently used ones
+# are dropped first, and invalidations only affect the current process.
+_entries = OrderedDict()
+_generations = {}
+_refreshing = set()
+_lock = Lock()
+
+
+def _get_shared_cache():
+    if settings.METADATA_CACHE:
+        return caches[settings.METADATA_CACHE]
+    return None
+
+
+def _get_generation(namespace):
+    shared_cache = _get_shared_cache()
+    if shared_cache:
+        return shared_cache.get('catmaid-metadata-generation:' + namespace, 0)
+    return _generations.get(namespace, 0)
+
+
+def _cache_key(namespace, key):
+    return 'catmaid-metadata:%s:%s:%s' % (namespace,
+            _get_generation(namespace), key)
+
+
+def _get_entry(cache_key):
+    shared_cache = _get_shared_cache()
+    if shared_cache:
+        return shared_cache.get(cache_key)
+    with _lock:
+        entry = _entries.pop(cache_key, None)
+        if entry is not None:
+            # Keep the most recently used entries last
+            _entries[cache_key] = entry
+    return entry
+
+
+def _set_entry(cache_key, value):
+    entry = (time.time(), value)
+    shared_cache = _get_shared_cache()
+    if shared_cache:
+        shared_cache.set(cache_key, entry, settings.METADATA_CACHE_MAX_AGE)
+    else:
+        with _lock:
+            _entries.pop(cache_key, None)
+            _entries[cache_key] = entry
+            while len(_entries) > settings.METADATA_CACHE_MAX_ENTRIES:
+                _entries.popitem(last=False)
+
+
+def _delete_entry(cache_key, loading_time):
+    """Remove an entry, unless it has been loaded again in the meantime."""
+    shared_cache = _get_shared_cache()
+    if shared_cache:
+        entry = shared_cache.get(cache_key)
+        if entry is not None and entry[0] == loading_time:
+            shared_cache.delete(cache_key)
+    else:
+        with _lock:
+            entry = _entries.get(cache_key)
+            if entry is not None and entry[0] == loading_time:
+                del _entries[cache_key]
+
+
+def _refresh(cache_key, load, loading_time):
+    try:
+        _set_entry(cache_key, load())
+    except Exception:
+        logger.exception("Couldn't refresh cached metadata %s" % cache_key)
+        _delete_entry(cache_key, loading_time)
+    finally:
+        with _lock:
+            _refreshing.discard(cache_key)
+        # Loaders can use the database, whose connections are per thread
+        connection.close()
+
+
+def get(namespace, key, load):
+    """Return the cached value of <key> in <namespace>. If there is no cached
+    value or it is older than METADATA_CACHE_MAX_AGE seconds, it is loaded by
+    calling <load>. Values older than METADATA_CACHE_TIMEOUT seconds are
+    returned and reloaded in the background. If that fails, the value is
+    removed and loaded again by the next call. Values are shared, they must not
+    be modified.
+    """
+    cache_key = _cache_key(namespace, key)
+    entry = _get_entry(cache_key)
+    now = time.time()
+    if entry is None or now - entry[0] > settings.METADATA_CACHE_MAX_AGE:
+        value = load()
+        _set_entry(cache_key, value)
+        return value
+
+    if now - entry[0] > settings.METADATA_CACHE_TIMEOUT:
+        with _lock:
+            start = cache_key not in _refreshing
+            _refreshing.add(cache_key)
+        if start:
+            refresher = Thread(target=_refresh,
+                    args=(cache_key, load, entry[0]),
+                    name='catmaid-metadata-refresh')
+            refresher.daemon = True
+            refresher.start()
+
+    return entry[1]
+
+
+def _invalidate(namespace):
+    shared_cache = _get_shared_cache()
+    if shared_cache:
+        generation_key = 'catmaid-metadata-generation:' + namespace
+        shared_cache.add(generation_key, 0, None)
+        try:
+            shared_cache.incr(generation_key)
+        except ValueError:
+            # Evicted in the meantime
+            shared_cache.set(generation_key, 1, None)
+    else:
+        with _lock:
+            _generations[namespace] = _generations.get(namespace, 0) + 1
+            prefix = 'catmaid-metadata:%s:' % namespace
+            for cache_key in [k for k in _entries if k.startswith(prefix)]:
+                del _entries[cache_key]
+
+
+def invalidate(namespace):
+    """Remove all cached values of <namespace>. Values loaded before the
+    current transaction is committed could still contain old data, which is why
+    the namespace is invalidated again after the commit.
+    """
+    _invalidate(namespace)
+    transaction.on_commit(lambda: _invalidate(namespace))
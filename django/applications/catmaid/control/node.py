@@ -1,4 +1,7 @@
+import calendar
 import json
+import struct
+import numpy as np
 
 from collections import defaultdict
 
@@ -17,6 +20,14 @@ from catmaid.models import UserRole, Treenode, \
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
 from catmaid.control.common import get_relation_to_id_map, get_request_list
+from catmaid.control import node_list_cache
+
+
+# The content type of binary node list responses. Clients can request this
+# format by listing it in their Accept header.
+NODE_LIST_BINARY_CONTENT_TYPE = 'application/x-catmaid-node-list'
+NODE_LIST_BINARY_MAGIC = b'CMNL'
+NODE_LIST_BINARY_VERSION = 1
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -33,6 +44,11 @@ def node_list_tuples(request, project_id=None, provider=None):
     so care must be taken never to alter the order of the variables in the SQL
     statements without modifying the accesses to said data both in this function
     and in the client that consumes it.
+
+    Alternatively, the same data can be retrieved in a binary columnar format
+    (see _node_list_binary_response()). This happens if the "format" parameter
+    is set to "binary" or if the Accept header of the request asks for
+    NODE_LIST_BINARY_CONTENT_TYPE.
     '''
     project_id = int(project_id) # sanitize
     params = {}
@@ -45,11 +61,57 @@ def node_list_tuples(request, project_id=None, provider=None):
     params['limit'] = settings.NODE_LIST_MAXIMUM_COUNT
     params['project_id'] = project_id
     include_labels = (request.POST.get('labels', None) == 'true')
+    binary = request.POST.get('format', None) == 'binary' or \
+            NODE_LIST_BINARY_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')
 
     provider = get_treenodes_postgis
 
+    if node_list_cache.is_enabled():
+        return node_list_tuples_cached(params, project_id, treenode_ids,
+                connector_ids, include_labels, provider, binary)
+
     return node_list_tuples_query(params, project_id, treenode_ids, connector_ids,
-                                  include_labels, provider)
+                                  include_labels, provider, binary)
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_list_tuples_sections(request, project_id=None):
+    '''Retrieve node lists for a range of consecutive sections at once. The
+    bounding box of the first section is defined like for node_list_tuples()
+    and <n_sections> sections are returned. Each following section is shifted
+    by <section_step> in Z, which defaults to the thickness of the first
+    section (z2 - z1). Explicitly requested treenodes and connectors are
+    included in every section. The result is a JSON array with one node list
+    per section, each with the same format as returned by node_list_tuples().
+    All sections are retrieved with the same set of queries.
+    '''
+    project_id = int(project_id) # sanitize
+    params = {}
+
+    treenode_ids = get_request_list(request.POST, 'treenode_ids', map_fn=int)
+    connector_ids = get_request_list(request.POST, 'connector_ids', map_fn=int)
+    for p in ('top', 'left', 'bottom', 'right', 'z1', 'z2'):
+        params[p] = float(request.POST.get(p, 0))
+    params['limit'] = settings.NODE_LIST_MAXIMUM_COUNT
+    params['project_id'] = project_id
+    include_labels = (request.POST.get('labels', None) == 'true')
+
+    n_sections = int(request.POST.get('n_sections', 1))
+    if n_sections < 1 or n_sections > settings.NODE_LIST_MAXIMUM_SECTIONS:
+        raise ValueError("The number of sections has to be between 1 and %s" %
+                settings.NODE_LIST_MAXIMUM_SECTIONS)
+    section_step = float(request.POST.get('section_step',
+            params['z2'] - params['z1']))
+    sections = [(params['z1'] + i * section_step,
+                 params['z2'] + i * section_step) for i in xrange(n_sections)]
+
+    cursor = connection.cursor()
+    relation_map = get_relation_map(cursor, project_id)
+    results = _node_list_sections(cursor, params, sections, relation_map,
+            treenode_ids, connector_ids, include_labels)
+
+    return HttpResponse(json.dumps(results, cls=DjangoJSONEncoder,
+            separators=(',', ':')), content_type='application/json')
 
 
 def get_treenodes_classic(cursor, params):
@@ -316,14 +378,271 @@ def get_connector_nodes_postgis(cursor, params, treenode_ids, missing_connector_
     return list(cursor.fetchall())
 
 
-def node_list_tuples_query(params, project_id, explicit_treenode_ids, explicit_connector_ids, include_labels, tn_provider):
-    try:
-        cursor = connection.cursor()
+def get_connector_nodes_by_id(cursor, params, treenode_ids, missing_connector_ids):
+    """Selects all connectors in missing_connector_ids along with their links,
+    regardless of their location.
+    """
+    if not missing_connector_ids:
+        return []
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+    cursor.execute('''
+    SELECT
+        c.id,
+        c.location_x,
+        c.location_y,
+        c.location_z,
+        c.confidence,
+        c.edition_time,
+        c.user_id,
+        tc.treenode_id,
+        tc.relation_id,
+        tc.confidence,
+        tc.edition_time,
+        tc.id
+    FROM connector c
+    LEFT JOIN treenode_connector tc
+      ON (tc.connector_id = c.id)
+    WHERE c.project_id = %(project_id)s
+      AND c.id = ANY(%(connector_ids)s::bigint[])
+    ''', {
+        'project_id': params['project_id'],
+        'connector_ids': [int(cid) for cid in missing_connector_ids]
+    })
+
+    return list(cursor.fetchall())
+
+
+def get_no_treenodes(cursor, params):
+    """A treenode provider that doesn't select any treenodes. It is used to
+    only collect explicitly requested nodes.
+    """
+    return []
+
+
+def get_relation_map(cursor, project_id):
+    return get_relation_to_id_map(project_id, cursor=cursor)
+
+
+def node_list_tuples_query(params, project_id, explicit_treenode_ids, explicit_connector_ids, include_labels, tn_provider, binary=False):
+    cursor = connection.cursor()
+    relation_map = get_relation_map(cursor, project_id)
+    result = _node_list(cursor, params, relation_map, explicit_treenode_ids,
+            explicit_connector_ids, include_labels, tn_provider)
+    return _node_list_response(result, binary)
+
+
+def node_list_tuples_cached(params, project_id, explicit_treenode_ids, explicit_connector_ids, include_labels, tn_provider, binary=False):
+    """Like node_list_tuples_query(), but assemble the result from cached
+    per-tile chunks (see node_list_cache). Explicitly requested nodes that are
+    not part of any chunk are queried separately. If the field of view covers
+    too many tiles, the database is queried directly.
+    """
+    cursor = connection.cursor()
+    relation_map = get_relation_map(cursor, project_id)
+
+    def compute_tile(tile_params):
+        return _node_list(cursor, tile_params, relation_map, None, None,
+                include_labels, tn_provider)
+
+    chunks = node_list_cache.get_node_list(project_id, params, include_labels,
+            compute_tile)
+    if chunks is None:
+        result = _node_list(cursor, params, relation_map,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                tn_provider)
+        return _node_list_response(result, binary)
+
+    # Each tile was queried with the full node limit, which is why the limit
+    # has to be applied to the merged result as well.
+    result = _merge_node_lists(chunks, params['limit'])
+
+    # Add explicitly requested treenodes and connectors, if necessary.
+    treenode_ids = set(row[0] for row in result[0])
+    connector_ids = set(row[0] for row in result[1])
+    missing_treenode_ids = [tnid for tnid in (explicit_treenode_ids or [])
+            if -1 != tnid and tnid not in treenode_ids]
+    missing_connector_ids = [cid for cid in (explicit_connector_ids or [])
+            if -1 != cid and cid not in connector_ids]
+    if missing_treenode_ids or missing_connector_ids:
+        explicit = _node_list(cursor, dict(params), relation_map,
+                missing_treenode_ids, missing_connector_ids, include_labels,
+                get_no_treenodes, get_connector_nodes_by_id)
+        result = _merge_node_lists([result, explicit])
+
+    return _node_list_response(result, binary)
+
+
+def _merge_node_lists(node_lists, limit=None):
+    """Merge multiple node list results into one. Treenodes and connectors
+    are de-duplicated by ID, connector links by their treenode connector ID.
+    If a <limit> is given, merging stops before the first node list that would
+    raise the number of treenodes above it and the limit is marked as reached.
+    """
+    treenodes = []
+    treenode_ids = set()
+    connectors = []
+    connector_links = {}
+    labels = defaultdict(list)
+    limit_reached = False
+    used_rel_map = {}
+
+    for n_treenodes, n_connectors, n_labels, n_limit_reached, n_rel_map in node_lists:
+        if limit is not None and treenodes:
+            n_new_treenodes = sum(1 for row in n_treenodes
+                    if row[0] not in treenode_ids)
+            if len(treenodes) + n_new_treenodes > limit:
+                limit_reached = True
+                break
+
+        for row in n_treenodes:
+            if row[0] not in treenode_ids:
+                treenode_ids.add(row[0])
+                treenodes.append(row)
+
+        for row in n_connectors:
+            cid = row[0]
+            if cid not in connector_links:
+                links = list(row[7])
+                connector_links[cid] = (links, set(l[4] for l in links))
+                connectors.append(tuple(row[0:7]) + (links,))
+            else:
+                links, seen_links = connector_links[cid]
+                for l in row[7]:
+                    if l[4] not in seen_links:
+                        seen_links.add(l[4])
+                        links.append(l)
+
+        for node_id, node_labels in n_labels.iteritems():
+            merged_labels = labels[node_id]
+            for l in node_labels:
+                if l not in merged_labels:
+                    merged_labels.append(l)
+
+        limit_reached = limit_reached or n_limit_reached
+        used_rel_map.update(n_rel_map)
+
+    return treenodes, connectors, labels, limit_reached, used_rel_map
+
+
+def _node_list_response(result, binary=False):
+    if binary:
+        return _node_list_binary_response(result)
+
+    treenodes, connectors, labels, limit_reached, used_rel_map = result
+    return HttpResponse(json.dumps((
+        treenodes, connectors, labels,
+        limit_reached,
+        used_rel_map),
+        cls=DjangoJSONEncoder,
+        separators=(',', ':')), # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+        content_type='application/json')
+
+
+def _epoch_seconds(timestamp):
+    """Return a datetime as (fractional) seconds since the Unix epoch."""
+    return calendar.timegm(timestamp.utctimetuple()) + \
+            timestamp.microsecond * 1e-6
+
+
+def _binary_column(values, dtype):
+    """Return the passed in values as little endian array of the given type,
+    padded to a multiple of eight bytes.
+    """
+    data = np.array(values, dtype=dtype).tostring()
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _node_list_binary_response(result):
+    """Encode a node list result as a single binary buffer of typed columns.
+    All numbers are little endian. The buffer starts with a 24 byte header:
+
+    magic (4 bytes, "CMNL"), format version (uint16), flags (uint16, bit 0 set
+    if the node limit was reached), number of treenodes (uint32), number of
+    connectors (uint32), number of connector links (uint32) and length of the
+    trailing JSON block (uint32).
+
+    The header is followed by these columns, each padded to a multiple of
+    eight bytes so that it can be read as typed array in place:
+
+    treenodes: id (int64), parent_id (int64, -1 for root nodes), x, y, z
+    (float32), confidence (uint8), radius (float32), skeleton_id (int64),
+    edition_time (float64, seconds since epoch), user_id (int32)
+
+    connectors: id (int64), x, y, z (float32), confidence (uint8),
+    edition_time (float64), user_id (int32), link offset (uint32, number of
+    connectors + 1 entries, links of connector i are in [offset[i],
+    offset[i+1]))
+
+    links: treenode_id (int64), relation_id (int64), confidence (uint8),
+    edition_time (float64), id (int64)
+
+    The buffer ends with a UTF-8 encoded JSON object with the fields "labels"
+    and "relation_map", equivalent to the respective fields of the JSON
+    response.
+    """
+    treenodes, connectors, labels, limit_reached, used_rel_map = result
+
+    links = []
+    link_offsets = [0]
+    for c in connectors:
+        links.extend(c[7])
+        link_offsets.append(len(links))
+
+    tn = zip(*treenodes) or [()] * 10
+    cn = zip(*connectors) or [()] * 8
+    ln = zip(*links) or [()] * 5
+
+    trailer = json.dumps({
+        'labels': labels,
+        'relation_map': used_rel_map
+    }, separators=(',', ':')).encode('utf-8')
+
+    parts = [
+        struct.pack('<4sHHIIII', NODE_LIST_BINARY_MAGIC,
+                NODE_LIST_BINARY_VERSION, 1 if limit_reached else 0,
+                len(treenodes), len(connectors), len(links), len(trailer)),
+        # Treenodes
+        _binary_column(tn[0], '<i8'),
+        _binary_column([-1 if p is None else p for p in tn[1]], '<i8'),
+        _binary_column(tn[2], '<f4'),
+        _binary_column(tn[3], '<f4'),
+        _binary_column(tn[4], '<f4'),
+        _binary_column(tn[5], '<u1'),
+        _binary_column(tn[6], '<f4'),
+        _binary_column(tn[7], '<i8'),
+        _binary_column([_epoch_seconds(t) for t in tn[8]], '<f8'),
+        _binary_column(tn[9], '<i4'),
+        # Connectors
+        _binary_column(cn[0], '<i8'),
+        _binary_column(cn[1], '<f4'),
+        _binary_column(cn[2], '<f4'),
+        _binary_column(cn[3], '<f4'),
+        _binary_column(cn[4], '<u1'),
+        _binary_column([_epoch_seconds(t) for t in cn[5]], '<f8'),
+        _binary_column(cn[6], '<i4'),
+        _binary_column(link_offsets, '<u4'),
+        # Links
+        _binary_column(ln[0], '<i8'),
+        _binary_column(ln[1], '<i8'),
+        _binary_column(ln[2], '<u1'),
+        _binary_column([_epoch_seconds(t) for t in ln[3]], '<f8'),
+        _binary_column(ln[4], '<i8'),
+        trailer
+    ]
+
+    return HttpResponse(b''.join(parts),
+            content_type=NODE_LIST_BINARY_CONTENT_TYPE)
+
+
+def _node_list(cursor, params, relation_map, explicit_treenode_ids,
+        explicit_connector_ids, include_labels, tn_provider, cn_provider=None):
+    """Collect treenodes, connectors and labels in the bounding box defined by
+    <params> as well as explicitly requested nodes. Returns a tuple of
+    treenodes, connectors, labels, whether the node limit was reached and a
+    map of used relation IDs to relation names.
+    """
+    response_on_error = ''
+    try:
         id_to_relation = {v: k for k, v in relation_map.items()}
 
         response_on_error = 'Failed to query treenodes'
@@ -364,7 +683,8 @@ def node_list_tuples_query(params, project_id, explicit_treenode_ids, explicit_c
         # Find connectors related to treenodes in the field of view
         # Connectors found attached to treenodes
         response_on_error = 'Failed to query connector locations.'
-        cn_provider = get_connector_nodes_classic if tn_provider == get_treenodes_classic else get_connector_nodes_postgis
+        if not cn_provider:
+            cn_provider = get_connector_nodes_classic if tn_provider == get_treenodes_classic else get_connector_nodes_postgis
         crows = cn_provider(cursor, params, treenode_ids, missing_connector_ids)
 
         connectors = []
@@ -442,46 +762,297 @@ def node_list_tuples_query(params, project_id, explicit_treenode_ids, explicit_c
                     top <= r[3] < bottom and \
                     z1 <= r[4] < z2
 
-            # Collect treenodes visible in the current section
-            visible = [row[0] for row in treenodes if is_visible(row)]
-            if visible:
-                cursor.execute('''
-                SELECT treenode_class_instance.treenode_id,
-                       class_instance.name
-                FROM class_instance,
-                     treenode_class_instance,
-                     UNNEST(%s::bigint[]) treenodes(tnid)
-                WHERE treenode_class_instance.relation_id = %s
-                  AND class_instance.id = treenode_class_instance.class_instance_id
-                  AND treenode_class_instance.treenode_id = tnid
-                ''', (visible, relation_map['labeled_as']))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
-
-            # Collect connectors visible in the current section
-            visible = [row[0] for row in connectors if z1 <= row[3] < z2]
-            if visible:
-                cursor.execute('''
-                SELECT connector_class_instance.connector_id,
-                       class_instance.name
-                FROM class_instance,
-                     connector_class_instance,
-                     UNNEST(%s::bigint[]) connectors(cnid)
-                WHERE connector_class_instance.relation_id = %s
-                  AND class_instance.id = connector_class_instance.class_instance_id
-                  AND connector_class_instance.connector_id = cnid
-                ''', (visible, relation_map['labeled_as']))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
+            # Collect treenodes and connectors visible in the current section
+            visible_treenodes = [row[0] for row in treenodes if is_visible(row)]
+            visible_connectors = [row[0] for row in connectors if z1 <= row[3] < z2]
+            _add_node_labels(cursor, labels, visible_treenodes,
+                    visible_connectors, relation_map['labeled_as'])
 
         used_rel_map = {r:id_to_relation[r] for r in used_relations}
-        return HttpResponse(json.dumps((
-            treenodes, connectors, labels,
-            n_retrieved_nodes == params['limit'],
-            used_rel_map),
-            cls=DjangoJSONEncoder,
-            separators=(',', ':')), # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
-            content_type='application/json')
+        return (treenodes, connectors, labels,
+                n_retrieved_nodes == params['limit'], used_rel_map)
+
+    except Exception as e:
+        raise Exception(response_on_error + ':' + str(e))
+
+
+def _add_node_labels(cursor, labels, treenode_ids, connector_ids, labeled_as):
+    """Add the labels of the passed in treenodes and connectors to <labels>, a
+    dictionary that maps node IDs to lists of label names.
+    """
+    if treenode_ids:
+        cursor.execute('''
+        SELECT treenode_class_instance.treenode_id,
+               class_instance.name
+        FROM class_instance,
+             treenode_class_instance,
+             UNNEST(%s::bigint[]) treenodes(tnid)
+        WHERE treenode_class_instance.relation_id = %s
+          AND class_instance.id = treenode_class_instance.class_instance_id
+          AND treenode_class_instance.treenode_id = tnid
+        ''', (list(treenode_ids), labeled_as))
+        for row in cursor.fetchall():
+            labels[row[0]].append(row[1])
+
+    if connector_ids:
+        cursor.execute('''
+        SELECT connector_class_instance.connector_id,
+               class_instance.name
+        FROM class_instance,
+             connector_class_instance,
+             UNNEST(%s::bigint[]) connectors(cnid)
+        WHERE connector_class_instance.relation_id = %s
+          AND class_instance.id = connector_class_instance.class_instance_id
+          AND connector_class_instance.connector_id = cnid
+        ''', (list(connector_ids), labeled_as))
+        for row in cursor.fetchall():
+            labels[row[0]].append(row[1])
+
+
+# Query fragment that provides one row per requested section, along with the
+# geometries needed to find edges that intersect this section (see
+# get_treenodes_postgis() for an explanation).
+_SECTIONS_QUERY = '''
+    WITH sections AS (
+        SELECT s.idx,
+            ST_MakeLine(ST_MakePoint(%(left)s, %(bottom)s, s.z2),
+                        ST_MakePoint(%(right)s, %(top)s, s.z1)) AS bbox,
+            ST_MakePolygon(ST_MakeLine(ARRAY[
+                ST_MakePoint(%(left)s, %(top)s, (s.z1 + s.z2) * 0.5),
+                ST_MakePoint(%(right)s, %(top)s, (s.z1 + s.z2) * 0.5),
+                ST_MakePoint(%(right)s, %(bottom)s, (s.z1 + s.z2) * 0.5),
+                ST_MakePoint(%(left)s, %(bottom)s, (s.z1 + s.z2) * 0.5),
+                ST_MakePoint(%(left)s, %(top)s, (s.z1 + s.z2) * 0.5)])) AS plane,
+            abs(s.z2 - s.z1) * 0.5 AS halfzdiff
+        FROM UNNEST(%(z1s)s::float8[], %(z2s)s::float8[])
+            WITH ORDINALITY s(z1, z2, idx)
+    )
+'''
+
+
+def _node_list_sections(cursor, params, sections, relation_map,
+        explicit_treenode_ids, explicit_connector_ids, include_labels):
+    """Collect node lists like _node_list() does for a list of sections, each
+    given as (z1, z2) tuple, and the X/Y bounds in <params>. Treenodes,
+    connectors, treenodes linked to connectors and labels are retrieved with
+    one query each for all sections. A list of node list results is returned,
+    one for each section in the same order.
+    """
+    response_on_error = ''
+    try:
+        id_to_relation = {v: k for k, v in relation_map.items()}
+        params = dict(params)
+        params['z1s'] = [s[0] for s in sections]
+        params['z2s'] = [s[1] for s in sections]
+        params['connector_ids'] = [int(cid) for cid in
+                (explicit_connector_ids or []) if -1 != cid]
+        explicit_treenode_ids = set(tnid for tnid in
+                (explicit_treenode_ids or []) if -1 != tnid)
+
+        treenodes = [[] for s in sections]
+        treenode_ids = [set() for s in sections]
+        n_retrieved_nodes = [0 for s in sections]
+
+        response_on_error = 'Failed to query treenodes'
+        cursor.execute(_SECTIONS_QUERY + '''
+        SELECT
+            s.idx,
+            t1.id,
+            t1.parent_id,
+            t1.location_x,
+            t1.location_y,
+            t1.location_z,
+            t1.confidence,
+            t1.radius,
+            t1.skeleton_id,
+            t1.edition_time,
+            t1.user_id,
+            t2.id,
+            t2.parent_id,
+            t2.location_x,
+            t2.location_y,
+            t2.location_z,
+            t2.confidence,
+            t2.radius,
+            t2.skeleton_id,
+            t2.edition_time,
+            t2.user_id
+        FROM sections s
+        CROSS JOIN LATERAL (
+            SELECT te.id
+            FROM treenode_edge te
+            WHERE te.edge &&& s.bbox
+              AND ST_3DDWithin(te.edge, s.plane, s.halfzdiff)
+              AND te.project_id = %(project_id)s
+            LIMIT %(limit)s
+        ) edges(edge_child_id)
+        JOIN treenode t1 ON edge_child_id = t1.id
+        LEFT JOIN treenode t2 ON t2.id = t1.parent_id
+        ''', params)
+
+        for row in cursor.fetchall():
+            i = row[0] - 1
+            n_retrieved_nodes[i] += 1
+            section_treenode_ids = treenode_ids[i]
+            t1id = row[1]
+            if t1id not in section_treenode_ids:
+                section_treenode_ids.add(t1id)
+                treenodes[i].append(row[1:11])
+            t2id = row[11]
+            if t2id and t2id not in section_treenode_ids:
+                section_treenode_ids.add(t2id)
+                treenodes[i].append(row[11:21])
+
+        response_on_error = 'Failed to query connector locations.'
+        cursor.execute(_SECTIONS_QUERY + '''
+        SELECT s.idx, c.*
+        FROM sections s
+        CROSS JOIN LATERAL (
+            SELECT
+                c.id,
+                c.location_x,
+                c.location_y,
+                c.location_z,
+                c.confidence,
+                c.edition_time,
+                c.user_id,
+                tc.treenode_id,
+                tc.relation_id,
+                tc.confidence,
+                tc.edition_time,
+                tc.id
+            FROM (SELECT tce.id AS tce_id
+                 FROM treenode_connector_edge tce
+                 WHERE tce.edge &&& s.bbox
+                   AND ST_3DDWithin(tce.edge, s.plane, s.halfzdiff)
+                   AND tce.project_id = %(project_id)s
+              ) edges(edge_tc_id)
+            JOIN treenode_connector tc
+              ON (tc.id = edge_tc_id)
+            JOIN connector c
+              ON (c.id = tc.connector_id)
+            WHERE c.project_id = %(project_id)s
+
+            UNION
+
+            SELECT
+                c.id,
+                c.location_x,
+                c.location_y,
+                c.location_z,
+                c.confidence,
+                c.edition_time,
+                c.user_id,
+                NULL,
+                NULL,
+                NULL,
+                NULL,
+                NULL
+            FROM (SELECT cg.id AS cg_id
+                 FROM connector_geom cg
+                 WHERE cg.geom &&& s.bbox
+                   AND ST_3DDWithin(cg.geom, s.plane, s.halfzdiff)
+                   AND cg.project_id = %(project_id)s
+                UNION SELECT UNNEST(%(connector_ids)s::bigint[])
+              ) geoms(geom_connector_id)
+            JOIN connector c
+              ON (geom_connector_id = c.id)
+            WHERE c.project_id = %(project_id)s
+            LIMIT %(limit)s
+        ) c(id, location_x, location_y, location_z, confidence, edition_time,
+            user_id, treenode_id, relation_id, tc_confidence, tc_edition_time,
+            tc_id)
+        ''', params)
+
+        connectors = [[] for s in sections]
+        connector_ids = [set() for s in sections]
+        links = [defaultdict(list) for s in sections]
+        used_relations = [set() for s in sections]
+        seen_links = [set() for s in sections]
+        missing_treenode_ids = [explicit_treenode_ids - section_treenode_ids
+                for section_treenode_ids in treenode_ids]
+
+        for row in cursor.fetchall():
+            i = row[0] - 1
+            cid = row[1] # connector ID
+            tnid = row[8] # treenode ID
+            tcid = row[12] # treenode connector ID
+            section_links = links[i]
+
+            if tnid is not None:
+                if tcid in seen_links[i]:
+                    continue
+                if tnid not in treenode_ids[i]:
+                    missing_treenode_ids[i].add(tnid)
+                seen_links[i].add(tcid)
+                section_links[cid].append(row[8:13])
+                used_relations[i].add(row[9])
+
+            if cid not in connector_ids[i]:
+                connectors[i].append(row[1:8] + (section_links[cid],))
+                connector_ids[i].add(cid)
+
+        # Fetch treenodes that are linked to a connector of a section, but
+        # aren't part of this section yet, for all sections at once.
+        all_missing_treenode_ids = set()
+        for section_missing_treenode_ids in missing_treenode_ids:
+            all_missing_treenode_ids.update(section_missing_treenode_ids)
+
+        if all_missing_treenode_ids:
+            response_on_error = 'Failed to query treenodes from connectors'
+            cursor.execute('''
+            SELECT id,
+                parent_id,
+                location_x,
+                location_y,
+                location_z,
+                confidence,
+                radius,
+                skeleton_id,
+                edition_time,
+                user_id
+            FROM treenode,
+                 UNNEST(%s::bigint[]) missingnodes(mnid)
+            WHERE id = mnid''', (list(all_missing_treenode_ids),))
+            missing_treenodes = {row[0]: row for row in cursor.fetchall()}
+
+            for i, section_missing_treenode_ids in enumerate(missing_treenode_ids):
+                treenodes[i].extend(missing_treenodes[tnid] for tnid in
+                        section_missing_treenode_ids if tnid in missing_treenodes)
+
+        # Labels of nodes visible in any section are queried at once and
+        # distributed to the individual sections afterwards.
+        section_labels = [defaultdict(list) for s in sections]
+        if include_labels:
+            top, left = params['top'], params['left']
+            bottom, right = params['bottom'], params['right']
+
+            visible_nodes = []
+            all_visible_treenodes = set()
+            all_visible_connectors = set()
+            for i, (z1, z2) in enumerate(sections):
+                visible_treenodes = [row[0] for row in treenodes[i] if
+                        left <= row[2] < right and top <= row[3] < bottom and
+                        z1 <= row[4] < z2]
+                visible_connectors = [row[0] for row in connectors[i]
+                        if z1 <= row[3] < z2]
+                visible_nodes.append(visible_treenodes + visible_connectors)
+                all_visible_treenodes.update(visible_treenodes)
+                all_visible_connectors.update(visible_connectors)
+
+            labels = defaultdict(list)
+            _add_node_labels(cursor, labels, all_visible_treenodes,
+                    all_visible_connectors, relation_map['labeled_as'])
+
+            for i, section_visible_nodes in enumerate(visible_nodes):
+                for node_id in section_visible_nodes:
+                    if node_id in labels:
+                        section_labels[i][node_id] = labels[node_id]
+
+        return [(treenodes[i], connectors[i], section_labels[i],
+                n_retrieved_nodes[i] == params['limit'],
+                {r: id_to_relation[r] for r in used_relations[i]})
+                for i in xrange(len(sections))]
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -592,6 +1163,14 @@ def node_update(request, project_id=None):
     old_treenodes = _update_location("treenode", treenodes, now, request.user, cursor)
     old_connectors = _update_location("connector", connectors, now, request.user, cursor)
 
+    # Both the old and the new location of moved nodes are now outdated in
+    # cached node lists.
+    if nodes:
+        old_locations = {r[0]: (r[2], r[3], r[4]) for r in
+                (old_treenodes or []) + (old_connectors or [])}
+        node_list_cache.invalidate_nodes(project_id, old_locations.keys(),
+                old_locations, cursor)
+
     num_updated_nodes = len(treenodes) + len(connectors)
     return JsonResponse({
         'updated': num_updated_nodes,
@@ -0,0 +1,236 @@
+import math
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+
+# If more version keys than this would have to be bumped for a single edit,
+# the whole project is invalidated instead.
+MAX_INVALIDATED_BUCKETS = 2048
+
+
+def is_enabled():
+    """Whether node list responses should be cached. This is the case if
+    NODE_LIST_CACHE names a cache configured in CACHES.
+    """
+    return bool(getattr(settings, 'NODE_LIST_CACHE', None))
+
+
+def get_cache():
+    return caches[settings.NODE_LIST_CACHE]
+
+
+def new_token():
+    """Return a new random version token. Random tokens (rather than counters)
+    make sure a version key that got evicted from the cache can't accidentally
+    be re-initialized to a value an old chunk was stored with.
+    """
+    return random.getrandbits(62)
+
+
+def generation_key(project_id):
+    return 'catmaid-nodelist-gen:%d' % project_id
+
+
+def version_key(project_id, tx, ty, tz):
+    return 'catmaid-nodelist-version:%d:%d:%d:%d' % (project_id, tx, ty, tz)
+
+
+def chunk_key(project_id, z1, z2, tx, ty, include_labels):
+    return 'catmaid-nodelist-chunk:%d:%r:%r:%d:%d:%d' % (project_id, z1, z2,
+            tx, ty, 1 if include_labels else 0)
+
+
+def tile_range(low, high, size):
+    """Return the first and last tile index covering the half open interval
+    [low, high) if it is split into tiles of the given size.
+    """
+    first = int(math.floor(float(low) / size))
+    last = max(first, int(math.ceil(float(high) / size)) - 1)
+    return first, last
+
+
+def get_node_list(project_id, params, include_labels, compute_tile):
+    """Return a list of per-tile node list results that together cover the
+    bounding box in <params>. Tiles are taken from the cache if they are still
+    current and computed with <compute_tile> otherwise. The compute function
+    is called with a copy of <params> that is restricted to the tile's
+    bounding box. Results are ordered by the distance of their tile to the
+    center of the field of view. None is returned if the field of view covers
+    more tiles than NODE_LIST_CACHE_MAX_TILES, in which case the caller is
+    expected to query the database directly.
+    """
+    cache = get_cache()
+    sx, sy, sz = settings.NODE_LIST_CACHE_TILE_SIZE
+    z1, z2 = params['z1'], params['z2']
+
+    tx_min, tx_max = tile_range(params['left'], params['right'], sx)
+    ty_min, ty_max = tile_range(params['top'], params['bottom'], sy)
+    tz_min, tz_max = tile_range(z1, z2, sz)
+
+    tiles = [(tx, ty) for tx in xrange(tx_min, tx_max + 1)
+                      for ty in xrange(ty_min, ty_max + 1)]
+    if len(tiles) > settings.NODE_LIST_CACHE_MAX_TILES:
+        return None
+
+    # Central tiles come first, so that they are kept if the caller can't use
+    # all results, e.g. because the node limit is reached.
+    cx = (params['left'] + params['right']) / (2.0 * sx) - 0.5
+    cy = (params['top'] + params['bottom']) / (2.0 * sy) - 0.5
+    tiles.sort(key=lambda t: (t[0] - cx) ** 2 + (t[1] - cy) ** 2)
+
+    # Collect the current version of every spatial bucket a tile depends on
+    # and initialize missing ones.
+    gen_key = generation_key(project_id)
+    tile_version_keys = {(tx, ty): [version_key(project_id, tx, ty, tz)
+            for tz in xrange(tz_min, tz_max + 1)] for tx, ty in tiles}
+    all_version_keys = [gen_key] + [k for keys in tile_version_keys.values()
+            for k in keys]
+    versions = cache.get_many(all_version_keys)
+    missing_version_keys = [k for k in all_version_keys if k not in versions]
+    if missing_version_keys:
+        for k in missing_version_keys:
+            cache.add(k, new_token(), None)
+        versions.update(cache.get_many(missing_version_keys))
+
+    def signature(tile):
+        return (versions.get(gen_key),) + tuple(versions.get(k)
+                for k in tile_version_keys[tile])
+
+    chunk_keys = {tile: chunk_key(project_id, z1, z2, tile[0], tile[1],
+            include_labels) for tile in tiles}
+    cached_chunks = cache.get_many(chunk_keys.values())
+
+    chunks = []
+    new_chunks = {}
+    for tile in tiles:
+        key = chunk_keys[tile]
+        tile_signature = signature(tile)
+        cached = cached_chunks.get(key)
+        if cached and cached[0] == tile_signature:
+            chunks.append(cached[1])
+            continue
+
+        tile_params = dict(params)
+        tile_params['left'] = tile[0] * sx
+        tile_params['right'] = (tile[0] + 1) * sx
+        tile_params['top'] = tile[1] * sy
+        tile_params['bottom'] = (tile[1] + 1) * sy
+        chunk = compute_tile(tile_params)
+        chunks.append(chunk)
+        new_chunks[key] = (tile_signature, chunk)
+
+    if new_chunks:
+        cache.set_many(new_chunks, settings.NODE_LIST_CACHE_TIMEOUT)
+
+    return chunks
+
+
+def bump_versions(keys):
+    cache = get_cache()
+    cache.set_many({k: new_token() for k in keys}, None)
+
+
+def schedule_bump(keys):
+    """Bump the passed in version keys right away and again once the current
+    transaction is committed. The second bump makes sure a tile that was
+    recomputed by a concurrent request before the edit became visible is
+    not served any longer.
+    """
+    if not keys:
+        return
+    bump_versions(keys)
+    transaction.on_commit(lambda: bump_versions(keys))
+
+
+def invalidate_project(project_id):
+    """Mark all cached node list tiles of a project as outdated. This is used
+    for edits that affect large parts of a project, like splits, merges and
+    reroots of whole skeletons.
+    """
+    if not is_enabled():
+        return
+    schedule_bump([generation_key(int(project_id))])
+
+
+def invalidate_boxes(project_id, boxes):
+    """Mark all tiles as outdated that intersect one of the passed in bounding
+    boxes, each given as ((min_x, min_y, min_z), (max_x, max_y, max_z)).
+    """
+    if not is_enabled():
+        return
+    project_id = int(project_id)
+    sx, sy, sz = settings.NODE_LIST_CACHE_TILE_SIZE
+    keys = set()
+    for (x0, y0, z0), (x1, y1, z1) in boxes:
+        tx0, ty0, tz0 = (int(math.floor(float(v) / s)) for v, s in
+                ((x0, sx), (y0, sy), (z0, sz)))
+        tx1, ty1, tz1 = (int(math.floor(float(v) / s)) for v, s in
+                ((x1, sx), (y1, sy), (z1, sz)))
+        n_buckets = (tx1 - tx0 + 1) * (ty1 - ty0 + 1) * (tz1 - tz0 + 1)
+        if len(keys) + n_buckets > MAX_INVALIDATED_BUCKETS:
+            schedule_bump([generation_key(project_id)])
+            return
+        for tx in xrange(tx0, tx1 + 1):
+            for ty in xrange(ty0, ty1 + 1):
+                for tz in xrange(tz0, tz1 + 1):
+                    keys.add(version_key(project_id, tx, ty, tz))
+    schedule_bump(keys)
+
+
+def invalidate_nodes(project_id, node_ids, extra_locations=None, cursor=None):
+    """Mark all tiles as outdated that show a treenode or connector in
+    <node_ids> or any edge from or to it. This includes edges to parent and
+    child treenodes as well as to linked connectors or treenodes. Optionally,
+    <extra_locations> maps node IDs to (x, y, z) tuples of additional
+    locations that belong to this node, typically the location before a node
+    was moved. Nodes that changed their topology need to be invalidated both
+    before and after the change.
+    """
+    if not is_enabled():
+        return
+    node_ids = [int(n) for n in node_ids]
+    if not node_ids:
+        return
+
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+        SELECT q.id, l.location_x, l.location_y, l.location_z
+        FROM UNNEST(%(ids)s::bigint[]) q(id)
+        JOIN location l ON l.id = q.id
+        UNION ALL
+        SELECT q.id, t.location_x, t.location_y, t.location_z
+        FROM UNNEST(%(ids)s::bigint[]) q(id)
+        JOIN treenode t ON t.parent_id = q.id
+        UNION ALL
+        SELECT q.id, p.location_x, p.location_y, p.location_z
+        FROM UNNEST(%(ids)s::bigint[]) q(id)
+        JOIN treenode c ON c.id = q.id
+        JOIN treenode p ON p.id = c.parent_id
+        UNION ALL
+        SELECT q.id, c.location_x, c.location_y, c.location_z
+        FROM UNNEST(%(ids)s::bigint[]) q(id)
+        JOIN treenode_connector tc ON tc.treenode_id = q.id
+        JOIN connector c ON c.id = tc.connector_id
+        UNION ALL
+        SELECT q.id, t.location_x, t.location_y, t.location_z
+        FROM UNNEST(%(ids)s::bigint[]) q(id)
+        JOIN treenode_connector tc ON tc.connector_id = q.id
+        JOIN treenode t ON t.id = tc.treenode_id
+    ''', {'ids': node_ids})
+
+    locations = {}
+    for node_id, x, y, z in cursor.fetchall():
+        locations.setdefault(node_id, []).append((x, y, z))
+    if extra_locations:
+        for node_id, loc in extra_locations.iteritems():
+            locations.setdefault(node_id, []).append(loc)
+
+    boxes = []
+    for node_locations in locations.itervalues():
+        xs, ys, zs = zip(*node_locations)
+        boxes.append(((min(xs), min(ys), min(zs)), (max(xs), max(ys), max(zs))))
+
+    invalidate_boxes(project_id, boxes)
@@ -0,0 +1,45 @@
+import atexit
+import multiprocessing
+import os
+
+from itertools import imap
+from threading import Lock
+
+from django.conf import settings
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """Return the process pool of the current process or None if
+    PROCESS_POOL_SIZE is lower than two. The pool is created on first use, so
+    that worker processes of prefork servers each get their own.
+    """
+    global _pool, _pool_pid
+    size = getattr(settings, 'PROCESS_POOL_SIZE', 0)
+    if size < 2:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(size)
+            _pool_pid = os.getpid()
+            atexit.register(_pool.terminate)
+        return _pool
+
+
+def imap_tasks(fn, tasks, min_tasks=2):
+    """Apply <fn> to every element of <tasks> and return an iterator over the
+    results in the order of the tasks. If a process pool is configured and
+    there are at least <min_tasks> tasks, they are run in parallel. In this
+    case, <fn> has to be a module level function and both tasks and results
+    have to be picklable. Since they are copied between processes, tasks should
+    be compact, e.g. tuples of NumPy arrays rather than networkx graphs.
+    """
+    tasks = list(tasks)
+    pool = get_pool() if len(tasks) >= min_tasks else None
+    if pool is None:
+        return imap(fn, tasks)
+    return pool.imap(fn, tasks)
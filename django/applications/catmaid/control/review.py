@@ -99,15 +99,15 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
 
     skids_string = ','.join(map(str, skeleton_ids))
 
-    # Count nodes of each skeleton
+    # Look up node counts and union review counts of each skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes, num_reviewed_nodes
+    FROM catmaid_skeleton_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
+      AND num_nodes > 0
     ''' % skids_string)
     for row in cursor.fetchall():
-        skeletons[row[0]] = [row[1], 0]
+        skeletons[row[0]] = [row[1], row[2]]
 
     query_joins = ""
     # Optionally, add a filter
@@ -130,9 +130,13 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
         user_filter = " AND r.reviewer_id NOT IN (%s)" % \
             ",".join(map(str, excluding_user_ids))
     else:
-        # Count total number of reviewed nodes per skeleton, regardless
-        # of reviewer.
-        user_filter = ""
+        # The total number of reviewed nodes per skeleton, regardless of
+        # reviewer, is part of the skeleton summary.
+        return skeletons
+
+    # Filtered reviews have to be counted explicitly
+    for counts in skeletons.itervalues():
+        counts[1] = 0
 
     cursor.execute('''
     SELECT skeleton_id, count(*)
@@ -15,6 +15,8 @@ from catmaid.models import UserRole, RegionOfInterest, Project, Relation, \
 from celery.task import task
 from celery.utils.log import get_task_logger
 
+from PIL import Image
+
 # Prefix for stored ROIs
 file_prefix = "roi_"
 # File extension of the stored ROIs
@@ -215,13 +217,13 @@ def create_roi_image_task(user, project_id, roi_id, file_path):
         job = cropping.CropJob(user, project_id, [roi.stack.id],
             x_min, x_max, y_min, y_max, z_min, z_max, roi.rotation_cw,
             roi.zoom_level, single_channel)
-        # Create the pgmagick images
+        # Create the images
         cropped_stacks = cropping.extract_substack( job )
         if len(cropped_stacks) == 0:
             raise StandardError("Couldn't create ROI image")
         # There is only one image here
-        img = cropped_stacks[0]
-        img.write(str(file_path))
+        img = Image.fromarray(cropped_stacks[0])
+        img.save(str(file_path))
     finally:
         release_lock()
 
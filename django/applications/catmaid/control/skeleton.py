@@ -11,7 +11,7 @@ from django.conf import settings
 from django.http import HttpResponse, HttpResponseBadRequest, Http404, \
         JsonResponse
 from django.shortcuts import get_object_or_404
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.views.decorators.cache import never_cache
 
@@ -31,6 +31,7 @@ from catmaid.control.neuron_annotations import create_annotation_query, \
         _annotate_entities, _update_neuron_annotations
 from catmaid.control.review import get_review_status
 from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control import arbor_cache, node_list_cache
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -224,8 +225,7 @@ def find_labels(request, project_id=None, skeleton_id=None):
     label_regex = str(request.POST['label_regex'])
     cursor = connection.cursor()
 
-    cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-    labeled_as = cursor.fetchone()[0]
+    labeled_as = get_relation_to_id_map(project_id, ('labeled_as',), cursor)['labeled_as']
 
     # Select all nodes in the skeleton and any matching labels
     cursor.execute('''
@@ -601,21 +601,40 @@ def split_skeleton(request, project_id=None):
     new neuron are updated to refer to the new skeleton.
     """
     treenode_id = int(request.POST['treenode_id'])
-    treenode = Treenode.objects.get(pk=treenode_id)
-    skeleton_id = treenode.skeleton_id
-    project_id = int(project_id)
     upstream_annotation_map = json.loads(request.POST.get('upstream_annotation_map'))
     downstream_annotation_map = json.loads(request.POST.get('downstream_annotation_map'))
-    cursor = connection.cursor()
 
     # Check if the treenode is root!
+    treenode = Treenode.objects.get(pk=treenode_id)
     if not treenode.parent:
         return JsonResponse({'error': 'Can\'t split at the root node: it doesn\'t have a parent.'})
 
+    return JsonResponse(_split_skeleton(request.user, project_id, treenode_id,
+            upstream_annotation_map, downstream_annotation_map))
+
+
+def _split_skeleton(user, project_id, treenode_id, upstream_annotation_map,
+        downstream_annotation_map):
+    """ Split the skeleton of the passed in treenode at the edge between the
+    treenode and its parent. The treenode and everything downstream of it
+    becomes part of a new skeleton, which models a new neuron. The annotation
+    maps map annotation names to annotator IDs. If upstream_annotation_map is
+    None, the existing neuron keeps all its annotations and the new one has
+    none.
+    """
+    treenode = Treenode.objects.get(pk=treenode_id)
+    skeleton_id = treenode.skeleton_id
+    project_id = int(project_id)
+    cursor = connection.cursor()
+
+    if not treenode.parent_id:
+        raise ValueError('Can\'t split at the root node: it doesn\'t have a parent.')
+
     # Check if annotations are valid
-    if not check_annotations_on_split(project_id, skeleton_id,
-            frozenset(upstream_annotation_map.keys()),
-            frozenset(downstream_annotation_map.keys())):
+    if upstream_annotation_map is not None and \
+            not check_annotations_on_split(project_id, skeleton_id,
+                frozenset(upstream_annotation_map.keys()),
+                frozenset(downstream_annotation_map.keys())):
         raise Exception("Annotation distribution is not valid for splitting. " \
           "One part has to keep the whole set of annotations!")
 
@@ -627,35 +646,8 @@ def split_skeleton(request, project_id=None):
         cici_via_b__class_instance_a_id=skeleton_id)
 
     # Make sure the user has permissions to edit
-    can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
+    can_edit_class_instance_or_fail(user, neuron.id, 'neuron')
 
-    # Retrieve the id, parent_id of all nodes in the skeleton. Also
-    # pre-emptively lock all treenodes and connectors in the skeleton to prevent
-    # race conditions resulting in inconsistent skeleton IDs from, e.g., node
-    # creation or update.
-    cursor.execute('''
-        SELECT 1 FROM treenode_connector tc WHERE tc.skeleton_id = %s
-        ORDER BY tc.id
-        FOR NO KEY UPDATE OF tc;
-        SELECT t.id, t.parent_id FROM treenode t WHERE t.skeleton_id = %s
-        ORDER BY t.id
-        FOR NO KEY UPDATE OF t
-        ''', (skeleton_id, skeleton_id)) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -684,35 +676,34 @@ def split_skeleton(request, project_id=None):
     cici.project_id = project_id
     cici.save()
 
-    # Update skeleton IDs for treenodes, treenode_connectors, and reviews.
-    cursor.execute("""
-        UPDATE treenode
-          SET skeleton_id = %(new_skeleton_id)s
-          WHERE id = ANY(%(change_list)s::bigint[]);
-        UPDATE treenode_connector
-          SET skeleton_id = %(new_skeleton_id)s
-          WHERE treenode_id = ANY(%(change_list)s::bigint[]);
-        UPDATE review
-          SET skeleton_id = %(new_skeleton_id)s
-          WHERE treenode_id = ANY(%(change_list)s::bigint[]);
-        """, {'new_skeleton_id': new_skeleton.id, 'change_list': change_list})
-
-    # setting new root treenode's parent to null
-    Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
-
-    # Update annotations of existing neuron to have only over set
-    _update_neuron_annotations(project_id, request.user, neuron.id,
-            upstream_annotation_map)
-
-    # Update annotations of under skeleton
-    _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
+    # Move the downstream part of the skeleton, including its connector links
+    # and reviews, to the new skeleton and make the treenode its root. This
+    # locks all treenodes and links of the skeleton first, to prevent race
+    # conditions resulting in inconsistent skeleton IDs from, e.g., node
+    # creation or update.
+    arbor_versions = arbor_cache.lock_versions([treenode.id], cursor)
+    cursor.execute('SELECT split_skeleton(%s, %s, %s)',
+            (treenode.id, new_skeleton.id, user.id))
+
+    # All nodes of the new skeleton changed, cached node lists are outdated
+    node_list_cache.invalidate_project(project_id)
+    arbor_cache.on_split(skeleton_id, new_skeleton.id, treenode_id,
+            versions=arbor_versions, cursor=cursor)
+
+    if upstream_annotation_map is not None:
+        # Update annotations of existing neuron to have only over set
+        _update_neuron_annotations(project_id, user, neuron.id,
+                upstream_annotation_map)
+
+        # Update annotations of under skeleton
+        _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
 
     # Log the location of the node at which the split was done
     location = (treenode.location_x, treenode.location_y, treenode.location_z)
-    insert_into_log(project_id, request.user.id, "split_skeleton", location,
+    insert_into_log(project_id, user.id, "split_skeleton", location,
                     "Split skeleton with ID {0} (neuron: {1})".format( skeleton_id, neuron.name ) )
 
-    return JsonResponse({'new_skeleton_id': new_skeleton.id, 'existing_skeleton_id': skeleton_id})
+    return {'new_skeleton_id': new_skeleton.id, 'existing_skeleton_id': skeleton_id}
 
 
 @api_view(['GET'])
@@ -832,21 +823,31 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
+    # Obtain the synapses made by all skeleton_ids considering the desired
+    # direction of the synapse, as specified by relation_id_1 and
+    # relation_id_2. Synapse counts per confidence are precomputed in
+    # skeleton_adjacency, which is keyed by the relation of the presynaptic
+    # (or gap junction) side.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id = ANY(%s::integer[])
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t1.id != t2.id
-      AND t2.relation_id = %s
-    ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+    SELECT pre_skeleton_id, post_skeleton_id, confidence_histogram
+    FROM skeleton_adjacency
+    WHERE pre_skeleton_id = ANY(%(skids)s::integer[])
+      AND relation_id = %(rel_1)s
+    UNION ALL
+    SELECT post_skeleton_id, pre_skeleton_id, confidence_histogram
+    FROM skeleton_adjacency
+    WHERE post_skeleton_id = ANY(%(skids)s::integer[])
+      AND relation_id = %(rel_2)s
+      AND %(rel_1)s != %(rel_2)s
+    ''', {
+        'skids': list(skeleton_ids),
+        'rel_1': int(relation_id_1),
+        'rel_2': int(relation_id_2)
+    })
 
     # Sum the number of synapses
-    for srcID, partnerID, confidence in cursor.fetchall():
-        partners[partnerID].skids[srcID][confidence - 1] += 1
+    for srcID, partnerID, confidence_histogram in cursor.fetchall():
+        partners[partnerID].skids[srcID] = confidence_histogram
 
     # There may not be any synapses
     if not partners:
@@ -867,10 +868,9 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
 
     # Count nodes of each partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes
+    FROM catmaid_skeleton_summary
     WHERE skeleton_id = ANY(%s::integer[])
-    GROUP BY skeleton_id
     ''', (partner_skids,))
     for row in cursor.fetchall():
         partners[row[0]].num_nodes = row[1]
@@ -889,16 +889,8 @@ def _skeleton_info_raw(project_id, skeletons, op):
     cursor = connection.cursor()
 
     # Obtain the IDs of the 'presynaptic_to', 'postsynaptic_to' and 'model_of' relations
-    cursor.execute('''
-    SELECT relation_name,
-           id
-    FROM relation
-    WHERE project_id=%s
-      AND (relation_name='presynaptic_to'
-        OR relation_name='postsynaptic_to'
-        OR relation_name='gapjunction_with'
-        OR relation_name='model_of')''' % project_id)
-    relation_ids = dict(cursor.fetchall())
+    relation_ids = get_relation_to_id_map(project_id, ('presynaptic_to',
+            'postsynaptic_to', 'gapjunction_with', 'model_of'), cursor)
 
     # Obtain partner skeletons and their info
     incoming, incoming_reviewers = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
@@ -1062,32 +1054,25 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids):
     """
     cursor = connection.cursor()
     relation_map = get_relation_to_id_map(project_id)
-    post_rel_id = relation_map['postsynaptic_to']
     pre_rel_id = relation_map['presynaptic_to']
 
-    # Obtain all synapses made between row skeletons and column skeletons.
+    # Obtain the number of synapses made between row skeletons and column
+    # skeletons.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t2.skeleton_id IN (%s)
-      AND t1.connector_id = t2.connector_id
-      AND t1.relation_id = %s
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, row_skeleton_ids)),
-           ','.join(map(str, col_skeleton_ids)),
-           pre_rel_id, post_rel_id))
+    SELECT pre_skeleton_id, post_skeleton_id,
+           (SELECT sum(n) FROM unnest(confidence_histogram) n)
+    FROM skeleton_adjacency
+    WHERE pre_skeleton_id = ANY(%s::integer[])
+      AND post_skeleton_id = ANY(%s::integer[])
+      AND relation_id = %s
+    ''', (map(int, row_skeleton_ids), map(int, col_skeleton_ids), pre_rel_id))
 
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner.
     outgoing = defaultdict(dict)
-    for r in cursor.fetchall():
-        source, target = r[0], r[1]
-        mapping = outgoing[source]
-        count = mapping.get(target, 0)
-        mapping[target] = count + 1
+    for source, target, count in cursor.fetchall():
+        outgoing[source][target] = int(count)
 
     return outgoing
 
@@ -1195,45 +1180,15 @@ def _reroot_skeleton(treenode_id, project_id):
             return False
 
         response_on_error = 'An error occured while rerooting.'
-        q_treenode = Treenode.objects.filter(
-                skeleton_id=rootnode.skeleton_id,
-                project=project_id).values_list('id', 'parent_id', 'confidence')
-        nodes = {tnid: (parent_id, confidence) for (tnid, parent_id, confidence) in list(q_treenode)}
-
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parents = []
-        new_parent = rootnode.id
-        new_confidence = rootnode.confidence
-        node = first_parent
-
-        while True:
-            # Store current values to be used in next iteration
-            parent, confidence = nodes[node]
-
-            # Set new values
-            new_parents.append((node, new_parent, new_confidence))
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        new_parents.append((rootnode.id, 'NULL', 5)) # Reset to maximum confidence.
-
+        # Reverse the parent relationships on the path to the current root in
+        # the database, so that the selected treenode becomes the root.
         cursor = connection.cursor()
-        cursor.execute('''
-                UPDATE treenode
-                SET parent_id = v.parent_id,
-                    confidence = v.confidence
-                FROM (VALUES %s) v(id, parent_id, confidence)
-                WHERE treenode.id = v.id
-                ''' % ','.join(['(%s,%s,%s)' % node for node in new_parents]))
+        arbor_versions = arbor_cache.lock_versions([rootnode.id], cursor)
+        cursor.execute('SELECT reroot_skeleton(%s)', (rootnode.id,))
+
+        node_list_cache.invalidate_project(project_id)
+        arbor_cache.on_reroot(rootnode.skeleton_id, rootnode.id,
+                versions=arbor_versions, cursor=cursor)
 
         return rootnode
 
@@ -1292,6 +1247,80 @@ def join_skeleton(request, project_id=None):
         raise Exception(response_on_error + ':' + str(e))
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Annotate)
+def edit_skeletons(request, project_id=None):
+    """Reroot, split and join skeletons in a single transaction.
+
+    Operations are applied in the passed in order, each one sees the results of
+    the previous ones. If one of them fails, none is applied. The same
+    permission checks as for individual reroots, splits and joins are done.
+    ---
+    parameters:
+      - name: operations
+        description: >
+            JSON encoded list of operations. Each one is an object with a type
+            field of either "reroot", "split" or "join". Reroots and splits
+            need a treenode_id field. Splits can have upstream_annotation_map
+            and downstream_annotation_map fields, which map annotation names to
+            annotator IDs. Without them, the existing neuron keeps all its
+            annotations. Joins need from_id and to_id fields and can have an
+            annotation_set field like the join endpoint.
+        required: true
+        type: string
+        paramType: form
+    type:
+      results:
+        description: >
+            One result per operation, like it is returned by the reroot, split
+            and join endpoints.
+        type: array
+        items:
+          type: object
+        required: true
+    """
+    operations = json.loads(request.POST.get('operations', '[]'))
+    if not operations:
+        raise ValueError("No operations provided")
+
+    results = []
+    with transaction.atomic():
+        for operation in operations:
+            op_type = operation.get('type')
+            if 'reroot' == op_type:
+                treenode = _reroot_skeleton(operation['treenode_id'], project_id)
+                if not treenode:
+                    raise ValueError('Node #%s is already root!' % \
+                            operation['treenode_id'])
+                location = (treenode.location_x, treenode.location_y,
+                        treenode.location_z)
+                insert_into_log(project_id, request.user.id, 'reroot_skeleton',
+                        location, 'Rerooted skeleton for treenode with ID %s' % \
+                        treenode.id)
+                results.append({'newroot': treenode.id})
+            elif 'split' == op_type:
+                results.append(_split_skeleton(request.user, project_id,
+                        int(operation['treenode_id']),
+                        operation.get('upstream_annotation_map'),
+                        operation.get('downstream_annotation_map', {})))
+            elif 'join' == op_type:
+                from_treenode_id = int(operation['from_id'])
+                to_treenode_id = int(operation['to_id'])
+                join_info = _join_skeleton(request.user, from_treenode_id,
+                        to_treenode_id, project_id,
+                        operation.get('annotation_set'))
+                results.append({
+                    'fromid': from_treenode_id,
+                    'toid': to_treenode_id,
+                    'result_skeleton_id': join_info['from_skeleton_id'],
+                    'deleted_skeleton_id': join_info['to_skeleton_id']
+                })
+            else:
+                raise ValueError("Unknown operation type: %s" % op_type)
+
+    return JsonResponse({'results': results})
+
+
 def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         annotation_map):
     """ Take the IDs of two nodes, each belonging to a different skeleton, and
@@ -1365,32 +1394,25 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
                 raise Exception("Annotation distribution is not valid for joining. " \
                 "Annotations for which you don't have permissions have to be kept!")
 
-        # Reroot to_skid at to_treenode if necessary
-        response_on_error = 'Could not reroot at treenode %s' % to_treenode_id
-        _reroot_skeleton(to_treenode_id, project_id)
-
-        # The target skeleton is removed and its treenode assumes
-        # the skeleton id of the from-skeleton.
-
-        response_on_error = 'Could not update Treenode table with new skeleton id for joined treenodes.'
-        Treenode.objects.filter(skeleton=to_skid).update(skeleton=from_skid)
-
-        response_on_error = 'Could not update TreenodeConnector table.'
-        TreenodeConnector.objects.filter(
-            skeleton=to_skid).update(skeleton=from_skid)
-
-        # Update reviews from 'losing' neuron to now belong to the new neuron
-        response_on_error = 'Couldn not update reviews with new skeleton IDs for joined treenodes.'
-        Review.objects.filter(skeleton_id=to_skid).update(skeleton=from_skid)
+        # Reroot to_skid at to_treenode if necessary and make to_treenode a
+        # child of from_treenode. All treenodes, connector links and reviews
+        # of to_skid assume the skeleton id of the from-skeleton.
+        response_on_error = 'Could not join treenodes %s and %s' % \
+                (from_treenode_id, to_treenode_id)
+        cursor = connection.cursor()
+        arbor_versions = arbor_cache.lock_versions(
+                [from_treenode_id, to_treenode_id], cursor)
+        cursor.execute('SELECT join_skeletons(%s, %s, %s)',
+                (from_treenode_id, to_treenode_id, user.id))
 
         # Remove skeleton of to_id (deletes cicic part_of to neuron by cascade,
         # leaving the parent neuron dangling in the object tree).
         response_on_error = 'Could not delete skeleton with ID %s.' % to_skid
         ClassInstance.objects.filter(pk=to_skid).delete()
 
-        # Update the parent of to_treenode.
-        response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
-        Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
+        node_list_cache.invalidate_project(project_id)
+        arbor_cache.on_join(from_skid, from_treenode_id, to_skid,
+                to_treenode_id, versions=arbor_versions)
 
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
@@ -1617,6 +1639,8 @@ def _import_skeleton(user, project_id, arborescence, neuron_id=None, name=None):
         WHERE treenode.id = v.id AND treenode.skeleton_id = %s
         """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
 
+    node_list_cache.invalidate_project(project_id)
+
     # Log import.
     insert_into_log(project_id, user.id, 'create_neuron',
                     new_location, 'Create neuron %d and skeleton '
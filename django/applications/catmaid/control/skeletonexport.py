@@ -1,16 +1,23 @@
 import json
 import logging
+import zlib
 import networkx as nx
+import numpy as np
 import pytz
-from itertools import imap
+from itertools import imap, groupby
+from operator import itemgetter
 from functools import partial
-from collections import defaultdict
-from math import sqrt
+from collections import defaultdict, namedtuple
+from contextlib import closing
 from datetime import datetime
+from decimal import Decimal
+from hashlib import sha1
 
+from django.conf import settings
+from django.core.cache import caches
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 
@@ -18,11 +25,11 @@ from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review
 from catmaid.control import export_NeuroML_Level3
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, get_request_list
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
 
-from tree_util import edge_count_to_root, partition
+from tree_util import edge_count_to_root, lazy_load_rows
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -107,9 +114,7 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
     tags = defaultdict(list)
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if 0 != with_connectors:
         # Fetch all connectors with their partner treenode IDs
@@ -178,77 +183,160 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     with_connectors  = int(with_connectors)
     with_tags = int(with_tags)
 
+    nodes, connectors, tags = _compact_arbors(project_id, [skeleton_id],
+            with_nodes, with_connectors, with_tags)[skeleton_id]
+
+    if 0 != with_nodes and 0 == len(nodes):
+        # Check if the skeleton exists
+        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
+            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+        # Otherwise returns an empty list of nodes
+
+    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+
+
+def _compact_arbors(project_id, skeleton_ids, with_nodes, with_connectors, with_tags):
+    """ Return a dictionary of skeleton ID vs a (nodes, connections, tags)
+    tuple like it is returned by compact_arbor() for every passed in skeleton.
+    Each kind of data is fetched with a single query for all skeletons. All
+    links of a connector are fetched once, even if it links many of the
+    skeletons, and connections are then built from these links.
+    """
     cursor = connection.cursor()
 
-    nodes = ()
-    connectors = []
-    tags = defaultdict(list)
+    skeleton_ids = set(skeleton_ids)
+    nodes = defaultdict(list)
+    connectors = defaultdict(list)
+    tags = defaultdict(lambda: defaultdict(list))
 
     if 0 != with_nodes:
         cursor.execute('''
-            SELECT id, parent_id, user_id,
+            SELECT skeleton_id, id, parent_id, user_id,
                 location_x, location_y, location_z,
                 radius, confidence
             FROM treenode
-            WHERE skeleton_id = %s
-        ''' % skeleton_id)
-
-        nodes = tuple(cursor.fetchall())
+            WHERE skeleton_id = ANY(%s::integer[])
+        ''', (list(skeleton_ids),))
 
-        if 0 == len(nodes):
-            # Check if the skeleton exists
-            if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-                raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
-            # Otherwise returns an empty list of nodes
+        for row in cursor.fetchall():
+            nodes[row[0]].append(row[1:])
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if 0 != with_connectors:
-        # Fetch all inputs and outputs
-
+        # Fetch all synaptic links of all connectors that are linked to any of
+        # the skeletons.
         pre = relations['presynaptic_to']
         post = relations['postsynaptic_to']
-
         cursor.execute('''
-            SELECT tc1.treenode_id, tc1.confidence,
-                   tc1.connector_id,
-                   tc2.confidence, tc2.treenode_id, tc2.skeleton_id,
-                   tc1.relation_id, tc2.relation_id
-            FROM treenode_connector tc1,
-                 treenode_connector tc2
-            WHERE tc1.skeleton_id = %s
-              AND tc1.id != tc2.id
-              AND tc1.connector_id = tc2.connector_id
-              AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-        ''' % (skeleton_id, pre, post))
-
-        for row in cursor.fetchall():
-            # Ignore all other kinds of relation pairs (there shouldn't be any)
-            if row[6] == pre and row[7] == post:
-                connectors.append((row[0], row[1], row[2], row[3], row[4], row[5], 0, 1))
-            elif row[6] == post and row[7] == pre:
-                connectors.append((row[0], row[1], row[2], row[3], row[4], row[5], 1, 0))
+            SELECT tc.connector_id, tc.id, tc.treenode_id, tc.confidence,
+                   tc.skeleton_id, tc.relation_id
+            FROM treenode_connector tc
+            WHERE tc.connector_id IN (
+                    SELECT connector_id
+                    FROM treenode_connector
+                    WHERE skeleton_id = ANY(%(skids)s::integer[])
+                      AND relation_id IN (%(pre)s, %(post)s))
+              AND tc.relation_id IN (%(pre)s, %(post)s)
+            ORDER BY tc.connector_id
+        ''', {'skids': list(skeleton_ids), 'pre': pre, 'post': post})
+
+        # The relation is 0 for pre and 1 for post
+        relation_index = {pre: 0, post: 1}
+        for connector_id, links in groupby(cursor.fetchall(), key=itemgetter(0)):
+            links = list(links)
+            for _, link_id, treenode_id, confidence, skid, relation_id in links:
+                if skid not in skeleton_ids:
+                    continue
+                for partner in links:
+                    # Only pairs of a pre- and a postsynaptic link are connections
+                    if partner[5] == relation_id:
+                        continue
+                    connectors[skid].append((treenode_id, confidence,
+                            connector_id, partner[3], partner[2], partner[4],
+                            relation_index[relation_id],
+                            relation_index[partner[5]]))
 
     if 0 != with_tags:
         # Fetch all node tags
         cursor.execute('''
-            SELECT c.name, tci.treenode_id
+            SELECT t.skeleton_id, c.name, tci.treenode_id
             FROM treenode t,
                  treenode_class_instance tci,
                  class_instance c
-            WHERE t.skeleton_id = %s
+            WHERE t.skeleton_id = ANY(%s::integer[])
               AND t.id = tci.treenode_id
               AND tci.relation_id = %s
               AND c.id = tci.class_instance_id
-        ''' % (skeleton_id, relations['labeled_as']))
+        ''', (list(skeleton_ids), relations['labeled_as']))
 
         for row in cursor.fetchall():
-            tags[row[0]].append(row[1])
+            tags[row[0]][row[1]].append(row[2])
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+    return {skid: (tuple(nodes[skid]), connectors[skid], tags[skid])
+            for skid in skeleton_ids}
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def compact_arbors(request, project_id=None):
+    """Get nodes, connections and tags of many skeletons at once.
+
+    For each skeleton, the result is the same as the one of the compact-arbor
+    endpoint: [[nodes], [connections], {nodeID: [tags]}]. Connectors shared by
+    many of the skeletons are looked up only once.
+    ---
+    parameters:
+      - name: skeleton_ids[]
+        description: IDs of the skeletons to get
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: with_nodes
+        description: Whether to include nodes (0 or 1)
+        required: false
+        type: integer
+        defaultValue: 1
+        paramType: form
+      - name: with_connectors
+        description: Whether to include connections (0 or 1)
+        required: false
+        type: integer
+        defaultValue: 1
+        paramType: form
+      - name: with_tags
+        description: Whether to include tags (0 or 1)
+        required: false
+        type: integer
+        defaultValue: 1
+        paramType: form
+    type:
+      '{skeleton_id}':
+        description: Nodes, connections and tags of the skeleton
+        type: array
+        required: true
+    """
+    project_id = int(project_id)
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+    with_nodes = int(request.POST.get('with_nodes', 1))
+    with_connectors = int(request.POST.get('with_connectors', 1))
+    with_tags = int(request.POST.get('with_tags', 1))
+
+    skeleton_ids = set(skeleton_ids)
+    existing = set(ClassInstance.objects.filter(project_id=project_id,
+            id__in=skeleton_ids).values_list('id', flat=True))
+    missing = skeleton_ids - existing
+    if missing:
+        raise ValueError("Skeletons don't exist: %s" % \
+                ", ".join(map(str, sorted(missing))))
+
+    return HttpResponse(json.dumps(_compact_arbors(project_id, skeleton_ids,
+            with_nodes, with_connectors, with_tags), separators=(',', ':')))
 
 
 @requires_user_role([UserRole.Browse])
@@ -322,8 +410,7 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
 
     if 0 == lean: # meaning not lean
         # Text tags
-        cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-        labeled_as = cursor.fetchall()[0][0]
+        labeled_as = get_relation_to_id_map(project_id, ('labeled_as',), cursor)['labeled_as']
 
         cursor.execute(
              ''' SELECT treenode_class_instance.treenode_id, class_instance.name
@@ -370,10 +457,104 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
     return name, nodes, tags, connectors, reviews
 
 
+def _skeleton_3d_cache():
+    """ Return the cache configured in SKELETON_3D_CACHE or None if 3D viewer
+    responses aren't cached. """
+    name = getattr(settings, 'SKELETON_3D_CACHE', None)
+    return caches[name] if name else None
+
+
+def _skeleton_3d_versions(skeleton_ids):
+    """ Return a dictionary of skeleton ID vs a version string, which changes
+    whenever the data returned by _skeleton_for_3d_viewer() for this skeleton
+    changes: its nodes (as seen by the version of the skeleton summary, which
+    changes with every treenode edit), connector links and connectors, tags,
+    reviews and neuron name. Edition times are taken from different
+    transactions and aren't guaranteed to increase with every edit, which is
+    why versions also include counts and sums of linked IDs. All versions are
+    computed with a single query. Skeletons without nodes are mapped to None.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT skid.id, s.version, s.num_reviewed_nodes, links.n, links.id_sum,
+               links.last_edition_time, labels.n, labels.id_sum,
+               labels.last_edition_time, reviews.n, reviews.last_review_time,
+               neuron.name, neuron.edition_time
+        FROM unnest(%s::integer[]) skid(id)
+        JOIN catmaid_skeleton_summary s
+            ON s.skeleton_id = skid.id
+        CROSS JOIN LATERAL (
+            SELECT count(*), sum(tc.connector_id + tc.relation_id),
+                   GREATEST(max(tc.edition_time), max(c.edition_time))
+            FROM treenode_connector tc
+            JOIN connector c
+                ON c.id = tc.connector_id
+            WHERE tc.skeleton_id = skid.id) links(n, id_sum, last_edition_time)
+        CROSS JOIN LATERAL (
+            SELECT count(*), sum(tci.class_instance_id + tci.treenode_id),
+                   max(tci.edition_time)
+            FROM treenode t
+            JOIN treenode_class_instance tci
+                ON tci.treenode_id = t.id
+            WHERE t.skeleton_id = skid.id) labels(n, id_sum, last_edition_time)
+        CROSS JOIN LATERAL (
+            SELECT count(*), max(r.review_time)
+            FROM review r
+            WHERE r.skeleton_id = skid.id) reviews(n, last_review_time)
+        LEFT JOIN LATERAL (
+            SELECT ci.name, ci.edition_time
+            FROM class_instance_class_instance cici
+            JOIN class_instance ci
+                ON ci.id = cici.class_instance_b
+            WHERE cici.class_instance_a = skid.id
+            LIMIT 1) neuron ON TRUE
+    ''', (list(skeleton_ids),))
+
+    versions = dict.fromkeys(skeleton_ids)
+    for row in cursor.fetchall():
+        fields = [f.isoformat() if isinstance(f, datetime) else
+                  str(f) if isinstance(f, Decimal) else f for f in row[1:]]
+        versions[row[0]] = sha1(json.dumps(fields)).hexdigest()
+    return versions
+
+
+def _cached_3d_viewer_response(project_id, skeleton_id, variant, encoding,
+        to_json):
+    """ Return an HttpResponse with the JSON encoded result of
+    _skeleton_for_3d_viewer(), with the passed in parameters and encoded by
+    <to_json>. If SKELETON_3D_CACHE is set, the encoded result is cached per
+    skeleton version and <encoding>, a name for to_json. The version is also
+    sent as ETag. """
+    skeleton_id = int(skeleton_id)
+    with_connectors, lean, all_field = variant
+    cache = _skeleton_3d_cache()
+    version = _skeleton_3d_versions([skeleton_id])[skeleton_id] if cache else None
+    if version:
+        key = 'catmaid-3d-skeleton:%d:%s:%d%d%d:%s' % (skeleton_id, encoding,
+                bool(with_connectors), 0 != lean, bool(all_field), version)
+        data = cache.get(key)
+        if data is None:
+            data = to_json(_skeleton_for_3d_viewer(skeleton_id, project_id,
+                    with_connectors, lean, all_field))
+            cache.set(key, data, settings.SKELETON_3D_CACHE_TIMEOUT)
+    else:
+        data = to_json(_skeleton_for_3d_viewer(skeleton_id, project_id,
+                with_connectors, lean, all_field))
+
+    response = HttpResponse(data)
+    if version:
+        response['ETag'] = '"%s"' % version
+    return response
+
+
 # DEPRECATED. Will be removed.
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_for_3d_viewer(request, project_id=None, skeleton_id=None):
-    return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=request.POST.get('with_connectors', True), lean=int(request.POST.get('lean', 0)), all_field=request.POST.get('all_fields', False)), separators=(',', ':')))
+    variant = (request.POST.get('with_connectors', True),
+            int(request.POST.get('lean', 0)),
+            request.POST.get('all_fields', False))
+    return _cached_3d_viewer_response(project_id, skeleton_id, variant,
+            'compact', lambda result: json.dumps(result, separators=(',', ':')))
 
 # DEPRECATED. Will be removed.
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -392,164 +573,205 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
             )
         return millis
 
-    return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, project_id, \
-        with_connectors=True, lean=0, all_field=True), separators=(',', ':'), default=default))
+    return _cached_3d_viewer_response(project_id, skeleton_id, (True, 0, True),
+            'metadata', lambda result: json.dumps(result, separators=(',', ':'), default=default))
+
 
-def _measure_skeletons(skeleton_ids):
+@api_view(['POST'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def skeleton_3d_versions(request, project_id=None):
+    """Get the current version of the 3D viewer data of many skeletons.
+
+    The version of a skeleton changes whenever its nodes, connectors, tags,
+    reviews or neuron name change. It is sent as ETag with the compact-json
+    and json representations of a skeleton, if SKELETON_3D_CACHE is
+    configured. Clients can compare versions to reload only changed
+    skeletons. Skeletons without nodes have a version of null.
+    ---
+    parameters:
+      - name: skeleton_ids[]
+        description: IDs of the skeletons to get versions for
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+    type:
+      '{skeleton_id}':
+        description: Current version of the skeleton
+        type: string
+        required: true
+    """
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+    skeleton_ids = ClassInstance.objects.filter(project_id=project_id,
+            id__in=skeleton_ids).values_list('id', flat=True)
+    return JsonResponse(_skeleton_3d_versions(list(skeleton_ids)))
+
+SkeletonMeasurements = namedtuple('SkeletonMeasurements', ['raw_cable',
+        'smooth_cable', 'principal_branch_cable', 'n_nodes', 'n_ends',
+        'n_branch', 'n_pre', 'n_post'])
+
+
+def _measure_skeletons(project_id, skeleton_ids):
+    """Measure cable lengths, node counts and synapse counts of the passed in
+    skeletons. The smoothed cable is measured after moving each slab node
+    towards the position of its neighbors, weighted by their distance. The
+    principal branch is the path from the node farthest away from the root (in
+    number of edges) to the root. All measurements are computed for all
+    skeletons at once on arrays of parent indices. Returns a dictionary that
+    maps skeleton IDs to SkeletonMeasurements.
+    """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
-    skids_string = ",".join(map(str, skeleton_ids))
-
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
+    SELECT id, COALESCE(parent_id, -1), skeleton_id,
+           location_x, location_y, location_z
     FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
-
-    # Count inputs
+    WHERE skeleton_id = ANY(%s::bigint[])
+    ''', (list(skeleton_ids),))
+    rows = cursor.fetchall()
+    if not rows:
+        return {}
+
+    data = np.array(rows, dtype=np.float64)
+    node_ids = data[:, 0].astype(np.int64)
+    parent_ids = data[:, 1].astype(np.int64)
+    measured_skeleton_ids, skeleton_index = np.unique(
+            data[:, 2].astype(np.int64), return_inverse=True)
+    positions = data[:, 3:6]
+    n_nodes = len(node_ids)
+    n_skeletons = len(measured_skeleton_ids)
+
+    # Find the index of each node's parent, -1 for root nodes. Each edge is
+    # represented by the index of its child and its parent node.
+    has_parent = parent_ids != -1
+    order = np.argsort(node_ids)
+    parents = np.full(n_nodes, -1, dtype=np.int64)
+    parents[has_parent] = order[np.searchsorted(node_ids,
+            parent_ids[has_parent], sorter=order)]
+    children = np.flatnonzero(has_parent)
+    edge_parents = parents[children]
+    edge_skeletons = skeleton_index[children]
+
+    def edge_lengths(p):
+        return np.sqrt(((p[children] - p[edge_parents]) ** 2).sum(axis=1))
+
+    raw_lengths = edge_lengths(positions)
+
+    # Count end nodes and branch nodes. A root node with one child is an end
+    # node, with two children it is in the middle of the skeleton.
+    n_children = np.bincount(edge_parents, minlength=n_nodes)
+    is_end = np.where(has_parent, n_children == 0, n_children == 1)
+    is_branch = np.where(has_parent, n_children > 1, n_children > 2)
+
+    # Compute weighted positions for slab nodes only (root, branch and end
+    # nodes do not move): 40% of their own position and 60% of the average
+    # position of their neighbors, weighted by the distance to them.
+    is_slab = ~(is_end | is_branch) & (n_children > 0)
+    neighbor_distance = np.bincount(children, weights=raw_lengths,
+            minlength=n_nodes) + np.bincount(edge_parents,
+            weights=raw_lengths, minlength=n_nodes)
+    weighted = np.empty_like(positions)
+    for d in xrange(3):
+        weighted[:, d] = np.bincount(children,
+                weights=positions[edge_parents, d] * raw_lengths,
+                minlength=n_nodes) + np.bincount(edge_parents,
+                weights=positions[children, d] * raw_lengths,
+                minlength=n_nodes)
+    # Nodes whose neighbors are all at the same location stay where they are
+    movable = is_slab & (neighbor_distance > 0)
+    smoothed = positions.copy()
+    smoothed[movable] = positions[movable] * 0.4 + 0.6 * \
+            weighted[movable] / neighbor_distance[movable, np.newaxis]
+
+    smooth_lengths = edge_lengths(smoothed)
+
+    # Find for each node the number of edges and the smoothed cable to the
+    # root by pointer jumping: each step adds up the values of a node and the
+    # node it currently points to, and lets it point to its target's target.
+    depth = has_parent.astype(np.int64)
+    cable_to_root = np.zeros(n_nodes)
+    cable_to_root[children] = smooth_lengths
+    jump = parents.copy()
+    active = children
+    while len(active):
+        targets = jump[active]
+        depth[active] += depth[targets]
+        cable_to_root[active] += cable_to_root[targets]
+        jump[active] = jump[targets]
+        active = active[jump[active] != -1]
+
+    # The principal branch runs from the deepest node of a skeleton to its
+    # root. Sorting by skeleton and depth puts the deepest node of each
+    # skeleton last in its skeleton's block.
+    order = np.lexsort((depth, skeleton_index))
+    deepest = order[np.append(np.flatnonzero(np.diff(skeleton_index[order])),
+            n_nodes - 1)]
+
+    raw_cable = np.bincount(edge_skeletons, weights=raw_lengths,
+            minlength=n_skeletons)
+    smooth_cable = np.bincount(edge_skeletons, weights=smooth_lengths,
+            minlength=n_skeletons)
+    principal_branch_cable = cable_to_root[deepest]
+    node_count = np.bincount(skeleton_index, minlength=n_skeletons)
+    end_count = np.bincount(skeleton_index[is_end], minlength=n_skeletons)
+    branch_count = np.bincount(skeleton_index[is_branch], minlength=n_skeletons)
+
+    # Count inputs (postsynaptic links of a skeleton) and outputs (the number
+    # of postsynaptic partner links on connectors a skeleton is presynaptic
+    # to) with a single query.
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'), cursor)
+    pre_id = relations.get('presynaptic_to', -1)
+    post_id = relations.get('postsynaptic_to', -1)
     cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
-    ''' % skids_string)
-
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
-
-    # Count outputs
-    cursor.execute('''
-    SELECT tc1.skeleton_id, count(tc1.skeleton_id)
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         relation r1,
-         relation r2
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = 'presynaptic_to'
-      AND tc2.relation_id = r2.id
-      AND r2.relation_name = 'postsynaptic_to'
-      GROUP BY tc1.skeleton_id
-    ''' % skids_string)
-
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
-
-    return skeletons
+    SELECT tc1.skeleton_id,
+           count(*) FILTER (WHERE tc1.relation_id = %(post)s),
+           COALESCE(sum(partners.n) FILTER (WHERE tc1.relation_id = %(pre)s), 0)
+    FROM treenode_connector tc1
+    CROSS JOIN LATERAL (
+        SELECT count(*)
+        FROM treenode_connector tc2
+        WHERE tc1.relation_id = %(pre)s
+          AND tc2.connector_id = tc1.connector_id
+          AND tc2.relation_id = %(post)s
+    ) partners(n)
+    WHERE tc1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+      AND tc1.relation_id IN (%(pre)s, %(post)s)
+    GROUP BY tc1.skeleton_id
+    ''', {
+        'pre': pre_id,
+        'post': post_id,
+        'skeleton_ids': measured_skeleton_ids.tolist(),
+    })
+    synapses = {row[0]: (int(row[1]), int(row[2])) for row in cursor.fetchall()}
+
+    measurements = {}
+    for i, skeleton_id in enumerate(measured_skeleton_ids.tolist()):
+        n_pre, n_post = synapses.get(skeleton_id, (0, 0))
+        measurements[skeleton_id] = SkeletonMeasurements(
+                raw_cable=float(raw_cable[i]),
+                smooth_cable=float(smooth_cable[i]),
+                principal_branch_cable=float(principal_branch_cable[i]),
+                n_nodes=int(node_count[i]),
+                n_ends=int(end_count[i]),
+                n_branch=int(branch_count[i]),
+                n_pre=n_pre,
+                n_post=n_post)
+
+    return measurements
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+    return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(project_id, skeleton_ids).iteritems()]))
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
@@ -708,6 +930,185 @@ def skeleton_swc(*args, **kwargs):
     return export_skeleton_response(*args, **kwargs)
 
 
+# Number of skeletons whose connectors and tags are fetched with a single query
+# when many skeletons are exported at once.
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_CONTENT_TYPES = {
+    'swc': 'text/plain',
+    'compact-json': 'application/x-ndjson',
+}
+
+
+def _export_swc(skeleton_ids):
+    """ Generate the SWC representation of each skeleton, preceded by a
+    comment line with its ID. """
+    columns = ('id', 'parent_id', 'location_x', 'location_y', 'location_z', 'radius')
+    with closing(lazy_load_rows(skeleton_ids, columns)) as skeletons:
+        for skid, rows in skeletons:
+            yield "# skeleton_id %s\n" % skid + "".join("%s 0 %s %s %s %s %s\n" % (
+                    node_id, x, y, z, max(radius, 0), -1 if parent_id is None else parent_id)
+                    for node_id, parent_id, x, y, z, radius in rows)
+
+
+def _export_compact_json(project_id, skeleton_ids, with_connectors, with_tags):
+    """ Generate one line of JSON per skeleton, which is a list of the
+    skeleton ID followed by nodes, connectors and tags like they are returned
+    by compact_skeleton(). Connectors and tags are fetched for
+    EXPORT_BATCH_SIZE skeletons at a time. """
+    cursor = connection.cursor()
+    relations = get_relation_to_id_map(project_id, cursor=cursor)
+    pre = relations['presynaptic_to']
+    post = relations['postsynaptic_to']
+    gj = relations.get('gapjunction_with', -1)
+    relation_index = {pre: 0, post: 1, gj: 2}
+    columns = ('id', 'parent_id', 'user_id', 'location_x', 'location_y',
+            'location_z', 'radius', 'confidence')
+
+    for offset in xrange(0, len(skeleton_ids), EXPORT_BATCH_SIZE):
+        batch = skeleton_ids[offset:offset + EXPORT_BATCH_SIZE]
+        connectors = defaultdict(list)
+        tags = defaultdict(lambda: defaultdict(list))
+
+        if with_connectors:
+            cursor.execute('''
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                       tc.relation_id, c.location_x, c.location_y, c.location_z
+                FROM treenode_connector tc
+                JOIN connector c
+                    ON c.id = tc.connector_id
+                WHERE tc.skeleton_id = ANY(%s::integer[])
+                  AND tc.relation_id = ANY(%s::integer[])
+            ''', (batch, [pre, post, gj]))
+            for row in cursor.fetchall():
+                connectors[row[0]].append((row[1], row[2],
+                        relation_index[row[3]], row[4], row[5], row[6]))
+
+        if with_tags:
+            cursor.execute('''
+                SELECT t.skeleton_id, c.name, tci.treenode_id
+                FROM treenode t
+                JOIN treenode_class_instance tci
+                    ON tci.treenode_id = t.id
+                JOIN class_instance c
+                    ON c.id = tci.class_instance_id
+                WHERE t.skeleton_id = ANY(%s::integer[])
+                  AND tci.relation_id = %s
+            ''', (batch, relations['labeled_as']))
+            for skid, name, treenode_id in cursor.fetchall():
+                tags[skid][name].append(treenode_id)
+
+        with closing(lazy_load_rows(batch, columns)) as skeletons:
+            for skid, rows in skeletons:
+                yield json.dumps((skid, tuple(rows), connectors.get(skid, ()),
+                        tags.get(skid, {})), separators=(',', ':')) + "\n"
+
+
+def export_skeletons(project_id, skeleton_ids, export_format,
+        with_connectors=False, with_tags=False):
+    """ Return a generator of strings that together form the export of all
+    passed in skeletons in either 'swc' or 'compact-json' format. Skeletons
+    are exported in ascending order of their ID, skeletons without nodes are
+    left out. Treenodes are read through a server-side cursor, which keeps
+    memory use bounded independent of the number of skeletons. The generator
+    has to be closed if it isn't consumed completely, e.g. if a client
+    disconnects, to close the cursor and end its transaction. """
+    skeleton_ids = sorted(set(skeleton_ids))
+    if 'swc' == export_format:
+        return _export_swc(skeleton_ids)
+    elif 'compact-json' == export_format:
+        return _export_compact_json(project_id, skeleton_ids, with_connectors,
+                with_tags)
+    else:
+        raise ValueError("Unknown export format: %s" % export_format)
+
+
+def gzip_chunks(chunks):
+    """ Compress a sequence of strings into a gzip stream, chunk by chunk.
+    Closing the returned generator closes <chunks>, if it can be closed. """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    yield compressor.flush()
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def export_skeletons_stream(request, project_id=None):
+    """Export many skeletons at once as SWC or compact JSON.
+
+    The response is streamed while treenodes are read from the database. In SWC
+    format, each skeleton's SWC representation is preceded by a comment line
+    "# skeleton_id <id>". In compact-json format, each line is a JSON list of
+    the skeleton ID, nodes, connectors and tags, like they are returned by the
+    compact-skeleton endpoint. Skeletons are returned in ascending order of
+    their ID.
+    ---
+    parameters:
+      - name: skeleton_ids[]
+        description: IDs of the skeletons to export
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: format
+        description: Either "swc" (default) or "compact-json"
+        required: false
+        type: string
+        paramType: form
+      - name: with_connectors
+        description: Whether compact JSON should include connectors
+        required: false
+        type: boolean
+        defaultValue: false
+        paramType: form
+      - name: with_tags
+        description: Whether compact JSON should include tags
+        required: false
+        type: boolean
+        defaultValue: false
+        paramType: form
+      - name: gzip
+        description: Whether the response should be gzip encoded
+        required: false
+        type: boolean
+        defaultValue: false
+        paramType: form
+    """
+    project_id = int(project_id)
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+    export_format = request.POST.get('format', 'swc')
+    if export_format not in EXPORT_CONTENT_TYPES:
+        raise ValueError("Unknown export format: %s" % export_format)
+    with_connectors = request.POST.get('with_connectors', 'false') == 'true'
+    with_tags = request.POST.get('with_tags', 'false') == 'true'
+    use_gzip = request.POST.get('gzip', 'false') == 'true'
+
+    skeleton_ids = ClassInstance.objects.filter(project_id=project_id,
+            id__in=skeleton_ids).values_list('id', flat=True)
+    chunks = export_skeletons(project_id, list(skeleton_ids), export_format,
+            with_connectors, with_tags)
+    if use_gzip:
+        chunks = gzip_chunks(chunks)
+
+    # Django closes the generator once the response is sent or the client
+    # disconnected, which closes the database cursor.
+    response = StreamingHttpResponse(chunks,
+            content_type=EXPORT_CONTENT_TYPES[export_format])
+    if use_gzip:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+
 def _export_review_skeleton(project_id=None, skeleton_id=None,
                             subarbor_node_id=None):
     """ Returns a list of segments for the requested skeleton. Each segment
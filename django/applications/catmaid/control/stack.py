@@ -13,6 +13,7 @@ from django.shortcuts import get_object_or_404
 from ..models import UserRole, Project, Stack, ProjectStack, \
         BrokenSlice, Overlay
 from .authentication import requires_user_role
+from . import metadata_cache
 
 logger = logging.getLogger(__name__)
 
@@ -25,8 +26,14 @@ except ImportError, e:
 def get_stack_info(project_id=None, stack_id=None):
     """ Returns a dictionary with relevant information for stacks.
     Depending on the tile_source_type, get information from database
-    or from tile server directly
+    or from tile server directly. The result is cached and must not be
+    modified.
     """
+    project_id, stack_id = int(project_id), int(stack_id)
+    return metadata_cache.get('stacks', 'info:%s:%s' % (project_id, stack_id),
+            lambda: _load_stack_info(project_id, stack_id))
+
+def _load_stack_info(project_id, stack_id):
     p = get_object_or_404(Project, pk=project_id)
     s = get_object_or_404(Stack, pk=stack_id)
     ps_all = ProjectStack.objects.filter(project=project_id, stack=stack_id)
@@ -50,18 +57,8 @@ def get_stack_info_response(p, s, ps, overlay_data, broken_slices):
 
     if int(s.tile_source_type) == 2:
         # request appropriate stack metadata from tile source
-        url = s.image_base.rstrip('/').lstrip('http://')
-        # Important: Do not use localhost, but 127.0.0.1 instead
-        # to prevent an namespace lookup error (gaierror)
-        # Important2: Do not put http:// in front!
-        conn = httplib.HTTPConnection(url)
-        conn.request('GET', '/metadata')
-        response = conn.getresponse()
-        # read JSON response according to metadata convention
-        # Tornado reponse is escaped JSON string
-        read_response = response.read()
-        # convert it back to dictionary str->dict
-        return json.loads(read_response)
+        return metadata_cache.get('remote', 'tile-source:' + s.image_base,
+                lambda: get_tile_source_metadata(s.image_base))
     else:
         overlays = []
         for ele in overlay_data:
@@ -110,6 +107,26 @@ def get_stack_info_response(p, s, ps, overlay_data, broken_slices):
 
     return result
 
+def get_tile_source_metadata(image_base):
+    """ Return the parsed metadata of a tile source that provides stack
+    metadata itself (tile source type 2).
+    """
+    url = image_base.rstrip('/').lstrip('http://')
+    # Important: Do not use localhost, but 127.0.0.1 instead
+    # to prevent an namespace lookup error (gaierror)
+    # Important2: Do not put http:// in front!
+    conn = httplib.HTTPConnection(url)
+    try:
+        conn.request('GET', '/metadata')
+        response = conn.getresponse()
+        # read JSON response according to metadata convention
+        # Tornado reponse is escaped JSON string
+        read_response = response.read()
+    finally:
+        conn.close()
+    # convert it back to dictionary str->dict
+    return json.loads(read_response)
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def list_stack_tags(request, project_id=None, stack_id=None):
     """ Return the tags associated with the stack.
@@ -194,6 +211,13 @@ def stacks(request, project_id=None):
     """ Returns a response containing the JSON object with menu information
     about the project's stacks.
     """
+    project_id = int(project_id)
+    info = metadata_cache.get('stacks', 'list:%s' % project_id,
+            lambda: _load_stacks(project_id))
+    return HttpResponse(json.dumps(info, sort_keys=True, indent=4),
+                        content_type="application/json")
+
+def _load_stacks(project_id):
     project = Project.objects.get(pk=project_id)
     info = []
     for stack in project.stacks.all():
@@ -202,5 +226,9 @@ def stacks(request, project_id=None):
             'pid': project.id,
             'title': stack.title,
             'comment': stack.comment})
-    return HttpResponse(json.dumps(info, sort_keys=True, indent=4),
-                        content_type="application/json")
+    return info
+
+def invalidate_stack_info_cache():
+    """ Remove all cached stack information and stack lists.
+    """
+    metadata_cache.invalidate('stacks')
@@ -1,102 +1,237 @@
 import numpy as np
-from numpy import array, float32
 from numpy.linalg import norm
-import networkx as nx
-from collections import namedtuple
-from scipy.sparse.csgraph import dijkstra
+from collections import deque, namedtuple
 
 from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import Arbor
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
 
 
 def synapse_clustering( skeleton_id, h_list ):
 
-    Gwud = createSpatialGraphFromSkeletonID( skeleton_id )
+    arbor = createArborFromSkeletonID( skeleton_id )
     synNodes, connector_ids, relations = synapseNodesFromSkeletonID( skeleton_id )
 
-    return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
+    return tree_max_density(arbor, synNodes, connector_ids, relations, h_list)
 
 
 def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+    """ Gwud: an Arbor with locations, or a networkx graph were the edges are
+        weighted by length, and undirected.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+
+        Gwud is expected to be a tree (or a forest), which allows computing
+        the synapse density of all nodes for all bandwidths in O(n*k) time,
+        with n being the number of nodes and k the number of synapse nodes.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
+    tree = _treeArrays( Gwud )
+    synIndices = np.array(sorted(set(tree.id2index[node] for node in synNodes)), dtype=np.int64)
+    density = densityField( tree, synIndices, h_list )
 
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+    for hi, h in enumerate(h_list):
+        # targLoc hosts the final destination nodes of the hill climbing
+        targLoc = hillClimb( tree, density[hi] )
 
         loc2group = {}
 
         synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
-            loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-
         for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
+            val = tree.nodeList[targLoc[tree.id2index[node]]]
+            gi = loc2group.get(val)
+            if gi is None:
+                gi = loc2group[val] = len(loc2group)
+                synapseGroups[h][gi] = SynapseGroup([], [], [], val)
             synapseGroups[h][ gi ].node_ids.append( node )
             synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
             synapseGroups[h][ gi ].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
+# Maximum number of distances (synapse nodes x nodes) that are computed at
+# once when evaluating density fields.
+DENSITY_BLOCK_SIZE = 2000000
+
+TreeArrays = namedtuple("TreeArrays", ['nodeList', 'id2index', 'parents',
+        'weights', 'rootDistances', 'components', 'pre', 'post', 'levels',
+        'indptr', 'indices'])
+
+def _treeArrays( G ):
+    """ Index the nodes of the tree (or forest) G, which is either an Arbor or
+    an undirected networkx graph whose edges are weighted by length. Nodes are
+    referred to by their index in nodeList. Each tree is rooted at a node for
+    which parents is -1, an arbitrary one for graphs. Weights hold the length
+    of the edge to the parent and rootDistances the path length to the root.
+    The nodes in the subtree of node i have a pre-order index in
+    [pre[i], post[i]). Levels lists the node indices by distance (in edges) to
+    their root and indptr/indices are the neighbours of all nodes as CSR. """
+    if isinstance(G, Arbor):
+        return _arborArrays( G )
+
     nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
+    id2index = {node: i for i, node in enumerate(nodeList)}
+    n = len(nodeList)
+
+    parents = np.full(n, -1, dtype=np.int64)
+    weights = np.zeros(n)
+    depths = np.zeros(n, dtype=np.int64)
+    seen = np.zeros(n, dtype=bool)
+
+    # Breadth-first traversal of each tree
+    for root in xrange(n):
+        if seen[root]:
+            continue
+        seen[root] = True
+        queue = deque([root])
+        while queue:
+            i = queue.popleft()
+            for nn, props in G[nodeList[i]].iteritems():
+                j = id2index[nn]
+                if not seen[j]:
+                    seen[j] = True
+                    parents[j] = i
+                    weights[j] = props.get('weight', 1)
+                    depths[j] = depths[i] + 1
+                    queue.append(j)
+
+    return _indexTree(nodeList, id2index, parents, weights, depths)
+
+def _arborArrays( arbor ):
+    """ Like _treeArrays, but for an Arbor, whose edge lengths are computed from
+    its locations, if any, without building a graph first. """
+    nodeList = tuple(arbor.node_ids.tolist())
+    id2index = {node: i for i, node in enumerate(nodeList)}
+    parents = arbor.parents
+    weights = np.ones(len(nodeList))
+    if arbor.locations is not None:
+        children = np.flatnonzero(parents != -1)
+        weights[children] = norm(arbor.locations[children] -
+                arbor.locations[parents[children]], axis=1)
+    return _indexTree(nodeList, id2index, parents, weights, arbor.depths())
+
+def _indexTree( nodeList, id2index, parents, weights, depths ):
+    """ Create the TreeArrays of a forest given as parent indices, the length
+    of the edge to the parent and the depth of each node. """
+    n = len(nodeList)
+    weights[parents == -1] = 0
+
+    byDepth = np.argsort(depths, kind='mergesort')
+    levels = np.split(byDepth, np.cumsum(np.bincount(depths))[:-1]) if n else []
+
+    # Path lengths and roots, accumulated from the roots down
+    rootDistances = np.zeros(n)
+    components = np.arange(n)
+    for level in levels[1:]:
+        rootDistances[level] = rootDistances[parents[level]] + weights[level]
+        components[level] = components[parents[level]]
+
+    # Subtree sizes, accumulated from the leaves up
+    sizes = np.ones(n, dtype=np.int64)
+    for level in reversed(levels[1:]):
+        np.add.at(sizes, parents[level], sizes[level])
+
+    # Pre-order intervals: children take consecutive slots after their parent
+    pre = np.zeros(n, dtype=np.int64)
+    nextSlot = np.zeros(n, dtype=np.int64)
+    offset = 0
+    for i in byDepth.tolist():
+        p = parents[i]
+        if p == -1:
+            pre[i] = offset
+            offset += sizes[i]
+        else:
+            pre[i] = nextSlot[p]
+            nextSlot[p] += sizes[i]
+        nextSlot[i] = pre[i] + 1
+    post = pre + sizes
+
+    children = np.flatnonzero(parents != -1)
+    src = np.concatenate((parents[children], children))
+    dst = np.concatenate((children, parents[children]))
+    bySource = np.argsort(src, kind='mergesort')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n))))
+    indices = dst[bySource]
+
+    return TreeArrays(nodeList, id2index, parents, weights, rootDistances,
+            components, pre, post, levels, indptr, indices)
+
+def _distanceBlock( tree, sources ):
+    """ Path lengths from all nodes to each of the node indices in sources, as
+    a n x len(sources) matrix, with infinity for nodes of other trees. Walking
+    down from the root, the distance to a child grows by the edge length,
+    unless the child lies on the path from the root to the source. """
+    D = np.empty((len(tree.nodeList), len(sources)))
+    sourcePre = tree.pre[sources]
+    roots = tree.levels[0]
+    D[roots] = np.where(
+            tree.components[roots][:, np.newaxis] == tree.components[sources],
+            tree.rootDistances[sources], np.inf)
+    for level in tree.levels[1:]:
+        onPath = (tree.pre[level][:, np.newaxis] <= sourcePre) & \
+                 (sourcePre < tree.post[level][:, np.newaxis])
+        w = tree.weights[level][:, np.newaxis]
+        D[level] = D[tree.parents[level]] + np.where(onPath, -w, w)
+    return D
+
+def densityField( tree, synIndices, h_list ):
+    """ Return a len(h_list) x n matrix with the density of synapse nodes at
+    every node of the tree for each bandwidth in h_list. Synapse nodes are
+    processed in blocks to limit memory use. """
+    scales = -1 / np.square(np.asarray(h_list, dtype=float))
+    n = len(tree.nodeList)
+    density = np.zeros((len(h_list), n))
+    blockSize = max(1, DENSITY_BLOCK_SIZE // max(1, n))
+    for start in xrange(0, len(synIndices), blockSize):
+        D2 = _distanceBlock( tree, synIndices[start:start + blockSize] )
+        np.multiply(D2, D2, out=D2)
+        expDh = np.empty_like(D2)
+        for hi, scale in enumerate(scales):
+            np.multiply(D2, scale, out=expDh)
+            np.exp(expDh, out=expDh)
+            density[hi] += expDh.sum(axis=1)
+    return density
+
+def hillClimb( tree, density ):
+    """ Return for every node the index of the node where hill climbing on the
+    density field ends, i.e. where no neighbour has a higher density. From
+    each node, the climb proceeds to the first neighbour of highest density. """
+    n = len(tree.nodeList)
+    targets = np.arange(n)
+    indptr, indices = tree.indptr, tree.indices
+    if len(indices):
+        degrees = np.diff(indptr)
+        nodes = np.flatnonzero(degrees)
+        starts = indptr[nodes]
+        neighbourDensity = density[indices]
+        maxDensity = np.maximum.reduceat(neighbourDensity, starts)
+        positions = np.where(neighbourDensity == np.repeat(maxDensity, degrees[nodes]),
+                np.arange(len(indices)), len(indices))
+        best = indices[np.minimum.reduceat(positions, starts)]
+        uphill = density[best] > density[nodes]
+        targets[nodes[uphill]] = best[uphill]
+
+    # Follow the uphill pointers until each node points to its local maximum
+    while True:
+        jumped = targets[targets]
+        if np.array_equal(jumped, targets):
+            return targets
+        targets = jumped
 
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
+def distanceMatrix( G, synNodes ):
+    """ Given a nx tree, produce an all to all distance matrix between synapse nodes
+     (rows) and all nodes (columns). Also, you get in 'id2index' the the mapping from
+     a node id to the column index in the matrix. """
+    tree = _treeArrays( G )
+    synNodes = set(synNodes)
+    synIndices = np.array([i for i, node in enumerate(tree.nodeList) if node in synNodes], dtype=np.int64)
 
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    return _distanceBlock( tree, synIndices ).T, tree.id2index
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -108,20 +243,11 @@ def countTargets( skeleton_id ):
             nTargets[cid] = TreenodeConnector.objects.filter(connector_id=cid,relation_id=PRE).count()
     return nTargets
 
-def createSpatialGraphFromSkeletonID(sid):
+def createArborFromSkeletonID(sid):
     # retrieve all nodes of the skeleton
     treenode_qs = Treenode.objects.filter(skeleton_id=sid).values_list(
         'id', 'parent_id', 'location_x', 'location_y', 'location_z')
-    # build the networkx graph from it
-    G = nx.Graph()
-    locations = {}
-    for tnid, parent_id, location_x, location_y, location_z in treenode_qs:
-        if parent_id:
-            G.add_edge(parent_id, tnid)
-        locations[tnid] = array((location_x, location_y, location_z), dtype=float32)
-    for iFrom, iTo in G.edges(data=False):
-        G[iFrom][iTo]['weight'] = norm(locations[iFrom] - locations[iTo])
-    return G
+    return Arbor.from_rows(treenode_qs)
 
 def synapseNodesFromSkeletonID(sid):
     sk = ClassInstance.objects.get(pk=sid)
@@ -1,10 +1,18 @@
 import os
 import cStringIO
+import shutil
+from collections import OrderedDict
 from contextlib import closing
+from threading import Lock
 import logging
 import numpy as np
 import base64
 from django.conf import settings
+from django.core.cache import cache, caches
+
+from celery.task import task
+
+from catmaid.control import label_store
 
 try:
     from PIL import Image
@@ -21,6 +29,118 @@ except ImportError, e:
 
 from django.http import HttpResponse
 
+# Open read-only HDF5 files, most recently used last. Keys are file paths,
+# values are (modification time, file) tuples. A file is reopened if it has
+# been modified since it was opened. Files removed from the pool are closed
+# by h5py once no request uses them anymore.
+_files = OrderedDict()
+_files_lock = Lock()
+
+# Chunks read from HDF5 datasets, most recently used last. Keys are (file
+# path, modification time, dataset path, chunk row, chunk column) tuples,
+# values are NumPy arrays.
+_chunks = OrderedDict()
+_chunks_size = 0
+_chunks_lock = Lock()
+
+# Scale levels are added to a pyramid until the largest dimension of a level
+# is at most PYRAMID_MIN_SIZE pixels. Their datasets are chunked in tiles of
+# PYRAMID_CHUNK_SIZE pixels and built in bands of PYRAMID_BAND_SIZE rows.
+PYRAMID_MIN_SIZE = 256
+PYRAMID_CHUNK_SIZE = 256
+PYRAMID_BAND_SIZE = 2048
+PYRAMID_LOCK_EXPIRE = 60 * 60
+# If the build task can't be started, e.g. because no broker is reachable, it
+# is tried again after PYRAMID_RETRY_INTERVAL seconds at the earliest.
+PYRAMID_RETRY_INTERVAL = 60
+
+
+def get_hdf5_path(project_id, stack_id, basename):
+    return os.path.join(settings.HDF5_STORAGE_PATH,
+            '{0}_{1}_{2}.hdf'.format(project_id, stack_id, basename))
+
+def _tile_cache():
+    """ Return the cache configured in HDF5_TILE_CACHE or None if encoded
+    tiles aren't cached. """
+    name = getattr(settings, 'HDF5_TILE_CACHE', None)
+    return caches[name] if name else None
+
+def _open_file(fpath):
+    """ Return a (modification time, file) tuple of the read-only HDF5 file at
+    the passed in path, which is taken from the pool of open files if it
+    hasn't been modified since it was opened.
+    """
+    mtime = os.path.getmtime(fpath)
+    with _files_lock:
+        entry = _files.pop(fpath, None)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, h5py.File(fpath, 'r'))
+        _files[fpath] = entry
+        while len(_files) > max(settings.HDF5_FILE_HANDLES, 1):
+            _files.popitem(last=False)
+        return entry
+
+def _get_chunk(dataset, key, y, x, height, width):
+    """ Return the chunk of a dataset at the passed in position, from the
+    chunk cache if possible. """
+    global _chunks_size
+    chunk_key = key + (y, x)
+    with _chunks_lock:
+        chunk = _chunks.pop(chunk_key, None)
+        if chunk is not None:
+            _chunks[chunk_key] = chunk
+            return chunk
+    chunk = dataset[y:min(y + height, dataset.shape[0]),
+                    x:min(x + width, dataset.shape[1])]
+    with _chunks_lock:
+        if chunk_key not in _chunks:
+            _chunks[chunk_key] = chunk
+            _chunks_size += chunk.nbytes
+        while _chunks_size > settings.HDF5_CHUNK_CACHE_SIZE and _chunks:
+            _, evicted = _chunks.popitem(last=False)
+            _chunks_size -= evicted.nbytes
+    return chunk
+
+def read_region(dataset, key, y, x, height, width):
+    """ Return a region of a 2D dataset as NumPy array of the requested size,
+    parts outside of the dataset are zero. Chunked datasets are read a whole
+    chunk at a time and chunks are cached per process, up to
+    HDF5_CHUNK_CACHE_SIZE bytes, so that neighboring tiles don't read them
+    again. <key> is a tuple that identifies the dataset in the chunk cache.
+    """
+    region = np.zeros((height, width), dtype=dataset.dtype)
+    y0, x0 = max(y, 0), max(x, 0)
+    y1 = min(y + height, dataset.shape[0])
+    x1 = min(x + width, dataset.shape[1])
+    if y1 <= y0 or x1 <= x0:
+        return region
+
+    if not dataset.chunks or settings.HDF5_CHUNK_CACHE_SIZE <= 0:
+        region[y0 - y:y1 - y, x0 - x:x1 - x] = dataset[y0:y1, x0:x1]
+        return region
+
+    chunk_height, chunk_width = dataset.chunks[:2]
+    for cy in xrange(y0 - y0 % chunk_height, y1, chunk_height):
+        for cx in xrange(x0 - x0 % chunk_width, x1, chunk_width):
+            chunk = _get_chunk(dataset, key, cy, cx, chunk_height, chunk_width)
+            # Copy the intersection of chunk and region
+            iy0, iy1 = max(cy, y0), min(cy + chunk_height, y1)
+            ix0, ix1 = max(cx, x0), min(cx + chunk_width, x1)
+            region[iy0 - y:iy1 - y, ix0 - x:ix1 - x] = \
+                    chunk[iy0 - cy:iy1 - cy, ix0 - cx:ix1 - cx]
+    return region
+
+def _encode_tile(data, width, height):
+    pilImage = Image.frombuffer('RGBA', (width, height),
+            np.ascontiguousarray(data), 'raw', 'L', 0, 1)
+    output = cStringIO.StringIO()
+    pilImage.save(output, "PNG")
+    return output.getvalue()
+
+def _empty_tile(width, height):
+    return HttpResponse(_encode_tile(np.zeros((height, width)), width, height),
+            content_type="image/png")
+
 def get_tile(request, project_id=None, stack_id=None):
 
     scale = float(request.GET.get('scale', '0'))
@@ -34,36 +154,152 @@ def get_tile(request, project_id=None, stack_id=None):
     file_extension = request.GET.get('file_extension', 'png')
     basename = request.GET.get('basename', 'raw')
 
+    # Labels are read from the dataset put_tile() writes to, including strokes
+    # that are queued in this process. Stacks without painted labels of this
+    # scale level use the label file instead.
+    if basename == 'labels':
+        data = label_store.read(project_id, stack_id, scale, z, y, x,
+                height, width)
+        if data is not None:
+            return HttpResponse(_encode_tile(data, width, height),
+                    content_type="image/png")
+
     # need to know the stack name
-    fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
+    fpath = get_hdf5_path(project_id, stack_id, basename)
 
     if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
+        return _empty_tile(width, height)
         # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
 
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    mtime, hfile = _open_file(fpath)
+
+    # Encoded tiles are cached per version of the file
+    tile_cache = _tile_cache()
+    if tile_cache:
+        cache_key = 'hdf5-tile-{0}-{1}-{2}-{3}-{4}-{5}-{6}-{7}-{8}-{9}'.format(
+                project_id, stack_id, basename, int(scale), z, x, y, width,
+                height, mtime)
+        tile = tile_cache.get(cache_key)
+        if tile is not None:
+            return HttpResponse(tile, content_type="image/png")
+
+    scale_name = str(int(scale))
+    if not scale_name in hfile['/'].keys():
+        # Missing scale levels are built in the background
+        if needs_pyramid_levels(hfile):
+            build_pyramid(project_id, stack_id, basename)
+        return _empty_tile(width, height)
+        # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
+
+    hdfpath = '/' + scale_name + '/' + str(z) + '/data'
+    if not hdfpath in hfile:
+        return _empty_tile(width, height)
+    data = read_region(hfile[hdfpath], (fpath, mtime, hdfpath), y, x,
+            height, width)
+    tile = _encode_tile(data, width, height)
+    if tile_cache:
+        tile_cache.set(cache_key, tile, settings.HDF5_TILE_CACHE_TIMEOUT)
+
+    return HttpResponse(tile, content_type="image/png")
+
+def _get_scales(hfile):
+    return sorted(int(s) for s in hfile['/'].keys() if s.isdigit())
+
+def needs_pyramid_levels(hfile):
+    """ Return whether the largest dimension of the highest scale level of an
+    HDF5 file is larger than PYRAMID_MIN_SIZE. """
+    scales = _get_scales(hfile)
+    if not scales:
+        return False
+    level = hfile[str(scales[-1])]
+    return any(max(level[z]['data'].shape) > PYRAMID_MIN_SIZE
+            for z in level.keys())
+
+def downsample(data, average=True):
+    """ Halve width and height of a 2D array, either by averaging blocks of
+    2x2 pixels or by taking every second pixel, which is needed for e.g.
+    labels. """
+    if not average:
+        return data[::2, ::2]
+    height, width = data.shape
+    padded = np.pad(data, ((0, height % 2), (0, width % 2)), mode='edge')
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    result = blocks.mean(axis=(1, 3))
+    if np.issubdtype(data.dtype, np.integer):
+        result = np.round(result)
+    return result.astype(data.dtype)
+
+def add_pyramid_levels(hfile, average=True):
+    """ Add scale levels to an HDF5 file with 2D datasets /<scale>/<z>/data
+    until the largest dimension of the highest level is at most
+    PYRAMID_MIN_SIZE. Each level is computed from the previous one, a band of
+    rows at a time. Returns the number of added levels. """
+    added = 0
+    while needs_pyramid_levels(hfile):
+        scale = _get_scales(hfile)[-1]
+        source = hfile[str(scale)]
+        target = hfile.create_group(str(scale + 1))
+        for z in source.keys():
+            source_data = source[z]['data']
+            height, width = source_data.shape
+            shape = ((height + 1) // 2, (width + 1) // 2)
+            target_data = target.create_group(z).create_dataset('data',
+                    shape=shape, dtype=source_data.dtype,
+                    chunks=(min(PYRAMID_CHUNK_SIZE, shape[0]),
+                            min(PYRAMID_CHUNK_SIZE, shape[1])))
+            for band in xrange(0, height, PYRAMID_BAND_SIZE):
+                data = downsample(source_data[band:band + PYRAMID_BAND_SIZE],
+                        average)
+                target_data[band // 2:band // 2 + data.shape[0]] = data
+        added += 1
+    return added
+
+def create_pyramid_lock_name(fpath):
+    """ Creates a name for the pyramid build lock.
+    """
+    return "%s-lock-%s" % ('catmaid.build_hdf5_pyramid', fpath)
+
+def build_pyramid(project_id, stack_id, basename):
+    """ Tries to acquire a lock for building the missing scale levels of an
+    HDF5 file. If able to do this, launches the celery task which removes the
+    lock when done. Returns whether the task was launched.
+    """
+    lock_id = create_pyramid_lock_name(get_hdf5_path(project_id, stack_id,
+            basename))
+    # cache.add fails if the key is already exists
+    if not cache.add(lock_id, "true", PYRAMID_LOCK_EXPIRE):
+        return False
+    try:
+        build_pyramid_task.delay(project_id, stack_id, basename)
+    except Exception:
+        # Tiles are served without the missing scale levels. Keeping the lock
+        # for a while prevents every tile request from waiting for the broker.
+        logger.exception("Couldn't launch the pyramid build for %s" % lock_id)
+        cache.set(lock_id, "true", PYRAMID_RETRY_INTERVAL)
+        return False
+    return True
+
+@task(name='catmaid.build_hdf5_pyramid')
+def build_pyramid_task(project_id, stack_id, basename):
+    """ Adds the missing scale levels to a copy of an HDF5 file, which then
+    replaces the original. Tiles are served from the original file until then.
+    Label pyramids take every second pixel, all others are averaged.
+    """
+    fpath = get_hdf5_path(project_id, stack_id, basename)
+    lock_id = create_pyramid_lock_name(fpath)
+    temp_path = fpath + '.pyramid'
+    try:
+        # Copy without meta data, the modification time marks the new version
+        shutil.copyfile(fpath, temp_path)
+        with closing(h5py.File(temp_path, 'a')) as hfile:
+            added = add_pyramid_levels(hfile, basename != 'labels')
+        os.rename(temp_path, fpath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        cache.delete(lock_id)
+
+    return "Added %s scale levels to %s" % (added, fpath)
 
 def put_tile(request, project_id=None, stack_id=None):
     """ Store labels to HDF5 """
@@ -78,11 +314,9 @@ def put_tile(request, project_id=None, stack_id=None):
     row = request.POST.get('row', 'x')
     image = request.POST.get('image', 'x')
 
-    fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
-
-    with closing(h5py.File(fpath, 'a')) as hfile:
-        hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
-        image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
-        hfile[hdfpath][y:y+height,x:x+width,z] = image_from_canvas[:,:,0]
+    # Strokes are queued and written in batches
+    image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
+    label_store.put(project_id, stack_id, scale, z, y, x,
+            np.ascontiguousarray(image_from_canvas[:height,:width,0]))
 
     return HttpResponse("Image pushed to HDF5.", content_type="plain/text")
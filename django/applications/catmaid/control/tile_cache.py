@@ -0,0 +1,131 @@
+import errno
+import hashlib
+import os
+import tempfile
+
+from threading import Lock
+
+from django.conf import settings
+
+
+# Tiles are stored as one file per tile URL, named after the URL's SHA-1 hash
+# in a sub-directory of its first two characters. The modification time of a
+# file is its last use, which makes the cache a least recently used cache that
+# is shared by all processes of a server, e.g. web server and Celery workers.
+# Each process keeps an estimate of the cache size, which is updated by a
+# directory scan once it exceeds TILE_CACHE_SIZE.
+_cache_size = None
+_cache_size_lock = Lock()
+
+# Prefix of files that are currently written
+_temp_prefix = '.tmp'
+
+
+def is_enabled():
+    return getattr(settings, 'TILE_CACHE_SIZE', 0) > 0
+
+
+def get_cache_directory():
+    return os.path.join(settings.MEDIA_ROOT,
+            settings.MEDIA_TILE_CACHE_SUBDIRECTORY)
+
+
+def _cache_path(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    key = hashlib.sha1(url).hexdigest()
+    return os.path.join(get_cache_directory(), key[:2], key)
+
+
+def get(url):
+    """Return the cached data of the tile at <url> or None if it isn't
+    cached.
+    """
+    if not is_enabled():
+        return None
+    path = _cache_path(url)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Mark as recently used
+        os.utime(path, None)
+    except (IOError, OSError):
+        return None
+    return data
+
+
+def put(url, data):
+    """Store the data of the tile at <url>. Caching is done on a best effort
+    basis, errors like a full disk are ignored.
+    """
+    if not is_enabled() or len(data) > settings.TILE_CACHE_SIZE:
+        return
+    path = _cache_path(url)
+    directory = os.path.dirname(path)
+    try:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first, so that other processes never read
+        # partially written tiles.
+        fd, temp_path = tempfile.mkstemp(prefix=_temp_prefix, dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        return
+    _add_to_size(len(data))
+
+
+def _scan():
+    """Return a list of (last use, size, path) tuples of all cached tiles."""
+    entries = []
+    for root, dirs, files in os.walk(get_cache_directory()):
+        for name in files:
+            if name.startswith(_temp_prefix):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _add_to_size(size):
+    global _cache_size
+    with _cache_size_lock:
+        if _cache_size is None:
+            _cache_size = sum(e[1] for e in _scan())
+        else:
+            _cache_size += size
+        if _cache_size > settings.TILE_CACHE_SIZE:
+            _cache_size = evict(int(0.9 * settings.TILE_CACHE_SIZE))
+
+
+def evict(max_size):
+    """Remove least recently used tiles until the cache is not larger than
+    <max_size> bytes and return the size of the remaining tiles.
+    """
+    entries = sorted(_scan())
+    size = sum(e[1] for e in entries)
+    for _, entry_size, path in entries:
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
+    return size
+
+
+def clear():
+    """Remove all cached tiles."""
+    global _cache_size
+    with _cache_size_lock:
+        _cache_size = evict(0)
@@ -3,10 +3,18 @@
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
+from contextlib import closing
 from math import sqrt
-from itertools import izip, islice
+from itertools import izip, islice, groupby
+import numpy as np
+from uuid import uuid4
+from django.db import connection, transaction
 from catmaid.models import Treenode
 
+# Number of treenodes that are fetched per round trip when trees are loaded
+# lazily through a server-side cursor.
+TREENODE_FETCH_SIZE = 10000
+
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
@@ -189,37 +197,398 @@ def cable_length(tree, locations):
     return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
 
 
-def lazy_load_trees(skeleton_ids, node_properties):
+class Arbor(object):
+    """ A compact, array based representation of a tree. Nodes are stored by
+    index: node_ids[i] is the ID of the node at index i, parents[i] is the index
+    of its parent (-1 for the root) and, if available, locations[i] its (x, y, z)
+    position. The children of the node at index i are stored in compressed
+    sparse row form and are available as
+    children[child_offsets[i]:child_offsets[i+1]]. Unlike a DiGraph, an Arbor
+    needs only a few bytes per node and allows most queries to be answered with
+    vectorized operations. Use to_digraph() for code that expects a tree in the
+    networkx form used by the other functions in this module. """
+
+    __slots__ = ('node_ids', 'parents', 'locations', '_sorter', '_children',
+            '_child_offsets', '_depths')
+
+    def __init__(self, node_ids, parent_ids, locations=None):
+        """ node_ids and parent_ids are sequences of equal length, the parent ID
+        of the root is expected to be None or -1. The optional locations are a
+        sequence of (x, y, z) positions in the same order. """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64).reshape(-1)
+        self._sorter = np.argsort(self.node_ids, kind='mergesort')
+        parent_ids = np.array([-1 if p is None else p for p in parent_ids],
+                dtype=np.int64).reshape(-1)
+        if len(parent_ids) != len(self.node_ids):
+            raise ValueError("Need exactly one parent ID per node")
+        self.parents = np.full(len(self.node_ids), -1, dtype=np.int64)
+        has_parent = parent_ids != -1
+        self.parents[has_parent] = self.indices(parent_ids[has_parent])
+        if locations is None:
+            self.locations = None
+        else:
+            self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self._invalidate()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Create a new Arbor from an iterable of (id, parent_id) or
+        (id, parent_id, x, y, z) rows, like they are returned by a query on the
+        treenode table. """
+        rows = list(rows)
+        node_ids = [row[0] for row in rows]
+        parent_ids = [row[1] for row in rows]
+        locations = [row[2:5] for row in rows] if rows and len(rows[0]) > 4 else None
+        return cls(node_ids, parent_ids, locations)
+
+    @classmethod
+    def from_digraph(cls, tree, locations=None):
+        """ Create a new Arbor from a DiGraph with edges from parent to child.
+        locations: an optional dictionary of node ID vs (x, y, z). """
+        node_ids = tree.nodes()
+        parent_ids = [next(tree.predecessors_iter(node), None) for node in node_ids]
+        if locations:
+            locations = [locations[node] for node in node_ids]
+        return cls(node_ids, parent_ids, locations)
+
+    def to_digraph(self):
+        """ Return a DiGraph with edges from parent to child, as expected by
+        the other functions of this module. If locations are available, they
+        are stored as node properties location_x, location_y and location_z. """
+        tree = DiGraph()
+        node_ids = self.node_ids.tolist()
+        if self.locations is None:
+            tree.add_nodes_from(node_ids)
+        else:
+            for node_id, (x, y, z) in izip(node_ids, self.locations.tolist()):
+                tree.add_node(node_id, {'location_x': x, 'location_y': y,
+                        'location_z': z})
+        has_parent = self.parents != -1
+        tree.add_edges_from(izip(self.node_ids[self.parents[has_parent]].tolist(),
+                self.node_ids[has_parent].tolist()))
+        return tree
+
+    def copy(self):
+        """ Return a copy that can be rerooted without affecting this arbor. """
+        arbor = Arbor.__new__(Arbor)
+        arbor.node_ids = self.node_ids
+        arbor._sorter = self._sorter
+        arbor.parents = self.parents.copy()
+        arbor.locations = self.locations
+        arbor._invalidate()
+        return arbor
+
+    def _invalidate(self):
+        self._children = None
+        self._child_offsets = None
+        self._depths = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        if 0 == len(self.node_ids):
+            return False
+        i = np.searchsorted(self.node_ids, node_id, sorter=self._sorter)
+        return i < len(self.node_ids) and self.node_ids[self._sorter[i]] == node_id
+
+    def indices(self, node_ids):
+        """ Return an array with the indices of the passed in node IDs. Raises
+        a ValueError if any of the nodes is not part of this arbor. """
+        node_ids = np.asarray(node_ids, dtype=np.int64).reshape(-1)
+        if 0 == len(node_ids):
+            return np.zeros(0, dtype=np.int64)
+        if 0 == len(self.node_ids):
+            raise ValueError("Nodes not part of arbor: %s" % node_ids.tolist())
+        positions = np.searchsorted(self.node_ids, node_ids, sorter=self._sorter)
+        indices = self._sorter[np.minimum(positions, len(self.node_ids) - 1)]
+        missing = self.node_ids[indices] != node_ids
+        if missing.any():
+            raise ValueError("Nodes not part of arbor: %s" % \
+                    node_ids[missing].tolist())
+        return indices
+
+    def index(self, node_id):
+        return int(self.indices([node_id])[0])
+
+    def _update_children(self):
+        if self._children is not None:
+            return
+        n_nodes = len(self.node_ids)
+        has_parent = np.flatnonzero(self.parents != -1)
+        order = np.argsort(self.parents[has_parent], kind='mergesort')
+        self._children = has_parent[order]
+        counts = np.bincount(self.parents[has_parent], minlength=n_nodes)
+        self._child_offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._child_offsets[1:])
+
+    def child_counts(self):
+        """ Return an array with the number of children of each node. """
+        self._update_children()
+        return np.diff(self._child_offsets)
+
+    def children(self, node_id):
+        """ Return a list of the IDs of the children of the passed in node. """
+        self._update_children()
+        i = self.index(node_id)
+        start, end = self._child_offsets[i], self._child_offsets[i + 1]
+        return self.node_ids[self._children[start:end]].tolist()
+
+    def parent(self, node_id):
+        """ Return the ID of the parent of the passed in node, or None if it is
+        the root. """
+        parent = self.parents[self.index(node_id)]
+        return None if -1 == parent else int(self.node_ids[parent])
+
+    def parent_ids(self):
+        """ Return an array with the parent ID of each node, -1 for the root. """
+        parent_ids = np.full(len(self.node_ids), -1, dtype=np.int64)
+        has_parent = self.parents != -1
+        parent_ids[has_parent] = self.node_ids[self.parents[has_parent]]
+        return parent_ids
+
+    def find_root(self):
+        roots = np.flatnonzero(self.parents == -1)
+        return int(self.node_ids[roots[0]]) if len(roots) else None
+
+    def downstream(self, node_id):
+        """ Return a boolean array that is True for the passed in node and all
+        nodes downstream of it. """
+        start = self.index(node_id)
+        depths = self.depths()
+        is_downstream = np.zeros(len(self.node_ids), dtype=np.bool_)
+        is_downstream[start] = True
+        for level in self._levels()[depths[start] + 1:]:
+            is_downstream[level] = is_downstream[self.parents[level]]
+        return is_downstream
+
+    def depths(self):
+        """ Return an array with the number of edges between each node and the
+        root. Computed by pointer jumping, which needs only a logarithmic number
+        of vectorized passes over the parent array. """
+        if self._depths is None:
+            depths = (self.parents != -1).astype(np.int64)
+            jump = self.parents.copy()
+            active = np.flatnonzero(jump != -1)
+            while len(active):
+                targets = jump[active]
+                depths[active] += depths[targets]
+                jump[active] = jump[targets]
+                active = active[jump[active] != -1]
+            self._depths = depths
+        return self._depths
+
+    def _levels(self):
+        """ Return a list of index arrays, one for each depth level, starting
+        with the level of the root. """
+        depths = self.depths()
+        if 0 == len(depths):
+            return []
+        order = np.argsort(depths, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(depths[order])) + 1
+        return np.split(order, bounds)
+
+    def edge_count_to_root(self):
+        """ Return a map of node ID vs number of edges to the root plus one,
+        i.e. the root has a value of 1 like in the edge_count_to_root()
+        function of this module. """
+        return dict(izip(self.node_ids.tolist(), (self.depths() + 1).tolist()))
+
+    def subtree_sums(self, weights):
+        """ Return an array with the sum of the passed in per node weights over
+        the subtree of each node, the node itself included. """
+        sums = np.array(weights, dtype=np.float64)
+        for level in reversed(self._levels()[1:]):
+            np.add.at(sums, self.parents[level], sums[level])
+        return sums
+
+    def subtree_sizes(self):
+        """ Return an array with the number of nodes in the subtree of each
+        node, the node itself included. """
+        return self.subtree_sums(np.ones(len(self.node_ids))).astype(np.int64)
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from new_root to
+        the root. """
+        path = [self.index(new_root)]
+        parents = self.parents
+        parent = parents[path[0]]
+        if -1 == parent:
+            # new_root is already the root
+            return
+        while parent != -1:
+            path.append(parent)
+            parent = parents[parent]
+        path = np.array(path, dtype=np.int64)
+        parents[path[1:]] = path[:-1]
+        parents[path[0]] = -1
+        self._invalidate()
+
+    def find_common_ancestor(self, node_ids):
+        """ Return the nearest common ancestor of all passed in nodes as a tuple
+        of its node ID and its number of edges to the root. """
+        indices = self.indices(node_ids)
+        if 0 == len(indices):
+            raise ValueError("Need at least one node")
+        depths = self.depths()
+        current = np.unique(indices)
+        current_depths = depths[current]
+        target = current_depths.min()
+        # Bring all nodes to the same depth, then walk up together
+        while (current_depths > target).any():
+            deeper = current_depths > target
+            current[deeper] = self.parents[current[deeper]]
+            current_depths[deeper] -= 1
+            current = np.unique(current)
+            current_depths = depths[current]
+        while len(current) > 1:
+            current = np.unique(self.parents[current])
+        return int(self.node_ids[current[0]]), int(depths[current[0]])
+
+    def partition(self):
+        """ Partition the arbor as a list of sequences of node IDs, like the
+        partition() function of this module. Each sequence runs from an end
+        node to either the root or a branch node. """
+        ends = np.flatnonzero(self.child_counts() == 0)
+        ends = ends[np.argsort(-self.depths()[ends], kind='mergesort')]
+        node_ids = self.node_ids.tolist()
+        parents = self.parents.tolist()
+        seen = [False] * len(node_ids)
+        for end in ends.tolist():
+            sequence = [node_ids[end]]
+            parent = parents[end]
+            while parent != -1:
+                sequence.append(node_ids[parent])
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parents[parent]
+
+            if len(sequence) > 1:
+                yield sequence
+
+    def cable_length(self):
+        """ Return the sum of the lengths of all edges. Needs locations. """
+        if self.locations is None:
+            raise ValueError("Arbor has no locations")
+        has_parent = self.parents != -1
+        deltas = self.locations[has_parent] - \
+                self.locations[self.parents[has_parent]]
+        return float(np.sqrt((deltas * deltas).sum(axis=1)).sum())
+
+    def simplify(self, keepers):
+        """ Like simplify() of this module: return a new undirected Graph in which
+        only the nodes to keep and the branch points between them are preserved.
+        This arbor itself is not modified. """
+        keeper_indices = np.unique(self.indices(list(keepers)))
+        mini = Graph()
+        mini.add_nodes_from(self.node_ids[keeper_indices].tolist())
+        if len(keeper_indices) < 2:
+            return mini
+
+        arbor = self.copy()
+        arbor.reroot(self.node_ids[keeper_indices[0]])
+        parents = arbor.parents
+        is_keeper = np.zeros(len(arbor), dtype=np.bool_)
+        is_keeper[keeper_indices] = True
+        # A branch node is preserved if keepers are downstream of more
+        # than one of its children.
+        has_keepers = arbor.subtree_sums(is_keeper) > 0
+        upstream = parents[has_keepers & (parents != -1)]
+        is_mini = is_keeper | (np.bincount(upstream, minlength=len(arbor)) > 1)
+        # Find the nearest preserved ancestor of each node
+        nearest = np.full(len(arbor), -1, dtype=np.int64)
+        for level in arbor._levels()[1:]:
+            level_parents = parents[level]
+            nearest[level] = np.where(is_mini[level_parents], level_parents,
+                    nearest[level_parents])
+        connected = np.flatnonzero(is_mini & (nearest != -1))
+        mini.add_edges_from(izip(self.node_ids[connected].tolist(),
+                self.node_ids[nearest[connected]].tolist()))
+        return mini
+
+
+def _stream_skeleton_rows(skeleton_ids, columns, fetch_size):
+    """ Return a lazy collection of pairs of (skeleton_id, rows), where rows
+    is an iterator over the requested treenode columns of all nodes of the
+    skeleton. The rows of a skeleton have to be consumed before the next pair
+    is requested. Treenodes are read through a server-side cursor in batches of
+    fetch_size rows, which keeps memory use bounded by the size of the largest
+    skeleton rather than by the size of all of them. The cursor and the
+    transaction it lives in stay open until the generator is exhausted or
+    closed, consumers that stop early have to close it. """
+    valid_columns = set(f.column for f in Treenode._meta.concrete_fields)
+    unknown_columns = [c for c in columns if c not in valid_columns]
+    if unknown_columns:
+        raise ValueError("Unknown treenode columns: %s" % ", ".join(unknown_columns))
+
+    # Named cursors only live as long as the transaction they were created in
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+                name='catmaid_treenodes_%s' % uuid4().hex)
+        cursor.itersize = fetch_size
+        try:
+            cursor.execute('''
+                SELECT skeleton_id, %s
+                FROM treenode
+                WHERE skeleton_id = ANY(%%s::bigint[])
+                ORDER BY skeleton_id
+            ''' % ", ".join(columns), (list(skeleton_ids),))
+            for skid, rows in groupby(cursor, key=itemgetter(0)):
+                yield skid, rows
+        finally:
+            cursor.close()
+
+
+def lazy_load_rows(skeleton_ids, columns, fetch_size=TREENODE_FETCH_SIZE):
+    """ Return a lazy collection of pairs of (long, rows) representing
+    (skeleton_id, rows), where rows is an iterator over tuples of the requested
+    treenode columns. Skeletons are returned in ascending order of their ID,
+    the rows of a skeleton have to be consumed before the next pair is
+    requested. The returned generator has to be closed if it isn't consumed
+    completely, which closes the underlying database cursor. """
+    with closing(_stream_skeleton_rows(skeleton_ids, columns, fetch_size)) as skeletons:
+        for skid, rows in skeletons:
+            yield (skid, (row[1:] for row in rows))
+
+
+def lazy_load_trees(skeleton_ids, node_properties=(), fetch_size=TREENODE_FETCH_SIZE):
     """ Return a lazy collection of pairs of (long, DiGraph)
     representing (skeleton_id, tree).
     The node_properties is a list of strings, each being a name of a column
     in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
+    or skeleton_id. Skeletons are loaded one at a time, fetch_size treenodes
+    per database round trip. Like for lazy_load_rows(), the returned generator
+    has to be closed if it isn't consumed completely. """
 
     values_list = ('id', 'parent_id', 'skeleton_id')
     props = tuple(set(node_properties) - set(values_list))
-    values_list += props
-
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-            .order_by('skeleton') \
-            .values_list(*values_list)
-    skid = None
-    tree = None
-    for t in ts:
-        if t[2] != skid:
-            if tree:
-                yield (skid, tree)
-            # Prepare for the next one
-            skid = t[2]
+    columns = ('id', 'parent_id') + props
+
+    with closing(_stream_skeleton_rows(skeleton_ids, columns, fetch_size)) as skeletons:
+        for skid, rows in skeletons:
             tree = DiGraph()
+            for t in rows:
+                fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
+                tree.add_node(t[1], fields)
+
+                if t[2]:
+                    # From child to parent
+                    tree.add_edge(t[1], t[2])
 
-        fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
+            yield (skid, tree)
 
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
 
-    if tree:
-        yield (skid, tree)
+def lazy_load_arbors(skeleton_ids, with_locations=False, fetch_size=TREENODE_FETCH_SIZE):
+    """ Return a lazy collection of pairs of (long, Arbor) representing
+    (skeleton_id, arbor). Locations are only loaded if with_locations
+    is True. Like lazy_load_trees(), skeletons are loaded one at a time and
+    the returned generator has to be closed if it isn't consumed completely. """
+    columns = ('id', 'parent_id')
+    if with_locations:
+        columns += ('location_x', 'location_y', 'location_z')
 
+    with closing(_stream_skeleton_rows(skeleton_ids, columns, fetch_size)) as skeletons:
+        for skid, rows in skeletons:
+            yield (skid, Arbor.from_rows(row[1:] for row in rows))
@@ -1,6 +1,5 @@
 import itertools
 import math
-import networkx as nx
 import re
 
 from collections import defaultdict
@@ -21,6 +20,7 @@ from catmaid.control.common import get_relation_to_id_map, \
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.node import _fetch_location, _fetch_locations
 from catmaid.control.link import create_connector_link
+from catmaid.control import arbor_cache, node_list_cache
 from catmaid.util import Point3D, is_collinear
 
 
@@ -102,6 +102,7 @@ def create_treenode(request, project_id=None):
     if has_parent:
         state.validate_state(parent_id, request.POST.get('state'),
                 parent_edittime=has_parent, lock=True)
+        arbor_versions = arbor_cache.lock_versions([parent_id])
 
     new_treenode = _create_treenode(project_id, request.user, request.user,
             params['x'], params['y'], params['z'], params['radius'],
@@ -115,6 +116,11 @@ def create_treenode(request, project_id=None):
     else:
         created_links = []
 
+    node_list_cache.invalidate_nodes(project_id, [new_treenode.treenode_id])
+    if has_parent:
+        arbor_cache.on_add_node(new_treenode.skeleton_id,
+                new_treenode.treenode_id, parent_id, versions=arbor_versions)
+
     return JsonResponse({
         'treenode_id': new_treenode.treenode_id,
         'skeleton_id': new_treenode.skeleton_id,
@@ -200,6 +206,8 @@ def insert_treenode(request, project_id=None):
     else:
         user, time = child.user, child.creation_time
 
+    arbor_versions = arbor_cache.lock_versions([parent.id])
+
     # Create new treenode
     new_treenode = _create_treenode(project_id,
             user, request.user, params['x'], params['y'], params['z'],
@@ -232,6 +240,14 @@ def insert_treenode(request, project_id=None):
     else:
         created_links = []
 
+    # The new node's neighborhood includes the former edge between child and
+    # parent.
+    node_list_cache.invalidate_nodes(project_id, [new_treenode.treenode_id],
+            cursor=cursor)
+    arbor_cache.on_add_node(new_treenode.skeleton_id, new_treenode.treenode_id,
+            parent.id, [r[0] for r in result], versions=arbor_versions,
+            cursor=cursor)
+
     return JsonResponse({
         'treenode_id': new_treenode.treenode_id,
         'skeleton_id': new_treenode.skeleton_id,
@@ -437,8 +453,14 @@ def update_parent(request, project_id=None, treenode_id=None):
         raise Exception("Child node %s is in skeleton %s but parent node %s is in skeleton %s!", \
                         treenode_id, child.skeleton_id, parent_id, parent.skeleton_id)
 
+    # Invalidate cached node lists along the old and the new parent edge
+    node_list_cache.invalidate_nodes(project_id, [treenode_id])
+    arbor_versions = arbor_cache.lock_versions([treenode_id])
     child.parent_id = parent_id
     child.save()
+    node_list_cache.invalidate_nodes(project_id, [treenode_id])
+    arbor_cache.on_update_parent(child.skeleton_id, treenode_id, parent_id,
+            versions=arbor_versions)
 
     return JsonResponse({
         'success': True,
@@ -513,6 +535,7 @@ def update_radii(request, project_id=None):
             multinode=True, lock=True, cursor=cursor)
 
     updated_nodes = update_node_radii(treenode_ids, radii, cursor)
+    node_list_cache.invalidate_nodes(project_id, updated_nodes.keys(), cursor=cursor)
 
     return JsonResponse({
         'success': True,
@@ -532,6 +555,8 @@ def update_radius(request, project_id=None, treenode_id=None):
             node=True, lock=True, cursor=cursor)
 
     def create_update_response(updated_nodes, radius):
+        node_list_cache.invalidate_nodes(project_id, updated_nodes.keys(),
+                cursor=cursor)
         return JsonResponse({
             'success': True,
             'updated_nodes': updated_nodes,
@@ -637,8 +662,13 @@ def delete_treenode(request, project_id=None):
     state.validate_state(treenode_id, request.POST.get('state'), lock=True,
             neighborhood=True)
 
+    # The neighborhood of the node includes all edges that will change, which
+    # is why cached node lists are invalidated before the node is removed.
+    node_list_cache.invalidate_nodes(project_id, [treenode_id])
+
     treenode = Treenode.objects.get(pk=treenode_id)
     parent_id = treenode.parent_id
+    arbor_versions = arbor_cache.lock_versions([treenode_id])
 
     # Get information about linked connectors
     links = list(TreenodeConnector.objects.filter(project_id=project_id,
@@ -710,6 +740,11 @@ def delete_treenode(request, project_id=None):
         # Remove treenode
         response_on_error = 'Could not delete treenode.'
         Treenode.objects.filter(project_id=project_id, pk=treenode_id).delete()
+        if parent_id:
+            arbor_cache.on_remove_node(treenode.skeleton_id, treenode_id,
+                    versions=arbor_versions)
+        else:
+            arbor_cache.invalidate([treenode.skeleton_id])
         return JsonResponse({
             'x': treenode.location_x,
             'y': treenode.location_y,
@@ -913,6 +948,7 @@ def update_confidence(request, project_id=None, treenode_id=None):
 
     updated_partners = cursor.fetchall()
     if len(updated_partners) > 0:
+        node_list_cache.invalidate_nodes(project_id, [tnid], cursor=cursor)
         location = Location.objects.filter(id=tnid).values_list(
                 'location_x', 'location_y', 'location_z')[0]
         insert_into_log(project_id, request.user.id, "change_confidence",
@@ -934,25 +970,6 @@ def update_confidence(request, project_id=None, treenode_id=None):
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
-
-
 def _find_first_interesting_node(sequence):
     """ Find the first node that:
     1. Has confidence lower than 5
@@ -997,19 +1014,18 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = arbor_cache.get_arbor(skid)
+        child_counts = arbor.child_counts()
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
-        while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
-                break # Found the root node
+        parent = arbor.parents[arbor.index(tnid)]
+        while -1 != parent:
+            tnid = int(arbor.node_ids[parent])
+            seq.append(tnid)
+            if 1 != child_counts[parent]:
+                break # Found a branch node
+            parent = arbor.parents[parent]
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -1024,9 +1040,9 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = arbor_cache.get_arbor(skid)
 
-        children = graph.successors(tnid)
+        children = arbor.children(tnid)
         branches = []
         for child_node_id in children:
             # Travel downstream until finding a child node with more than one
@@ -1034,7 +1050,7 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
             seq = [child_node_id] # Does not include the starting node tnid
             branch_end = child_node_id
             while True:
-                branch_children = graph.successors(branch_end)
+                branch_children = arbor.children(branch_end)
                 if 1 == len(branch_children):
                     branch_end = branch_children[0]
                     seq.append(branch_end)
@@ -1046,9 +1062,10 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
                              branch_end])
 
         # If more than one branch exists, sort based on downstream arbor size.
+        # This is the number of nodes with children downstream of a branch.
         if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
+            n_parents = arbor.subtree_sums(arbor.child_counts() > 0)
+            branches.sort(key=lambda b: n_parents[arbor.index(b[0])],
                    reverse=True)
 
         # Leaf nodes will have no branches
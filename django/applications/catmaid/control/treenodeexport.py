@@ -15,6 +15,8 @@ from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
 
 from celery.task import task
 
+from PIL import Image
+
 
 # The path were archive files get stored in
 treenode_output_path = os.path.join(settings.MEDIA_ROOT,
@@ -170,7 +172,7 @@ class TreenodeExporter:
             # Save image in output path, named <treenode-id>.tiff
             image_name = "%s.tiff" % treenode.id
             treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+            Image.fromarray(img).save(treenode_image_path)
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
@@ -344,7 +346,7 @@ class ConnectorExporter(TreenodeExporter):
             z = int(z_min + i * crop_self.stacks[0].resolution.z  + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
             connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            Image.fromarray(img).save(connector_image_path)
 
     def post_process(self, nodes):
         pass
@@ -3,6 +3,7 @@ import pytz
 
 from datetime import datetime, timedelta
 from collections import defaultdict, namedtuple
+from contextlib import closing
 from itertools import imap
 from networkx import connected_components
 from functools import partial
@@ -307,10 +308,11 @@ def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
     relations = dict(Relation.objects.filter(project_id=project_id, relation_name__in=['presynaptic_to', 'postsynaptic_to']).values_list('relation_name', 'id'))
 
     # 2. Load each fully reviewed skeleton one at a time
-    evaluations = {skid: _evaluate_arbor(user_id, skid, tree, reviews[skid], relations, max_gap) \
-        for skid, tree in lazy_load_trees(skeleton_ids, ('location_x', 'location_y', 'location_z', \
-                                                         'creation_time', 'user_id', 'editor_id', \
-                                                         'edition_time'))}
+    with closing(lazy_load_trees(skeleton_ids, ('location_x', 'location_y', 'location_z', \
+                                                'creation_time', 'user_id', 'editor_id', \
+                                                'edition_time'))) as trees:
+        evaluations = {skid: _evaluate_arbor(user_id, skid, tree, reviews[skid], relations, max_gap) \
+            for skid, tree in trees}
 
     # 3. Extract evaluations for the user_id over time
     # Each evaluation contains an instance of EpochOps namedtuple, with members:
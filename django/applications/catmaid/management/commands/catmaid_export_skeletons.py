@@ -0,0 +1,61 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from catmaid.control.skeletonexport import export_skeletons, gzip_chunks, \
+        EXPORT_CONTENT_TYPES
+from catmaid.models import ClassInstance, Project
+
+class Command(BaseCommand):
+    help = 'Export skeletons of a project as SWC or compact JSON. Treenodes ' \
+        'are streamed from the database, which makes it possible to export ' \
+        'many skeletons with bounded memory use.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', required=True,
+            help='Export skeletons of this project')
+        parser.add_argument('--skeleton_id', dest='skeleton_ids', nargs='+',
+            help='Export only these skeletons, all skeletons of the project ' \
+            'are exported otherwise')
+        parser.add_argument('--format', dest='format', default='swc',
+            choices=sorted(EXPORT_CONTENT_TYPES.keys()),
+            help='Export format, defaults to swc')
+        parser.add_argument('--connectors', action='store_true',
+            dest='with_connectors', default=False,
+            help='Include connectors in compact JSON')
+        parser.add_argument('--tags', action='store_true', dest='with_tags',
+            default=False, help='Include tags in compact JSON')
+        parser.add_argument('--gzip', action='store_true', dest='gzip',
+            default=False, help='Compress the output with gzip')
+        parser.add_argument('--output', dest='output',
+            help='Write to this file instead of standard output')
+
+    def handle(self, *args, **options):
+        project_id = int(options['project_id'])
+        if not Project.objects.filter(pk=project_id).exists():
+            raise CommandError('Project "%s" does not exist' % project_id)
+
+        skeletons = ClassInstance.objects.filter(project_id=project_id,
+                class_column__class_name='skeleton')
+        if options['skeleton_ids']:
+            skeletons = skeletons.filter(
+                    id__in=[int(s) for s in options['skeleton_ids']])
+        skeleton_ids = list(skeletons.values_list('id', flat=True))
+
+        chunks = export_skeletons(project_id, skeleton_ids, options['format'],
+                options['with_connectors'], options['with_tags'])
+        if options['gzip']:
+            chunks = gzip_chunks(chunks)
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            # Closes the database cursor if the export didn't complete
+            chunks.close()
+            if options['output']:
+                output.close()
+
+        if options['output']:
+            self.stdout.write('Exported %s skeletons to %s' % \
+                    (len(skeleton_ids), options['output']))
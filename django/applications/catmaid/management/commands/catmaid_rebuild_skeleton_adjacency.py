@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.models import Project
+
+class DryRunRollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = 'Rebuild the skeleton adjacency table (synapse and gap junction ' \
+        'counts between skeletons) for all skeletons in the specified ' \
+        'projects or in all projects if no project is specified.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dryrun', action='store_true', dest='dryrun',
+            default=False, help='Don\'t actually apply changes')
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild skeleton adjacency for these projects')
+
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        if project_ids:
+            project_ids = [int(p) for p in project_ids]
+            existing = set(Project.objects.filter(pk__in=project_ids) \
+                    .values_list('id', flat=True))
+            for project_id in project_ids:
+                if project_id not in existing:
+                    raise CommandError('Project "%s" does not exist' % project_id)
+
+        dryrun = options['dryrun']
+        if dryrun:
+            self.stdout.write('DRY RUN - no changes will be made')
+        else:
+            self.stdout.write('This will make changes to the database')
+
+        cursor = connection.cursor()
+
+        try:
+            with transaction.atomic():
+                cursor.execute('SELECT rebuild_skeleton_adjacency(%s::integer[])',
+                        (project_ids,))
+                cursor.execute('''
+                    SELECT count(*) FROM skeleton_adjacency
+                    WHERE %(project_ids)s::integer[] IS NULL
+                       OR project_id = ANY(%(project_ids)s::integer[])
+                ''', {'project_ids': project_ids})
+                num_entries = cursor.fetchone()[0]
+                self.stdout.write('Created %s adjacency entries' % num_entries)
+
+                if dryrun:
+                    # For a dry run, cancel the transaction by raising an exception
+                    raise DryRunRollback()
+
+                self.stdout.write('Successfully rebuilt skeleton adjacency table')
+
+        except DryRunRollback:
+            self.stdout.write('Dry run completed')
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+create_skeleton_summary_table_and_triggers = """
+
+    -- Per skeleton aggregates that would otherwise be computed from the
+    -- treenode and review tables on every request. Branch and end nodes are
+    -- defined by their degree (number of children plus parent): end nodes have
+    -- a degree of one (this includes a root with a single child), branch nodes
+    -- a degree of more than two.
+    CREATE TABLE catmaid_skeleton_summary (
+        skeleton_id integer PRIMARY KEY,
+        project_id integer NOT NULL,
+        root_node_id bigint,
+        num_nodes integer NOT NULL DEFAULT 0,
+        num_branches integer NOT NULL DEFAULT 0,
+        num_ends integer NOT NULL DEFAULT 0,
+        num_reviewed_nodes integer NOT NULL DEFAULT 0,
+        cable_length double precision NOT NULL DEFAULT 0,
+        last_edition_time timestamp with time zone,
+        last_editor_id integer
+    );
+
+    CREATE INDEX catmaid_skeleton_summary_project_index
+      ON catmaid_skeleton_summary
+      USING btree (project_id);
+
+
+    CREATE FUNCTION skeleton_summary_edge_length(x1 real, y1 real, z1 real,
+            x2 real, y2 real, z2 real) RETURNS double precision
+    LANGUAGE sql IMMUTABLE
+    AS $$
+        SELECT sqrt(($1::double precision - $4) ^ 2 +
+                    ($2::double precision - $5) ^ 2 +
+                    ($3::double precision - $6) ^ 2);
+    $$;
+
+    CREATE FUNCTION skeleton_summary_is_end(degree bigint) RETURNS integer
+    LANGUAGE sql IMMUTABLE
+    AS $$
+        SELECT CASE WHEN $1 = 1 THEN 1 ELSE 0 END;
+    $$;
+
+    CREATE FUNCTION skeleton_summary_is_branch(degree bigint) RETURNS integer
+    LANGUAGE sql IMMUTABLE
+    AS $$
+        SELECT CASE WHEN $1 > 2 THEN 1 ELSE 0 END;
+    $$;
+
+    -- Add the passed in deltas to the summary of a skeleton, which is created
+    -- if it doesn't exist yet.
+    CREATE FUNCTION update_skeleton_summary(skid integer, pid integer,
+            node_delta integer, branch_delta integer, end_delta integer,
+            cable_delta double precision, review_delta integer,
+            edit_time timestamp with time zone, editor integer)
+    RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+
+            INSERT INTO catmaid_skeleton_summary AS s (skeleton_id,
+                    project_id, num_nodes, num_branches, num_ends,
+                    cable_length, num_reviewed_nodes, last_edition_time,
+                    last_editor_id)
+                VALUES (skid, pid, node_delta, branch_delta, end_delta,
+                    cable_delta, review_delta, edit_time, editor)
+            ON CONFLICT (skeleton_id) DO UPDATE SET
+                num_nodes = s.num_nodes + EXCLUDED.num_nodes,
+                num_branches = s.num_branches + EXCLUDED.num_branches,
+                num_ends = s.num_ends + EXCLUDED.num_ends,
+                cable_length = s.cable_length + EXCLUDED.cable_length,
+                num_reviewed_nodes = s.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes,
+                last_editor_id = CASE
+                    WHEN EXCLUDED.last_edition_time IS NOT NULL AND
+                        (s.last_edition_time IS NULL OR
+                         EXCLUDED.last_edition_time >= s.last_edition_time)
+                    THEN EXCLUDED.last_editor_id
+                    ELSE s.last_editor_id END,
+                last_edition_time = GREATEST(s.last_edition_time,
+                    EXCLUDED.last_edition_time);
+        END;
+        $$;
+
+    -- Recompute the summary of all skeletons in the passed in projects, or in
+    -- all projects if NULL is passed in.
+    CREATE FUNCTION rebuild_skeleton_summary(project_ids integer[])
+    RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+
+            DELETE FROM catmaid_skeleton_summary
+                WHERE project_ids IS NULL OR project_id = ANY(project_ids);
+
+            INSERT INTO catmaid_skeleton_summary (skeleton_id, project_id,
+                    root_node_id, num_nodes, num_branches, num_ends,
+                    cable_length, last_edition_time, last_editor_id)
+                SELECT t.skeleton_id, t.project_id,
+                    max(t.id) FILTER (WHERE t.parent_id IS NULL),
+                    count(*),
+                    count(*) FILTER (WHERE skeleton_summary_is_branch(d.degree) = 1),
+                    count(*) FILTER (WHERE skeleton_summary_is_end(d.degree) = 1),
+                    COALESCE(sum(skeleton_summary_edge_length(
+                        t.location_x, t.location_y, t.location_z,
+                        p.location_x, p.location_y, p.location_z)), 0),
+                    max(t.edition_time),
+                    (array_agg(t.editor_id ORDER BY t.edition_time DESC))[1]
+                FROM treenode t
+                LEFT JOIN treenode p
+                    ON p.id = t.parent_id
+                LEFT JOIN (
+                    SELECT parent_id, count(*)
+                    FROM treenode
+                    WHERE parent_id IS NOT NULL
+                      AND (project_ids IS NULL OR project_id = ANY(project_ids))
+                    GROUP BY parent_id) c(parent_id, n_children)
+                    ON c.parent_id = t.id
+                CROSS JOIN LATERAL (
+                    SELECT COALESCE(c.n_children, 0) +
+                        CASE WHEN t.parent_id IS NULL THEN 0 ELSE 1 END) d(degree)
+                WHERE project_ids IS NULL OR t.project_id = ANY(project_ids)
+                GROUP BY t.skeleton_id, t.project_id;
+
+            UPDATE catmaid_skeleton_summary s
+                SET num_reviewed_nodes = r.n_reviewed
+                FROM (
+                    SELECT skeleton_id, count(DISTINCT treenode_id)
+                    FROM review
+                    WHERE project_ids IS NULL OR project_id = ANY(project_ids)
+                    GROUP BY skeleton_id) r(skeleton_id, n_reviewed)
+                WHERE s.skeleton_id = r.skeleton_id;
+        END;
+        $$;
+
+    -- Keep the summary of the skeletons involved in a treenode change up to
+    -- date. This is a BEFORE trigger so that queries in it see the changes of
+    -- rows that were processed earlier in the same statement, but not the one
+    -- of the current row. The difference between a skeleton's state with and
+    -- without the current change is therefore exact, even for statements that
+    -- change many nodes at once.
+    CREATE FUNCTION on_change_treenode_update_skeleton_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+        DECLARE
+            node_id bigint;
+            n_children bigint;
+            node_degree bigint;
+            location_changed boolean;
+            lost_parent_id bigint;
+            gained_parent_id bigint;
+            parent_node record;
+            child_edges record;
+        BEGIN
+
+            IF TG_OP = 'UPDATE' THEN
+                location_changed := OLD.location_x != NEW.location_x OR
+                                    OLD.location_y != NEW.location_y OR
+                                    OLD.location_z != NEW.location_z;
+                IF OLD.skeleton_id = NEW.skeleton_id AND
+                   OLD.parent_id IS NOT DISTINCT FROM NEW.parent_id AND
+                   NOT location_changed THEN
+                    -- Only the last edit has to be updated
+                    PERFORM update_skeleton_summary(NEW.skeleton_id,
+                        NEW.project_id, 0, 0, 0, 0, 0, NEW.edition_time,
+                        NEW.editor_id);
+                    RETURN NEW;
+                END IF;
+            ELSE
+                location_changed := TRUE;
+            END IF;
+
+            IF TG_OP = 'DELETE' THEN
+                node_id := OLD.id;
+            ELSE
+                node_id := NEW.id;
+            END IF;
+
+            -- The children of a node aren't affected by a change of the node
+            SELECT count(*) INTO n_children
+                FROM treenode
+                WHERE parent_id = node_id;
+
+            -- Remove the old node from its skeleton and its parent
+            IF TG_OP != 'INSERT' THEN
+                node_degree := n_children + CASE WHEN OLD.parent_id IS NULL THEN 0 ELSE 1 END;
+                PERFORM update_skeleton_summary(OLD.skeleton_id, OLD.project_id,
+                    -1, -skeleton_summary_is_branch(node_degree),
+                    -skeleton_summary_is_end(node_degree),
+                    -COALESCE((SELECT skeleton_summary_edge_length(
+                            OLD.location_x, OLD.location_y, OLD.location_z,
+                            p.location_x, p.location_y, p.location_z)
+                        FROM treenode p WHERE p.id = OLD.parent_id), 0),
+                    0, NULL, NULL);
+
+                -- While a skeleton is changed, it can temporarily have more
+                -- than one root. Fall back to another one, if any.
+                IF OLD.parent_id IS NULL THEN
+                    UPDATE catmaid_skeleton_summary
+                        SET root_node_id = (
+                            SELECT r.id FROM treenode r
+                            WHERE r.skeleton_id = OLD.skeleton_id
+                              AND r.parent_id IS NULL
+                              AND r.id != OLD.id
+                            LIMIT 1)
+                        WHERE skeleton_id = OLD.skeleton_id
+                          AND root_node_id = OLD.id;
+                END IF;
+
+                -- A parent that loses a child. NEW can't be accessed in
+                -- DELETE triggers and OLD not in INSERT triggers, which is
+                -- why conditions on them are nested.
+                IF TG_OP = 'DELETE' THEN
+                    lost_parent_id := OLD.parent_id;
+                ELSIF OLD.parent_id IS DISTINCT FROM NEW.parent_id THEN
+                    lost_parent_id := OLD.parent_id;
+                END IF;
+            END IF;
+
+            IF lost_parent_id IS NOT NULL THEN
+                SELECT p.skeleton_id, p.project_id,
+                    (SELECT count(*) FROM treenode c WHERE c.parent_id = p.id) +
+                    CASE WHEN p.parent_id IS NULL THEN 0 ELSE 1 END AS degree
+                INTO parent_node
+                FROM treenode p
+                WHERE p.id = lost_parent_id;
+                IF FOUND THEN
+                    PERFORM update_skeleton_summary(parent_node.skeleton_id,
+                        parent_node.project_id, 0,
+                        skeleton_summary_is_branch(parent_node.degree - 1) -
+                            skeleton_summary_is_branch(parent_node.degree),
+                        skeleton_summary_is_end(parent_node.degree - 1) -
+                            skeleton_summary_is_end(parent_node.degree),
+                        0, 0, NULL, NULL);
+                END IF;
+            END IF;
+
+            -- Edges from children to the old location
+            IF TG_OP != 'INSERT' AND location_changed THEN
+                FOR child_edges IN
+                    SELECT c.skeleton_id, c.project_id,
+                        sum(skeleton_summary_edge_length(
+                            c.location_x, c.location_y, c.location_z,
+                            OLD.location_x, OLD.location_y, OLD.location_z)) AS cable
+                    FROM treenode c
+                    WHERE c.parent_id = OLD.id
+                    GROUP BY c.skeleton_id, c.project_id
+                LOOP
+                    PERFORM update_skeleton_summary(child_edges.skeleton_id,
+                        child_edges.project_id, 0, 0, 0, -child_edges.cable, 0,
+                        NULL, NULL);
+                END LOOP;
+            END IF;
+
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM catmaid_skeleton_summary
+                    WHERE skeleton_id = OLD.skeleton_id
+                      AND num_nodes <= 0;
+                RETURN OLD;
+            END IF;
+
+            -- Add the new node to its skeleton and its parent
+            node_degree := n_children + CASE WHEN NEW.parent_id IS NULL THEN 0 ELSE 1 END;
+            PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id,
+                1, skeleton_summary_is_branch(node_degree),
+                skeleton_summary_is_end(node_degree),
+                COALESCE((SELECT skeleton_summary_edge_length(
+                        NEW.location_x, NEW.location_y, NEW.location_z,
+                        p.location_x, p.location_y, p.location_z)
+                    FROM treenode p WHERE p.id = NEW.parent_id), 0),
+                0, NEW.edition_time, NEW.editor_id);
+
+            IF NEW.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary
+                    SET root_node_id = NEW.id
+                    WHERE skeleton_id = NEW.skeleton_id;
+            END IF;
+
+            -- A parent that gains a child
+            IF TG_OP = 'INSERT' THEN
+                gained_parent_id := NEW.parent_id;
+            ELSIF OLD.parent_id IS DISTINCT FROM NEW.parent_id THEN
+                gained_parent_id := NEW.parent_id;
+            END IF;
+
+            IF gained_parent_id IS NOT NULL THEN
+                SELECT p.skeleton_id, p.project_id,
+                    (SELECT count(*) FROM treenode c WHERE c.parent_id = p.id) +
+                    CASE WHEN p.parent_id IS NULL THEN 0 ELSE 1 END AS degree
+                INTO parent_node
+                FROM treenode p
+                WHERE p.id = gained_parent_id;
+                IF FOUND THEN
+                    PERFORM update_skeleton_summary(parent_node.skeleton_id,
+                        parent_node.project_id, 0,
+                        skeleton_summary_is_branch(parent_node.degree + 1) -
+                            skeleton_summary_is_branch(parent_node.degree),
+                        skeleton_summary_is_end(parent_node.degree + 1) -
+                            skeleton_summary_is_end(parent_node.degree),
+                        0, 0, NULL, NULL);
+                END IF;
+            END IF;
+
+            -- Edges from children to the new location
+            IF location_changed THEN
+                FOR child_edges IN
+                    SELECT c.skeleton_id, c.project_id,
+                        sum(skeleton_summary_edge_length(
+                            c.location_x, c.location_y, c.location_z,
+                            NEW.location_x, NEW.location_y, NEW.location_z)) AS cable
+                    FROM treenode c
+                    WHERE c.parent_id = NEW.id
+                    GROUP BY c.skeleton_id, c.project_id
+                LOOP
+                    PERFORM update_skeleton_summary(child_edges.skeleton_id,
+                        child_edges.project_id, 0, 0, 0, child_edges.cable, 0,
+                        NULL, NULL);
+                END LOOP;
+            END IF;
+
+            IF TG_OP = 'UPDATE' THEN
+                IF OLD.skeleton_id != NEW.skeleton_id THEN
+                    DELETE FROM catmaid_skeleton_summary
+                        WHERE skeleton_id = OLD.skeleton_id
+                          AND num_nodes <= 0;
+                END IF;
+            END IF;
+
+            RETURN NEW;
+        END;
+        $$;
+
+    -- Keep the number of reviewed nodes of a skeleton up to date. Like above,
+    -- this is a BEFORE trigger so that other reviews of the same node that
+    -- are part of the same statement are counted correctly.
+    CREATE FUNCTION on_change_review_update_skeleton_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+
+            IF TG_OP = 'UPDATE' THEN
+                IF OLD.skeleton_id = NEW.skeleton_id AND
+                   OLD.treenode_id = NEW.treenode_id THEN
+                    RETURN NEW;
+                END IF;
+            END IF;
+
+            IF TG_OP != 'INSERT' THEN
+                IF NOT EXISTS (
+                    SELECT 1 FROM review r
+                    WHERE r.skeleton_id = OLD.skeleton_id
+                      AND r.treenode_id = OLD.treenode_id
+                      AND r.id != OLD.id) THEN
+                    UPDATE catmaid_skeleton_summary
+                        SET num_reviewed_nodes = num_reviewed_nodes - 1
+                        WHERE skeleton_id = OLD.skeleton_id;
+                END IF;
+            END IF;
+
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+
+            IF NOT EXISTS (
+                SELECT 1 FROM review r
+                WHERE r.skeleton_id = NEW.skeleton_id
+                  AND r.treenode_id = NEW.treenode_id
+                  AND r.id != NEW.id) THEN
+                PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id,
+                    0, 0, 0, 0, 1, NULL, NULL);
+            END IF;
+            RETURN NEW;
+        END;
+        $$;
+
+    SELECT rebuild_skeleton_summary(NULL);
+
+    -- Triggers
+    CREATE TRIGGER on_change_treenode_update_skeleton_summary
+        BEFORE INSERT OR UPDATE OR DELETE ON treenode
+        FOR EACH ROW EXECUTE PROCEDURE on_change_treenode_update_skeleton_summary();
+    CREATE TRIGGER on_change_review_update_skeleton_summary
+        BEFORE INSERT OR UPDATE OR DELETE ON review
+        FOR EACH ROW EXECUTE PROCEDURE on_change_review_update_skeleton_summary();
+"""
+
+remove_skeleton_summary_table_and_triggers = """
+    DROP TRIGGER on_change_treenode_update_skeleton_summary ON treenode;
+    DROP FUNCTION on_change_treenode_update_skeleton_summary();
+    DROP TRIGGER on_change_review_update_skeleton_summary ON review;
+    DROP FUNCTION on_change_review_update_skeleton_summary();
+
+    DROP FUNCTION rebuild_skeleton_summary(integer[]);
+    DROP FUNCTION update_skeleton_summary(integer, integer, integer, integer,
+        integer, double precision, integer, timestamp with time zone, integer);
+    DROP FUNCTION skeleton_summary_is_branch(bigint);
+    DROP FUNCTION skeleton_summary_is_end(bigint);
+    DROP FUNCTION skeleton_summary_edge_length(real, real, real, real, real, real);
+
+    DROP TABLE catmaid_skeleton_summary;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0013_add_missing_tnci_and_cnci_indices'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_skeleton_summary_table_and_triggers,
+                          remove_skeleton_summary_table_and_triggers),
+    ]
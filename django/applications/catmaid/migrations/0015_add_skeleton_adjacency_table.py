@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+create_skeleton_adjacency_table_and_triggers = """
+
+    -- Number of connections between two skeletons through a shared connector,
+    -- like they are found by joining treenode_connector with itself on the
+    -- connector ID. For synapses, relation_id is the ID of presynaptic_to and
+    -- every pair of a presynaptic and a postsynaptic link is counted. For gap
+    -- junctions, relation_id is the ID of gapjunction_with and every pair of
+    -- two different gap junction links is counted in both directions. Counts
+    -- are stored as a histogram of the lower confidence of both links, the
+    -- first element counts connections with a confidence of 1, the last those
+    -- with a confidence of 5.
+    CREATE TABLE skeleton_adjacency (
+        pre_skeleton_id integer NOT NULL,
+        post_skeleton_id integer NOT NULL,
+        relation_id integer NOT NULL,
+        project_id integer NOT NULL,
+        confidence_histogram integer[] NOT NULL,
+        PRIMARY KEY (pre_skeleton_id, post_skeleton_id, relation_id)
+    );
+
+    CREATE INDEX skeleton_adjacency_post_pre_index
+      ON skeleton_adjacency
+      USING btree (post_skeleton_id, pre_skeleton_id);
+
+    CREATE INDEX skeleton_adjacency_project_index
+      ON skeleton_adjacency
+      USING btree (project_id);
+
+
+    -- Add <delta> connections of the passed in confidence to an adjacency
+    -- entry, which is created if needed and removed if no connections remain.
+    CREATE FUNCTION update_skeleton_adjacency(pre_skid integer, post_skid integer,
+            rel integer, pid integer, link_confidence integer, delta integer)
+    RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+        DECLARE
+            bin integer := GREATEST(1, LEAST(5, link_confidence));
+        BEGIN
+
+            INSERT INTO skeleton_adjacency AS a (pre_skeleton_id,
+                    post_skeleton_id, relation_id, project_id,
+                    confidence_histogram)
+                VALUES (pre_skid, post_skid, rel, pid,
+                    (SELECT array_agg(CASE WHEN i = bin THEN delta ELSE 0 END ORDER BY i)
+                     FROM generate_series(1, 5) i))
+            ON CONFLICT (pre_skeleton_id, post_skeleton_id, relation_id) DO UPDATE
+                SET confidence_histogram[bin] = a.confidence_histogram[bin] + delta;
+
+            DELETE FROM skeleton_adjacency
+                WHERE pre_skeleton_id = pre_skid
+                  AND post_skeleton_id = post_skid
+                  AND relation_id = rel
+                  AND confidence_histogram = '{0,0,0,0,0}';
+        END;
+        $$;
+
+    -- Add or remove (depending on delta) all adjacencies that a single
+    -- treenode_connector link takes part in.
+    CREATE FUNCTION update_skeleton_adjacency_for_link(link_id bigint,
+            skid integer, rel integer, cid bigint, pid integer,
+            link_confidence integer, delta integer)
+    RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+        DECLARE
+            rel_name text;
+            partner_rel_name text;
+            partner record;
+        BEGIN
+
+            IF skid IS NULL THEN
+                RETURN;
+            END IF;
+
+            SELECT relation_name INTO rel_name FROM relation WHERE id = rel;
+            IF rel_name = 'presynaptic_to' THEN
+                partner_rel_name := 'postsynaptic_to';
+            ELSIF rel_name = 'postsynaptic_to' THEN
+                partner_rel_name := 'presynaptic_to';
+            ELSIF rel_name = 'gapjunction_with' THEN
+                partner_rel_name := 'gapjunction_with';
+            ELSE
+                RETURN;
+            END IF;
+
+            FOR partner IN
+                SELECT tc.skeleton_id, tc.relation_id,
+                    LEAST(tc.confidence, link_confidence) AS confidence,
+                    count(*) AS n
+                FROM treenode_connector tc
+                JOIN relation r
+                    ON r.id = tc.relation_id
+                WHERE tc.connector_id = cid
+                  AND tc.id != link_id
+                  AND tc.skeleton_id IS NOT NULL
+                  AND r.relation_name = partner_rel_name
+                GROUP BY tc.skeleton_id, tc.relation_id,
+                    LEAST(tc.confidence, link_confidence)
+            LOOP
+                IF rel_name = 'postsynaptic_to' THEN
+                    PERFORM update_skeleton_adjacency(partner.skeleton_id, skid,
+                        partner.relation_id, pid, partner.confidence,
+                        (delta * partner.n)::integer);
+                ELSE
+                    PERFORM update_skeleton_adjacency(skid, partner.skeleton_id,
+                        rel, pid, partner.confidence, (delta * partner.n)::integer);
+                    IF rel_name = 'gapjunction_with' THEN
+                        PERFORM update_skeleton_adjacency(partner.skeleton_id,
+                            skid, rel, pid, partner.confidence,
+                            (delta * partner.n)::integer);
+                    END IF;
+                END IF;
+            END LOOP;
+        END;
+        $$;
+
+    -- Recompute the adjacency of all skeletons in the passed in projects, or
+    -- in all projects if NULL is passed in.
+    CREATE FUNCTION rebuild_skeleton_adjacency(project_ids integer[])
+    RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+
+            DELETE FROM skeleton_adjacency
+                WHERE project_ids IS NULL OR project_id = ANY(project_ids);
+
+            INSERT INTO skeleton_adjacency (pre_skeleton_id, post_skeleton_id,
+                    relation_id, project_id, confidence_histogram)
+                SELECT tc1.skeleton_id, tc2.skeleton_id, tc1.relation_id,
+                    tc1.project_id, ARRAY[
+                        count(*) FILTER (WHERE c.bin = 1),
+                        count(*) FILTER (WHERE c.bin = 2),
+                        count(*) FILTER (WHERE c.bin = 3),
+                        count(*) FILTER (WHERE c.bin = 4),
+                        count(*) FILTER (WHERE c.bin = 5)]::integer[]
+                FROM treenode_connector tc1
+                JOIN relation r1
+                    ON r1.id = tc1.relation_id
+                JOIN treenode_connector tc2
+                    ON tc2.connector_id = tc1.connector_id
+                   AND tc2.id != tc1.id
+                JOIN relation r2
+                    ON r2.id = tc2.relation_id
+                CROSS JOIN LATERAL (
+                    SELECT GREATEST(1, LEAST(5, tc1.confidence, tc2.confidence))) c(bin)
+                WHERE ((r1.relation_name = 'presynaptic_to' AND
+                        r2.relation_name = 'postsynaptic_to') OR
+                       (r1.relation_name = 'gapjunction_with' AND
+                        r2.relation_name = 'gapjunction_with'))
+                  AND tc1.skeleton_id IS NOT NULL
+                  AND tc2.skeleton_id IS NOT NULL
+                  AND (project_ids IS NULL OR tc1.project_id = ANY(project_ids))
+                GROUP BY tc1.skeleton_id, tc2.skeleton_id, tc1.relation_id,
+                    tc1.project_id;
+        END;
+        $$;
+
+    -- Like the skeleton summary triggers, this is a BEFORE trigger: queries
+    -- in it see the links changed earlier in the same statement, but not the
+    -- current one. Joins and splits change the skeleton of many links at once,
+    -- which is handled exactly this way.
+    CREATE FUNCTION on_change_treenode_connector_update_skeleton_adjacency()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+
+            IF TG_OP = 'UPDATE' THEN
+                IF OLD.skeleton_id IS NOT DISTINCT FROM NEW.skeleton_id AND
+                   OLD.relation_id = NEW.relation_id AND
+                   OLD.connector_id = NEW.connector_id AND
+                   OLD.confidence = NEW.confidence THEN
+                    RETURN NEW;
+                END IF;
+            END IF;
+
+            IF TG_OP != 'INSERT' THEN
+                PERFORM update_skeleton_adjacency_for_link(OLD.id,
+                    OLD.skeleton_id, OLD.relation_id, OLD.connector_id,
+                    OLD.project_id, OLD.confidence, -1);
+            END IF;
+
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+
+            PERFORM update_skeleton_adjacency_for_link(NEW.id,
+                NEW.skeleton_id, NEW.relation_id, NEW.connector_id,
+                NEW.project_id, NEW.confidence, 1);
+            RETURN NEW;
+        END;
+        $$;
+
+    SELECT rebuild_skeleton_adjacency(NULL);
+
+    CREATE TRIGGER on_change_treenode_connector_update_skeleton_adjacency
+        BEFORE INSERT OR UPDATE OR DELETE ON treenode_connector
+        FOR EACH ROW EXECUTE PROCEDURE on_change_treenode_connector_update_skeleton_adjacency();
+"""
+
+remove_skeleton_adjacency_table_and_triggers = """
+    DROP TRIGGER on_change_treenode_connector_update_skeleton_adjacency ON treenode_connector;
+    DROP FUNCTION on_change_treenode_connector_update_skeleton_adjacency();
+
+    DROP FUNCTION rebuild_skeleton_adjacency(integer[]);
+    DROP FUNCTION update_skeleton_adjacency_for_link(bigint, integer, integer,
+        bigint, integer, integer, integer);
+    DROP FUNCTION update_skeleton_adjacency(integer, integer, integer, integer,
+        integer, integer);
+
+    DROP TABLE skeleton_adjacency;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0014_add_skeleton_summary_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_skeleton_adjacency_table_and_triggers,
+                          remove_skeleton_adjacency_table_and_triggers),
+    ]
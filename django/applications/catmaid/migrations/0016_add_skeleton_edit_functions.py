@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+create_skeleton_edit_functions = """
+
+    -- Make the passed in treenode the root of its skeleton by reversing all
+    -- edges on the path to the current root. Like an edge's confidence, which
+    -- is stored with the child, travels with the edge, the new root gets a
+    -- confidence of 5. Returns the number of changed treenodes, which is zero
+    -- if the node was root already.
+    CREATE FUNCTION reroot_skeleton(new_root_id bigint)
+    RETURNS integer
+    LANGUAGE sql
+    AS $$
+        WITH RECURSIVE path(id, parent_id, confidence, depth) AS (
+            SELECT id, parent_id, confidence, 0
+            FROM treenode
+            WHERE id = new_root_id
+            UNION ALL
+            SELECT t.id, t.parent_id, t.confidence, p.depth + 1
+            FROM path p
+            JOIN treenode t
+                ON t.id = p.parent_id
+        ), new_edges(id, parent_id, confidence) AS (
+            SELECT p.id, c.id, COALESCE(c.confidence, 5)
+            FROM path p
+            LEFT JOIN path c
+                ON c.depth = p.depth - 1
+            WHERE EXISTS (SELECT 1 FROM path WHERE depth > 0)
+        ), updated AS (
+            UPDATE treenode t
+            SET parent_id = e.parent_id,
+                confidence = e.confidence
+            FROM new_edges e
+            WHERE t.id = e.id
+            RETURNING t.id
+        )
+        SELECT count(*)::integer FROM updated;
+    $$;
+
+    -- Move the passed in treenode and all treenodes downstream of it, along
+    -- with their connector links and reviews, to another skeleton. All
+    -- treenodes and links of the original skeleton are locked first to
+    -- prevent concurrent edits from creating nodes with an outdated skeleton
+    -- ID. Returns the number of moved treenodes.
+    CREATE FUNCTION split_skeleton(split_node_id bigint, new_skeleton_id integer,
+            editor integer)
+    RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+        DECLARE
+            skid integer;
+            split_node_parent_id bigint;
+            moved bigint[];
+        BEGIN
+
+            SELECT skeleton_id, parent_id INTO skid, split_node_parent_id
+                FROM treenode
+                WHERE id = split_node_id;
+            IF NOT FOUND THEN
+                RAISE EXCEPTION 'Could not find treenode %', split_node_id;
+            END IF;
+            IF split_node_parent_id IS NULL THEN
+                RAISE EXCEPTION 'Can''t split at the root node: it doesn''t have a parent.';
+            END IF;
+
+            PERFORM 1 FROM treenode_connector
+                WHERE skeleton_id = skid
+                ORDER BY id
+                FOR NO KEY UPDATE;
+            PERFORM 1 FROM treenode
+                WHERE skeleton_id = skid
+                ORDER BY id
+                FOR NO KEY UPDATE;
+
+            WITH RECURSIVE downstream(id) AS (
+                SELECT split_node_id
+                UNION ALL
+                SELECT t.id
+                FROM downstream d
+                JOIN treenode t
+                    ON t.parent_id = d.id
+            )
+            SELECT array_agg(id) INTO moved FROM downstream;
+
+            UPDATE treenode
+                SET skeleton_id = new_skeleton_id,
+                    parent_id = CASE WHEN id = split_node_id THEN NULL
+                        ELSE parent_id END,
+                    editor_id = CASE WHEN id = split_node_id THEN editor
+                        ELSE editor_id END
+                WHERE id = ANY(moved);
+            UPDATE treenode_connector
+                SET skeleton_id = new_skeleton_id
+                WHERE treenode_id = ANY(moved);
+            UPDATE review
+                SET skeleton_id = new_skeleton_id
+                WHERE treenode_id = ANY(moved);
+
+            RETURN array_length(moved, 1);
+        END;
+        $$;
+
+    -- Merge the skeleton of to_node_id into the skeleton of from_node_id: the
+    -- former is rerooted at to_node_id, which becomes a child of from_node_id,
+    -- and all its treenodes, connector links and reviews are moved. The now
+    -- empty skeleton class instance is left to the caller. Returns the ID of
+    -- the merged in skeleton.
+    CREATE FUNCTION join_skeletons(from_node_id bigint, to_node_id bigint,
+            editor integer)
+    RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+        DECLARE
+            from_skid integer;
+            to_skid integer;
+        BEGIN
+
+            SELECT skeleton_id INTO from_skid FROM treenode WHERE id = from_node_id;
+            IF NOT FOUND THEN
+                RAISE EXCEPTION 'Could not find a skeleton for treenode #%', from_node_id;
+            END IF;
+            SELECT skeleton_id INTO to_skid FROM treenode WHERE id = to_node_id;
+            IF NOT FOUND THEN
+                RAISE EXCEPTION 'Could not find a skeleton for treenode #%', to_node_id;
+            END IF;
+            IF from_skid = to_skid THEN
+                RAISE EXCEPTION 'Cannot join treenodes of the same skeleton, this would introduce a loop.';
+            END IF;
+
+            PERFORM reroot_skeleton(to_node_id);
+
+            UPDATE treenode
+                SET skeleton_id = from_skid,
+                    parent_id = CASE WHEN id = to_node_id THEN from_node_id
+                        ELSE parent_id END,
+                    editor_id = CASE WHEN id = to_node_id THEN editor
+                        ELSE editor_id END
+                WHERE skeleton_id = to_skid;
+            UPDATE treenode_connector
+                SET skeleton_id = from_skid
+                WHERE skeleton_id = to_skid;
+            UPDATE review
+                SET skeleton_id = from_skid
+                WHERE skeleton_id = to_skid;
+
+            RETURN to_skid;
+        END;
+        $$;
+"""
+
+remove_skeleton_edit_functions = """
+    DROP FUNCTION join_skeletons(bigint, bigint, integer);
+    DROP FUNCTION split_skeleton(bigint, integer, integer);
+    DROP FUNCTION reroot_skeleton(bigint);
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0015_add_skeleton_adjacency_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_skeleton_edit_functions,
+                          remove_skeleton_edit_functions),
+    ]
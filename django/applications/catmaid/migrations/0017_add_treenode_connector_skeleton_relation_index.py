@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- Listing the links of a skeleton with a particular relation, ordered by
+    -- connector, is possible with an index scan only.
+    CREATE INDEX treenode_connector_skeleton_relation_connector_index
+        ON treenode_connector (skeleton_id, relation_id, connector_id);
+
+    -- Finding the partner links of a set of connectors.
+    CREATE INDEX treenode_connector_connector_relation_index
+        ON treenode_connector (connector_id, relation_id);
+"""
+
+backward = """
+    DROP INDEX treenode_connector_connector_relation_index;
+    DROP INDEX treenode_connector_skeleton_relation_connector_index;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0016_add_skeleton_edit_functions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
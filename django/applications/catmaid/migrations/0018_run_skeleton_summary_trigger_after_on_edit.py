@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- BEFORE triggers of the same event run in alphabetical order of their
+    -- names. The skeleton summary trigger has to run after on_edit_treenode,
+    -- which sets the edition time of updated nodes, to store the time of the
+    -- current edit rather than the one of the previous edit.
+    ALTER TRIGGER on_change_treenode_update_skeleton_summary ON treenode
+        RENAME TO on_edit_treenode_update_skeleton_summary;
+
+    -- Edition times stored so far can be too old
+    SELECT rebuild_skeleton_summary(NULL);
+"""
+
+backward = """
+    ALTER TRIGGER on_edit_treenode_update_skeleton_summary ON treenode
+        RENAME TO on_change_treenode_update_skeleton_summary;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0017_add_treenode_connector_skeleton_relation_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
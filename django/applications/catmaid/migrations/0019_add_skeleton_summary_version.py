@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+update_skeleton_summary = """
+    -- Add the passed in deltas to the summary of a skeleton, which is created
+    -- if it doesn't exist yet.
+    CREATE OR REPLACE FUNCTION update_skeleton_summary(skid integer, pid integer,
+            node_delta integer, branch_delta integer, end_delta integer,
+            cable_delta double precision, review_delta integer,
+            edit_time timestamp with time zone, editor integer)
+    RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+
+            INSERT INTO catmaid_skeleton_summary AS s (skeleton_id,
+                    project_id, num_nodes, num_branches, num_ends,
+                    cable_length, num_reviewed_nodes, last_edition_time,
+                    last_editor_id)
+                VALUES (skid, pid, node_delta, branch_delta, end_delta,
+                    cable_delta, review_delta, edit_time, editor)
+            ON CONFLICT (skeleton_id) DO UPDATE SET
+                num_nodes = s.num_nodes + EXCLUDED.num_nodes,
+                num_branches = s.num_branches + EXCLUDED.num_branches,
+                num_ends = s.num_ends + EXCLUDED.num_ends,
+                cable_length = s.cable_length + EXCLUDED.cable_length,
+                num_reviewed_nodes = s.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes,
+                last_editor_id = CASE
+                    WHEN EXCLUDED.last_edition_time IS NOT NULL AND
+                        (s.last_edition_time IS NULL OR
+                         EXCLUDED.last_edition_time >= s.last_edition_time)
+                    THEN EXCLUDED.last_editor_id
+                    ELSE s.last_editor_id END,
+                last_edition_time = GREATEST(s.last_edition_time,
+                    EXCLUDED.last_edition_time)%s;
+        END;
+        $$;
+"""
+
+forward = """
+    -- A number that changes with every change of a skeleton's summary, i.e.
+    -- with every change of its nodes, which caches of data derived from a
+    -- skeleton can be validated with. Unlike last_edition_time, it also changes
+    -- if two edits get the same edition time or if a transaction that started
+    -- earlier commits later. Values are taken from a sequence, so that they
+    -- aren't reused, not even if the summary is rebuilt.
+    CREATE SEQUENCE catmaid_skeleton_summary_version_seq;
+    ALTER TABLE catmaid_skeleton_summary ADD COLUMN version bigint NOT NULL
+        DEFAULT nextval('catmaid_skeleton_summary_version_seq');
+""" + update_skeleton_summary % """,
+                version = nextval('catmaid_skeleton_summary_version_seq')"""
+
+backward = update_skeleton_summary % "" + """
+    ALTER TABLE catmaid_skeleton_summary DROP COLUMN version;
+    DROP SEQUENCE catmaid_skeleton_summary_version_seq;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0018_run_skeleton_summary_trigger_after_on_edit'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
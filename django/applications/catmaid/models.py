@@ -12,7 +12,8 @@ from django.contrib.postgres.fields import JSONField
 from django.core.validators import RegexValidator
 from django.db import connection, models
 from django.db.models import Q
-from django.db.models.signals import pre_save, post_save
+from django.core.signals import request_started
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
@@ -359,6 +360,28 @@ class Relation(models.Model):
         db_table = "relation"
 
 
+def on_relation_or_class_change(sender, instance, **kwargs):
+    """ Invalidate the cached name to ID map of the project a relation or
+    class belongs to.
+    """
+    from catmaid.control.common import invalidate_id_map_cache
+    invalidate_id_map_cache(sender._meta.db_table, instance.project_id)
+
+def on_request_started(sender, **kwargs):
+    """ Every request starts a new transaction, name to ID maps changed in
+    previous ones can be cached again.
+    """
+    from catmaid.control.common import reset_uncommitted_id_maps
+    reset_uncommitted_id_maps()
+
+# Keep cached relation and class name to ID maps up to date
+post_save.connect(on_relation_or_class_change, sender=Class)
+post_delete.connect(on_relation_or_class_change, sender=Class)
+post_save.connect(on_relation_or_class_change, sender=Relation)
+post_delete.connect(on_relation_or_class_change, sender=Relation)
+request_started.connect(on_request_started)
+
+
 class RelationInstance(models.Model):
     # Repeat the columns inherited from 'concept'
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -400,6 +423,25 @@ class BrokenSlice(models.Model):
     class Meta:
         db_table = "broken_slice"
 
+def on_stack_info_change(sender, instance, **kwargs):
+    """ Stack information and stack lists of projects are cached, changes to
+    projects, stacks, their links, broken slices and overlays invalidate them.
+    """
+    from catmaid.control.stack import invalidate_stack_info_cache
+    invalidate_stack_info_cache()
+
+# Keep cached stack information up to date
+post_save.connect(on_stack_info_change, sender=Project)
+post_delete.connect(on_stack_info_change, sender=Project)
+post_save.connect(on_stack_info_change, sender=Stack)
+post_delete.connect(on_stack_info_change, sender=Stack)
+post_save.connect(on_stack_info_change, sender=ProjectStack)
+post_delete.connect(on_stack_info_change, sender=ProjectStack)
+post_save.connect(on_stack_info_change, sender=Overlay)
+post_delete.connect(on_stack_info_change, sender=Overlay)
+post_save.connect(on_stack_info_change, sender=BrokenSlice)
+post_delete.connect(on_stack_info_change, sender=BrokenSlice)
+
 
 class ClassClass(models.Model):
     # Repeat the columns inherited from 'relation_instance'
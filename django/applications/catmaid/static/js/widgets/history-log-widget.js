@@ -431,6 +431,7 @@
     "skeletons.merge": "Merge skeletons",
     "skeletons.reroot": "Reroot skeleton",
     "skeletons.import": "Import skeleton",
+    "skeletons.edit": "Reroot, split and join skeletons",
     "projects.clear_tags": "Clear tags on project",
     "projects.update_tags": "Update tags on project",
     "stacks.clear_tags": "Clear tags on stack",
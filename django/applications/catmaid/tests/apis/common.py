@@ -5,6 +5,7 @@ from django.test.client import Client
 from guardian.shortcuts import assign_perm
 from guardian.management import create_anonymous_user
 
+from catmaid.control.common import clear_id_map_cache
 from catmaid.models import Project, Treenode, User
 
 
@@ -21,6 +22,9 @@ class CatmaidApiTestCase(TestCase):
         self.test_user_id = 3
         self.client = Client()
 
+        # Relations and classes of earlier tests were rolled back
+        clear_id_map_cache()
+
         p = Project.objects.get(pk=self.test_project_id)
 
         create_anonymous_user(object())
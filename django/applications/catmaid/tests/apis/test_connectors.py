@@ -71,6 +71,39 @@ class ConnectorsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_list_connector_outgoing_with_page_key(self):
+        self.fake_authentication()
+        request = {
+            'iDisplayLength': 2,
+            'iSortingCols': 1,
+            'iSortCol_0': 6,
+            'sSortDir_0': 'desc',
+            'relation_type': 1,
+            'skeleton_id': 235,
+            'page_key': ''}
+        response = self.client.post(
+                '/%d/connector/table/list' % self.test_project_id, request)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(4, parsed_response['iTotalRecords'])
+        self.assertEqual([432, 421], [r[0] for r in parsed_response['aaData']])
+        self.assertIsNotNone(parsed_response['next_page_key'])
+
+        request['page_key'] = json.dumps(parsed_response['next_page_key'])
+        response = self.client.post(
+                '/%d/connector/table/list' % self.test_project_id, request)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected_result = {
+                u'iTotalRecords': 4,
+                u'iTotalDisplayRecords': 4,
+                u'next_page_key': None,
+                u'aaData': [
+                    [356, 373, 7620.00, 2890.00, 0.0, 5, 5, u"", 5, u"test2", 377, u'2011-10-27T10:45:09.870000+00:00'],
+                    [356, 361, 7030.00, 1980.00, 0.0, 5, 5, u"", 9, u"test2", 367, u'2011-10-27T10:45:09.870000+00:00']]}
+        self.assertEqual(expected_result, parsed_response)
+
+
     def test_list_connector_incoming_with_connecting_skeletons(self):
         self.fake_authentication()
         response = self.client.post(
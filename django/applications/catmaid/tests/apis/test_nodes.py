@@ -1,5 +1,7 @@
 import json
+import struct
 
+from django.core.cache import caches
 from django.db import connection
 
 from catmaid.models import Connector, Treenode
@@ -457,3 +459,215 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual({}, parsed_response[2])
         self.assertEqual(False, parsed_response[3])
         self.assertEqual(expected_rel_response, parsed_response[4])
+
+
+    def test_node_list_cache(self):
+        self.fake_authentication()
+        caches['default'].clear()
+
+        params = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'treenode_ids': 2423,
+            'labels': 'false',
+        }
+
+        def get_node_list():
+            response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                    params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        uncached_response = get_node_list()
+
+        with self.settings(NODE_LIST_CACHE='default'):
+            # The first request fills the cache, the second one is served from
+            # it. Both are expected to contain everything the uncached
+            # response contains.
+            for i in range(2):
+                cached_response = get_node_list()
+                self.assertEqual(5, len(cached_response))
+                cached_treenode_ids = set(t[0] for t in cached_response[0])
+                cached_connector_ids = set(c[0] for c in cached_response[1])
+                for t in uncached_response[0]:
+                    self.assertIn(t[0], cached_treenode_ids)
+                for c in uncached_response[1]:
+                    self.assertIn(c[0], cached_connector_ids)
+                self.assertIn(2423, cached_treenode_ids)
+                self.assertEqual(uncached_response[4], cached_response[4])
+
+            # Moving a node has to invalidate the cached tiles it touches
+            treenode_id = 289
+            response = self.client.post(
+                    '/%d/node/update' % self.test_project_id, {
+                        'state': make_nocheck_state(),
+                        't[0][0]': treenode_id,
+                        't[0][1]': 5690,
+                        't[0][2]': 3340,
+                        't[0][3]': 0})
+            self.assertEqual(response.status_code, 200)
+
+            cached_response = get_node_list()
+            moved_node = [t for t in cached_response[0] if t[0] == treenode_id]
+            self.assertEqual(1, len(moved_node))
+            self.assertEqual([5690.0, 3340.0, 0.0], moved_node[0][2:5])
+
+    def test_node_list_cache_limit(self):
+        self.fake_authentication()
+        caches['default'].clear()
+
+        # A crowded view that is split into 36 small tiles
+        params = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'labels': 'false',
+        }
+
+        def get_node_list():
+            response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                    params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        uncached_response = get_node_list()
+        self.assertTrue(len(uncached_response[0]) > 8)
+
+        with self.settings(NODE_LIST_CACHE='default',
+                NODE_LIST_CACHE_TILE_SIZE=(1000, 1000, 100),
+                NODE_LIST_CACHE_MAX_TILES=64, NODE_LIST_MAXIMUM_COUNT=8):
+            # Each tile is queried with the full limit, the limit has to be
+            # applied to the merged result, both when computing tiles and
+            # when reading them from the cache.
+            for i in range(2):
+                cached_response = get_node_list()
+                self.assertTrue(len(cached_response[0]) <= 8)
+                self.assertTrue(len(cached_response[0]) > 0)
+                self.assertEqual(True, cached_response[3])
+
+    def test_node_list_binary(self):
+        self.fake_authentication()
+
+        params = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'labels': 'true',
+        }
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                params)
+        self.assertEqual(response.status_code, 200)
+        treenodes, connectors, labels, limit_reached, relation_map = \
+                json.loads(response.content)
+
+        def check_binary_response(response):
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'],
+                    'application/x-catmaid-node-list')
+            data = response.content
+            magic, version, flags, n_treenodes, n_connectors, n_links, \
+                    trailer_length = struct.unpack('<4sHHIIII', data[:24])
+            self.assertEqual('CMNL', magic)
+            self.assertEqual(1, version)
+            self.assertEqual(limit_reached, bool(flags & 1))
+            self.assertEqual(len(treenodes), n_treenodes)
+            self.assertEqual(len(connectors), n_connectors)
+            self.assertEqual(sum(len(c[7]) for c in connectors), n_links)
+
+            def padded(n):
+                return n + (-n % 8)
+
+            # Treenode IDs and parent IDs are the first two columns
+            offset = 24
+            treenode_ids = struct.unpack('<%dq' % n_treenodes,
+                    data[offset:offset + 8 * n_treenodes])
+            offset += padded(8 * n_treenodes)
+            parent_ids = struct.unpack('<%dq' % n_treenodes,
+                    data[offset:offset + 8 * n_treenodes])
+            self.assertEqual([t[0] for t in treenodes], list(treenode_ids))
+            self.assertEqual([-1 if t[1] is None else t[1] for t in treenodes],
+                    list(parent_ids))
+
+            trailer = json.loads(data[-trailer_length:])
+            self.assertEqual(labels, trailer['labels'])
+            self.assertEqual(relation_map, trailer['relation_map'])
+
+        binary_params = dict(params)
+        binary_params['format'] = 'binary'
+        check_binary_response(self.client.post(
+                '/%d/node/list' % (self.test_project_id,), binary_params))
+        check_binary_response(self.client.post(
+                '/%d/node/list' % (self.test_project_id,), params,
+                HTTP_ACCEPT='application/x-catmaid-node-list'))
+
+    def test_node_list_sections(self):
+        self.fake_authentication()
+
+        params = {
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'treenode_ids': 2423,
+            'labels': 'true',
+        }
+
+        section_params = dict(params)
+        section_params.update({
+            'z1': 0,
+            'z2': 9,
+            'n_sections': 3,
+            'section_step': 9,
+        })
+        response = self.client.post('/%d/node/list/sections' % (self.test_project_id,),
+                section_params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(3, len(parsed_response))
+
+        # Every section is expected to match the individually requested node
+        # list for the same bounding box.
+        for i, node_list in enumerate(parsed_response):
+            single_params = dict(params)
+            single_params.update({
+                'z1': i * 9,
+                'z2': (i + 1) * 9,
+            })
+            response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                    single_params)
+            self.assertEqual(response.status_code, 200)
+            expected = json.loads(response.content)
+
+            def sort_key(n):
+                return n[0]
+
+            self.assertEqual(sorted(expected[0], key=sort_key),
+                    sorted(node_list[0], key=sort_key))
+            self.assertEqual(sorted(c[0] for c in expected[1]),
+                    sorted(c[0] for c in node_list[1]))
+            for c in expected[1]:
+                links = [n for n in node_list[1] if n[0] == c[0]][0][7]
+                self.assertEqual(sorted(c[7], key=lambda l: l[4]),
+                        sorted(links, key=lambda l: l[4]))
+            self.assertEqual(expected[2], node_list[2])
+            self.assertEqual(expected[3], node_list[3])
+            self.assertEqual(expected[4], node_list[4])
+
+        # Requesting too many sections is an error
+        section_params['n_sections'] = 1000
+        response = self.client.post('/%d/node/list/sections' % (self.test_project_id,),
+                section_params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertTrue('error' in parsed_response)
@@ -1,8 +1,9 @@
 import json
 
-from guardian.shortcuts import assign_perm
+from guardian.shortcuts import assign_perm, remove_perm
 from guardian.utils import get_anonymous_user
 
+from catmaid.control.authentication import get_permission_cache_stats
 from catmaid.models import Project, User
 
 from .common import CatmaidApiTestCase
@@ -69,3 +70,38 @@ class ProjectsApiTests(CatmaidApiTestCase):
         # Check the third project:
         stacks = get_project(result, 5)['stacks']
         self.assertEqual(len(stacks), 2)
+
+    def test_permission_cache(self):
+        self.fake_authentication()
+        url = '/%d/node/list' % self.test_project_id
+
+        def has_permission_error():
+            response = self.client.post(url)
+            self.assertEqual(response.status_code, 200)
+            return 'permission_error' in json.loads(response.content)
+
+        # The second request is expected to be answered from the cache
+        self.assertFalse(has_permission_error())
+        hits = get_permission_cache_stats()['hits']
+        self.assertFalse(has_permission_error())
+        self.assertEqual(hits + 1, get_permission_cache_stats()['hits'])
+
+        # Removing permissions has to take effect immediately
+        test_user = User.objects.get(pk=self.test_user_id)
+        p = Project.objects.get(pk=self.test_project_id)
+        remove_perm('can_browse', test_user, p)
+        remove_perm('can_annotate', test_user, p)
+        self.assertTrue(has_permission_error())
+
+        # Only superusers can retrieve cache statistics
+        response = self.client.get('/permissions/cache-stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['permission_error'])
+
+        User.objects.create_superuser('super', 'super@example.com', 'super')
+        self.client.login(username='super', password='super')
+        response = self.client.get('/permissions/cache-stats')
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.content)
+        for field in ('hits', 'misses', 'invalidations', 'hit_rate', 'size'):
+            self.assertIn(field, stats)
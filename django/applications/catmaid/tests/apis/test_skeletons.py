@@ -1,7 +1,9 @@
 import json
 import re
 import StringIO
+import zlib
 
+from django.db import connection
 from django.shortcuts import get_object_or_404
 
 from catmaid.models import ClassInstance, ClassInstanceClassInstance
@@ -115,6 +117,22 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(parsed_response, expected_response)
 
 
+    def test_skeleton_analytics(self):
+        self.fake_authentication()
+        response = self.client.post('/%d/skeleton/analytics' % \
+                (self.test_project_id,), {'skeleton_ids[0]': 235,
+                'skeleton_ids[1]': 373, 'adjacents': 1})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        issues = dict(parsed_response['issues'])
+        self.assertEqual([235, 373], sorted(issues.keys()))
+        for skeleton_id, skeleton_issues in issues.iteritems():
+            treenode_ids = set(Treenode.objects.filter(
+                    skeleton_id=skeleton_id).values_list('id', flat=True))
+            for issue_type, treenode_id in skeleton_issues:
+                self.assertIn(str(issue_type), parsed_response)
+                self.assertIn(treenode_id, treenode_ids)
+
     def test_skeleton_node_count(self):
         self.fake_authentication()
 
@@ -135,6 +153,71 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(parsed_response, expected_response)
 
 
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+            '/%d/skeletons/measure' % self.test_project_id, {
+                'skeleton_ids[0]': 235,
+                'skeleton_ids[1]': 361,
+                'skeleton_ids[2]': 373})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        # Each row: skeleton ID, raw cable, smooth cable, number of inputs,
+        # number of outputs, number of nodes, number of branch nodes, number
+        # of end nodes and principal branch cable.
+        expected_response = {
+            235: [11243, 10640, 0, 3, 28, 2, 4, 7391.129118],
+            361: [4575, 4005, 1, 0, 9, 0, 2, 2142.009800],
+            373: [2345, 2324, 2, 0, 5, 0, 2, 1705.858546],
+        }
+        self.assertEqual(3, len(parsed_response))
+        for row in parsed_response:
+            expected_row = expected_response[row[0]]
+            self.assertEqual(expected_row[:7], row[1:8])
+            self.assertAlmostEqual(expected_row[7], row[8], places=4)
+
+    def test_synapse_centrality(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+            '/%d/skeletons/synapse-centrality' % self.test_project_id, {
+                'skeleton_ids[0]': 2462,
+                'skeleton_ids[1]': 373})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(['2462', '373'], sorted(parsed_response.keys()))
+
+        # Skeleton 2462 has one input on node 2461 and two outputs on node
+        # 2462, both children of node 2460.
+        skeleton = parsed_response['2462']
+        flow = dict(zip(skeleton['node_ids'], skeleton['flow_centrality']))
+        centrality = dict(zip(skeleton['node_ids'], skeleton['synapse_centrality']))
+        self.assertEqual({2459: 0, 2460: 0, 2461: 2, 2462: 2}, flow)
+        self.assertEqual({2459: 0, 2460: 0, 2461: 1, 2462: 1}, centrality)
+
+        # Without outputs, synapse centrality can't be computed
+        skeleton = parsed_response['373']
+        self.assertEqual(5, len(skeleton['node_ids']))
+        self.assertEqual([0] * 5, skeleton['flow_centrality'])
+        self.assertEqual([-1] * 5, skeleton['synapse_centrality'])
+
+        # Skeletons without a last edition time in their summary aren't
+        # cached, but still computed.
+        cursor = connection.cursor()
+        cursor.execute('''
+            UPDATE catmaid_skeleton_summary SET last_edition_time = NULL
+            WHERE skeleton_id = 373
+        ''')
+        with self.settings(SYNAPSE_CENTRALITY_CACHE='default'):
+            for i in range(2):
+                response = self.client.post(
+                    '/%d/skeletons/synapse-centrality' % self.test_project_id, {
+                        'skeleton_ids[0]': 2462,
+                        'skeleton_ids[1]': 373})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(parsed_response, json.loads(response.content))
+
     def test_split_skeleton(self):
         self.fake_authentication()
 
@@ -687,6 +770,48 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
 
+    def test_edit_skeletons(self):
+        self.fake_authentication()
+
+        operations = [
+            {'type': 'reroot', 'treenode_id': 407},
+            {'type': 'split', 'treenode_id': 2394},
+            {'type': 'join', 'from_id': 2415, 'to_id': 2396},
+        ]
+        response = self.client.post(
+                '/%d/skeletons/edit' % self.test_project_id,
+                {'operations': json.dumps(operations)})
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual({'newroot': 407}, results[0])
+        self.assertEqual(2388, results[1]['existing_skeleton_id'])
+        new_skeleton_id = results[1]['new_skeleton_id']
+        self.assertEqual({
+            'fromid': 2415,
+            'toid': 2396,
+            'result_skeleton_id': 2411,
+            'deleted_skeleton_id': new_skeleton_id}, results[2])
+
+        self.assertTreenodeHasProperties(405, 407, 373)
+        self.assertTreenodeHasProperties(377, 405, 373)
+        self.assertTreenodeHasProperties(2392, None, 2388)
+        self.assertTreenodeHasProperties(2396, 2415, 2411)
+        self.assertTreenodeHasProperties(2394, 2396, 2411)
+        self.assertEqual(0, ClassInstance.objects.filter(id=new_skeleton_id).count())
+
+        # If one operation fails, none is applied
+        operations = [
+            {'type': 'reroot', 'treenode_id': 405},
+            {'type': 'reroot', 'treenode_id': 405},
+        ]
+        response = self.client.post(
+                '/%d/skeletons/edit' % self.test_project_id,
+                {'operations': json.dumps(operations)})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('error' in json.loads(response.content))
+        self.assertTreenodeHasProperties(405, 407, 373)
+
+
     def test_skeleton_connectors_by_partner(self):
         self.fake_authentication()
 
@@ -863,6 +988,135 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertJSONEqual(response.content, expected_result)
 
 
+    def test_export_skeletons(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/export' % (self.test_project_id,)
+
+        response = self.client.post(url, {'skeleton_ids': [373, 235]})
+        self.assertEqual(response.status_code, 200)
+        swc = ''.join(response.streaming_content)
+        parts = re.split('^# skeleton_id (\d+)\n', swc, flags=re.MULTILINE)
+        self.assertEqual('', parts[0])
+        self.assertEqual(['235', '373'], parts[1::2])
+        for skeleton_id, part in zip(parts[1::2], parts[2::2]):
+            single = self.client.get('/%d/skeleton/%s/swc' % (
+                    self.test_project_id, skeleton_id))
+            self.compare_swc_data(single.content, part)
+
+        response = self.client.post(url, {
+            'skeleton_ids': [373],
+            'format': 'compact-json',
+            'with_connectors': 'true',
+            'with_tags': 'true'})
+        self.assertEqual(response.status_code, 200)
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(1, len(lines))
+        skeleton_id, nodes, connectors, tags = json.loads(lines[0])
+        self.assertEqual(373, skeleton_id)
+        single = json.loads(self.client.get('/%d/373/1/1/compact-skeleton' % (
+                self.test_project_id,)).content)
+        self.assertEqual(sorted(single[0]), sorted(nodes))
+        self.assertEqual(sorted(single[1]), sorted(connectors))
+        self.assertEqual(single[2], tags)
+
+        response = self.client.post(url, {'skeleton_ids': [373, 235],
+            'gzip': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        gzipped = ''.join(response.streaming_content)
+        self.assertEqual(swc, zlib.decompress(gzipped, 16 + zlib.MAX_WBITS))
+
+
+    def test_skeleton_3d_versions(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/3d-versions' % (self.test_project_id,)
+
+        response = self.client.post(url, {'skeleton_ids': [235, 373]})
+        self.assertEqual(response.status_code, 200)
+        versions = json.loads(response.content)
+        self.assertEqual(['235', '373'], sorted(versions.keys()))
+        self.assertNotEqual(versions['235'], versions['373'])
+
+        # Uncached and cached responses are the same, the latter have the
+        # current version as ETag.
+        json_url = '/%d/skeleton/235/compact-json' % (self.test_project_id,)
+        uncached = self.client.post(json_url)
+        self.assertEqual(uncached.status_code, 200)
+        self.assertFalse(uncached.has_header('ETag'))
+        with self.settings(SKELETON_3D_CACHE='default'):
+            for i in range(2):
+                cached = self.client.post(json_url)
+                self.assertEqual(cached.status_code, 200)
+                self.assertEqual(uncached.content, cached.content)
+                self.assertEqual('"%s"' % versions['235'], cached['ETag'])
+
+        # Both representations of the same data are cached separately
+        metadata_url = '/%d/skeleton/235/json' % (self.test_project_id,)
+        uncached = self.client.post(metadata_url)
+        self.assertEqual(uncached.status_code, 200)
+        with self.settings(SKELETON_3D_CACHE='default'):
+            compact = self.client.post(json_url, {'all_fields': 'true'})
+            self.assertEqual(compact.status_code, 200)
+            cached = self.client.post(metadata_url)
+            self.assertEqual(cached.status_code, 200)
+            self.assertEqual(uncached.content, cached.content)
+
+        # Only the version of the reviewed skeleton changes
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+            review_time="2014-03-17T18:14:34.851Z", skeleton_id=235,
+            treenode_id=253)
+        response = self.client.post(url, {'skeleton_ids': [235, 373]})
+        new_versions = json.loads(response.content)
+        self.assertNotEqual(versions['235'], new_versions['235'])
+        self.assertEqual(versions['373'], new_versions['373'])
+
+        # Radius and confidence edits change neither counts nor the cable
+        # length, but still result in a new version and response.
+        for field, value in (('radius', 42), ('confidence', 1)):
+            with self.settings(SKELETON_3D_CACHE='default'):
+                versions = new_versions
+                Treenode.objects.filter(id=253).update(**{field: value})
+                response = self.client.post(url, {'skeleton_ids': [235, 373]})
+                new_versions = json.loads(response.content)
+                self.assertNotEqual(versions['235'], new_versions['235'])
+                self.assertEqual(versions['373'], new_versions['373'])
+
+                cached = self.client.post(json_url)
+                self.assertEqual('"%s"' % new_versions['235'], cached['ETag'])
+            uncached = self.client.post(json_url)
+            self.assertEqual(uncached.content, cached.content)
+
+
+    def test_compact_arbors(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/compact-arbor' % (self.test_project_id,)
+
+        response = self.client.post(url, {'skeleton_ids': [235, 373, 2364]})
+        self.assertEqual(response.status_code, 200)
+        arbors = json.loads(response.content)
+        self.assertEqual(['235', '2364', '373'], sorted(arbors.keys()))
+        for skeleton_id, (nodes, connectors, tags) in arbors.iteritems():
+            single = json.loads(self.client.get('/%d/%s/1/1/1/compact-arbor' % (
+                    self.test_project_id, skeleton_id)).content)
+            self.assertEqual(sorted(single[0]), sorted(nodes))
+            self.assertEqual(sorted(single[1]), sorted(connectors))
+            self.assertEqual(single[2], tags)
+        self.assertTrue(len(arbors['373'][1]) > 0)
+
+        response = self.client.post(url, {'skeleton_ids': [373],
+            'with_nodes': 0, 'with_tags': 0})
+        self.assertEqual(response.status_code, 200)
+        nodes, connectors, tags = json.loads(response.content)['373']
+        self.assertEqual([], nodes)
+        self.assertEqual({}, tags)
+        self.assertEqual(sorted(arbors['373'][1]), sorted(connectors))
+
+        response = self.client.post(url, {'skeleton_ids': [373, 99999999]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual("Skeletons don't exist: 99999999",
+                json.loads(response.content)['error'])
+
+
     def test_swc_file(self):
         self.fake_authentication()
         url = '/%d/skeleton/235/swc' % (self.test_project_id,)
@@ -1,5 +1,7 @@
 import json
 
+from catmaid.models import Stack
+
 from .common import CatmaidApiTestCase
 
 
@@ -45,3 +47,20 @@ class StacksApiTests(CatmaidApiTestCase):
         }
 
         self.assertEqual(expected_result, parsed_response)
+
+    def test_stack_info_after_change(self):
+        self.fake_authentication()
+        test_stack_id = 3
+        url = '/%d/stack/%d/info' % (self.test_project_id, test_stack_id)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        # Cached stack information has to reflect changed stacks
+        stack = Stack.objects.get(pk=test_stack_id)
+        stack.title = 'Changed title'
+        stack.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('Changed title', parsed_response['stitle'])
@@ -1,9 +1,14 @@
+from datetime import timedelta
+
 from django.core.management import call_command
 from django.test import TestCase
 from django.test.client import Client
+from django.db import connection
+from django.utils import timezone
 from django.utils.six import StringIO
 from guardian.shortcuts import assign_perm
-from catmaid.models import Class, ClassInstance, Project, User, Treenode
+from catmaid.models import Class, ClassInstance, Connector, Project, \
+        Relation, User, Treenode, TreenodeConnector
 
 
 class PruneSkeletonsTest(TestCase):
@@ -39,6 +44,167 @@ class PruneSkeletonsTest(TestCase):
         call_command('catmaid_prune_skeletons', project_id=[p.project.id], stdout=out)
         self.assertIn('Deleted 4 nodes in project "%s"' % p.project.id, out.getvalue())
 
+class SkeletonSummaryTest(TestCase):
+    """
+    Test the trigger maintained skeleton summary table and its rebuild
+    management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+
+    def get_summary(self, skeleton_id):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT num_nodes, num_branches, num_ends, cable_length,
+                   root_node_id
+            FROM catmaid_skeleton_summary
+            WHERE skeleton_id = %s
+        """, (skeleton_id,))
+        return cursor.fetchone()
+
+    def test_summary_updates(self):
+        p = TestProject(self.user)
+        skeleton = p.create_neuron()
+        skid = skeleton.id
+        root = p.create_node(0, 0, 0, None, skeleton)
+        n1 = p.create_node(0, 0, 10, root.id, skeleton)
+        n2 = p.create_node(0, 10, 10, n1.id, skeleton)
+        n3 = p.create_node(0, -10, 10, n1.id, skeleton)
+        # The root (one child) and both leaves are ends, n1 is a branch
+        self.assertEqual((4, 1, 3, 30.0, root.id), self.get_summary(skid))
+
+        # Moving a node updates both of its edges
+        n1.location_z = 20
+        n1.save()
+        summary = self.get_summary(skid)
+        self.assertAlmostEqual(20 + 2 * 10 * 2 ** 0.5, summary[3], places=4)
+
+        # Removing a leaf turns the branch into a regular node
+        Treenode.objects.filter(id=n3.id).delete()
+        summary = self.get_summary(skid)
+        self.assertEqual((3, 0, 2, root.id), summary[:3] + (summary[4],))
+
+        # Reroot the skeleton at the remaining leaf
+        Treenode.objects.filter(id=n2.id).update(parent=None)
+        Treenode.objects.filter(id=n1.id).update(parent=n2)
+        Treenode.objects.filter(id=root.id).update(parent=n1)
+        summary = self.get_summary(skid)
+        self.assertEqual((3, 0, 2, n2.id), summary[:3] + (summary[4],))
+
+        # A rebuild yields the same values
+        call_command('catmaid_rebuild_skeleton_summary',
+                project_id=[p.project.id], stdout=StringIO())
+        rebuilt_summary = self.get_summary(skid)
+        self.assertEqual(summary[:3], rebuilt_summary[:3])
+        self.assertAlmostEqual(summary[3], rebuilt_summary[3], places=4)
+        self.assertEqual(summary[4], rebuilt_summary[4])
+
+        # Without nodes, there is no summary
+        Treenode.objects.filter(skeleton_id=skid).delete()
+        self.assertEqual(None, self.get_summary(skid))
+
+    def get_last_edition_time(self, skeleton_id):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT last_edition_time
+            FROM catmaid_skeleton_summary
+            WHERE skeleton_id = %s
+        """, (skeleton_id,))
+        return cursor.fetchone()[0]
+
+    def test_summary_edition_time(self):
+        p = TestProject(self.user)
+        old_time = timezone.now() - timedelta(days=1)
+        skeletons = []
+        for i in range(2):
+            skeleton = p.create_neuron()
+            root = p.create_node(0, 0, 0, None, skeleton, old_time)
+            node = p.create_node(0, 0, 10, root.id, skeleton, old_time)
+            self.assertEqual(old_time, self.get_last_edition_time(skeleton.id))
+            skeletons.append((skeleton.id, node.id))
+
+        # Updates that don't set the edition time themselves, like moving a
+        # node or changing its radius, get the edition time set by the
+        # database, which the summary has to use.
+        (skid1, node1), (skid2, node2) = skeletons
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE location SET location_z = 20 WHERE id = %s
+        """, (node1,))
+        Treenode.objects.filter(id=node2).update(radius=5)
+        for skid, node_id in skeletons:
+            last_edition_time = self.get_last_edition_time(skid)
+            self.assertTrue(last_edition_time > old_time)
+            self.assertEqual(Treenode.objects.get(id=node_id).edition_time,
+                    last_edition_time)
+
+        # A rebuild yields the same edition times
+        call_command('catmaid_rebuild_skeleton_summary',
+                project_id=[p.project.id], stdout=StringIO())
+        for skid, node_id in skeletons:
+            self.assertEqual(Treenode.objects.get(id=node_id).edition_time,
+                    self.get_last_edition_time(skid))
+
+
+class SkeletonAdjacencyTest(TestCase):
+    """
+    Test the trigger maintained skeleton adjacency table and its rebuild
+    management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+
+    def get_adjacency(self, project_id):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT pre_skeleton_id, post_skeleton_id, relation_id,
+                   confidence_histogram
+            FROM skeleton_adjacency
+            WHERE project_id = %s
+            ORDER BY pre_skeleton_id, post_skeleton_id, relation_id
+        """, (project_id,))
+        return [tuple(row) for row in cursor.fetchall()]
+
+    def test_adjacency_updates(self):
+        p = TestProject(self.user)
+        pre = p.create_relation('presynaptic_to')
+        post = p.create_relation('postsynaptic_to')
+        sk1, sk2, sk3 = p.create_neuron(), p.create_neuron(), p.create_neuron()
+        n1 = p.create_node(0, 0, 0, None, sk1)
+        n2 = p.create_node(10, 0, 0, None, sk2)
+        n3 = p.create_node(20, 0, 0, None, sk3)
+        connector = p.create_connector(10, 10, 0)
+        p.create_link(n1, connector, pre, sk1)
+        l2 = p.create_link(n2, connector, post, sk2, confidence=3)
+        p.create_link(n3, connector, post, sk3)
+
+        self.assertEqual([
+            (sk1.id, sk2.id, pre.id, [0, 0, 1, 0, 0]),
+            (sk1.id, sk3.id, pre.id, [0, 0, 0, 0, 1]),
+        ], self.get_adjacency(p.project.id))
+
+        # Links that change their skeleton, like on joins, move their
+        # connections to the new skeleton.
+        TreenodeConnector.objects.filter(id=l2.id).update(skeleton=sk3)
+        adjacency = self.get_adjacency(p.project.id)
+        self.assertEqual([
+            (sk1.id, sk3.id, pre.id, [0, 0, 1, 0, 1]),
+        ], adjacency)
+
+        # A rebuild yields the same values
+        call_command('catmaid_rebuild_skeleton_adjacency',
+                project_id=[p.project.id], stdout=StringIO())
+        self.assertEqual(adjacency, self.get_adjacency(p.project.id))
+
+        # Without links, there are no connections
+        TreenodeConnector.objects.filter(connector=connector).delete()
+        self.assertEqual([], self.get_adjacency(p.project.id))
+
+
 class TestProject():
     """
     Create a new project, assign brows and annotate permissions to the test
@@ -63,7 +229,22 @@ class TestProject():
             return ClassInstance.objects.create(user=self.user, name="A skeleton",
                 project=self.project, class_column=self.class_map["skeleton"])
 
-    def create_node(self, x, y, z, parent_id, skeleton_id):
+    def create_relation(self, name):
+        return Relation.objects.get_or_create(project=self.project,
+                relation_name=name, defaults={'user': self.user})[0]
+
+    def create_connector(self, x, y, z):
+        return Connector.objects.create(location_x=x, location_y=y,
+                location_z=z, project=self.project, user=self.user,
+                editor=self.user)
+
+    def create_link(self, treenode, connector, relation, skeleton, confidence=5):
+        return TreenodeConnector.objects.create(treenode=treenode,
+                connector=connector, relation=relation, skeleton=skeleton,
+                confidence=confidence, project=self.project, user=self.user)
+
+    def create_node(self, x, y, z, parent_id, skeleton_id, edition_time=None):
         return Treenode.objects.create(location_x=x, location_y=y, location_z=z,
                 project=self.project, user=self.user, editor=self.user,
-                parent_id=parent_id, radius=-1, skeleton=skeleton_id)
+                parent_id=parent_id, radius=-1, skeleton=skeleton_id,
+                edition_time=edition_time or timezone.now())
@@ -187,6 +187,8 @@ class HistoryTableTests(TransactionTestCase):
         'treenode_connector_edge',
         'connector_geom',
         'catmaid_transaction_info',
+        'catmaid_skeleton_summary',
+        'skeleton_adjacency',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
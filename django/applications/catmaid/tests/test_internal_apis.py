@@ -1,10 +1,33 @@
+import os
+import shutil
+import tempfile
+import time
+
+from collections import defaultdict
+
+import networkx as nx
+import numpy as np
+
+from PIL import Image
+
+from django.db import connection
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.http import Http404
 from django.http.request import QueryDict
-from catmaid.control.common import get_request_list
+from catmaid.control import arbor_cache, cropping, label_store, \
+        metadata_cache, tile, tile_cache
+from catmaid.control.common import get_request_list, get_relation_to_id_map, \
+        get_class_to_id_map, clear_id_map_cache
 from catmaid.models import Project, Class, Relation, ClassInstance, \
-    ClassInstanceClassInstance
+    ClassInstanceClassInstance, Treenode
+from catmaid.control.graph import split_by_confidence_and_add_edges, \
+        split_by_synapse_domain
 from catmaid.control.neuron_annotations import delete_annotation_if_unused
+from catmaid.control.skeleton import _reroot_skeleton
+from catmaid.control.synapseclustering import distanceMatrix, tree_max_density
+from catmaid.control.tree_util import Arbor, lazy_load_arbors, \
+        lazy_load_trees, find_root, edge_count_to_root, simplify, partition, cable_length
 
 
 class InternalApiTestsNoDB(TestCase):
@@ -31,12 +54,690 @@ class InternalApiTestsNoDB(TestCase):
         self.assertEqual(get_request_list(q4, 'a'), [['1', '2', '3']])
         self.assertEqual(get_request_list(q4, 'a', map_fn=int), [[1, 2, 3]])
 
+    def test_arbor(self):
+        # 1 -> 2 -> 3, 2 -> 4 -> 5, 1 -> 6
+        node_ids = [5, 3, 1, 6, 2, 4]
+        parent_ids = [4, 2, None, 1, 1, 2]
+        locations = [(3, 0, 0), (2, 1, 0), (0, 0, 0), (0, 2, 0), (1, 0, 0), (2, 0, 0)]
+        arbor = Arbor(node_ids, parent_ids, locations)
+        tree = arbor.to_digraph()
+        self.assertEqual(sorted(tree.edges()),
+                [(1, 2), (1, 6), (2, 3), (2, 4), (4, 5)])
+        self.assertEqual(tree.node[3]['location_y'], 1.0)
+
+        self.assertEqual(arbor.find_root(), find_root(tree))
+        self.assertEqual(arbor.edge_count_to_root(), edge_count_to_root(tree))
+        self.assertEqual(sorted(arbor.children(2)), [3, 4])
+        self.assertEqual(arbor.parent(1), None)
+        self.assertEqual(arbor.parent(5), 4)
+        self.assertTrue(5 in arbor)
+        self.assertFalse(7 in arbor)
+        self.assertRaises(ValueError, arbor.index, 7)
+
+        sizes = arbor.subtree_sizes()
+        self.assertEqual([sizes[arbor.index(n)] for n in (1, 2, 3, 4, 5, 6)],
+                [6, 4, 1, 2, 1, 1])
+        self.assertEqual(arbor.find_common_ancestor([3, 5]), (2, 1))
+        self.assertEqual(arbor.find_common_ancestor([5, 6]), (1, 0))
+        self.assertEqual(arbor.find_common_ancestor([5]), (5, 3))
+
+        self.assertEqual(list(arbor.partition()), list(partition(tree)))
+        locations_map = {n: l for n, l in zip(node_ids, locations)}
+        self.assertAlmostEqual(arbor.cable_length(),
+                cable_length(tree, locations_map))
+
+        # Simplification doesn't change the arbor, unlike simplify()
+        mini = arbor.simplify([3, 5, 6])
+        expected = simplify(tree.copy(), [3, 5, 6])
+        self.assertEqual(sorted(sorted(e) for e in mini.edges()),
+                sorted(sorted(e) for e in expected.edges()))
+        self.assertEqual(sorted(mini.nodes()), [2, 3, 5, 6])
+        self.assertEqual(arbor.find_root(), 1)
+
+        arbor.reroot(5)
+        self.assertEqual(arbor.find_root(), 5)
+        self.assertEqual(sorted(arbor.to_digraph().edges()),
+                [(1, 6), (2, 1), (2, 3), (4, 2), (5, 4)])
+        self.assertEqual(arbor.edge_count_to_root()[6], 5)
+
+    def test_tree_max_density(self):
+        # Two groups of synapses, on 1, 2, 3, 7 and on 4, 5, 6, which are
+        # connected through a long edge between 3 and 4. Node 7 branches off
+        # of 2.
+        tree = nx.Graph()
+        tree.add_edge(1, 2, weight=10)
+        tree.add_edge(2, 3, weight=10)
+        tree.add_edge(3, 4, weight=1000)
+        tree.add_edge(4, 5, weight=10)
+        tree.add_edge(5, 6, weight=10)
+        tree.add_edge(2, 7, weight=5)
+
+        D, id2index = distanceMatrix(tree, [6, 1])
+        self.assertEqual(D.shape, (2, 7))
+        rows = sorted((1, 6), key=id2index.get)
+        expected = {1: [0, 10, 20, 1020, 1030, 1040, 15],
+                    6: [1040, 1030, 1020, 20, 10, 0, 1035]}
+        for row, node in enumerate(rows):
+            self.assertEqual([D[row, id2index[n]] for n in range(1, 8)],
+                    expected[node])
+
+        groups = tree_max_density(tree, [1, 2, 3, 7, 4, 5, 6, 6],
+                [11, 12, 13, 17, 14, 15, 16, 18],
+                ['pre', 'post', 'pre', 'pre', 'pre', 'pre', 'post', 'post'],
+                [5, 100000])
+        self.assertEqual(len(groups[5]), 2)
+        by_nodes = {tuple(g.node_ids): g for g in groups[5].itervalues()}
+        self.assertEqual(sorted(by_nodes.keys()), [(1, 2, 3, 7), (4, 5, 6, 6)])
+        self.assertEqual(by_nodes[(1, 2, 3, 7)].local_max, 2)
+        self.assertEqual(by_nodes[(1, 2, 3, 7)].connector_ids, [11, 12, 13, 17])
+        self.assertEqual(by_nodes[(4, 5, 6, 6)].local_max, 5)
+        self.assertEqual(by_nodes[(4, 5, 6, 6)].relations,
+                ['pre', 'pre', 'post', 'post'])
+        self.assertEqual(len(groups[100000]), 1)
+        self.assertEqual(groups[100000][0].local_max, 3)
+        self.assertEqual(groups[100000][0].connector_ids,
+                [11, 12, 13, 17, 14, 15, 16, 18])
+
+        # The same tree as Arbor, with edge lengths given by the locations
+        arbor = Arbor([1, 2, 3, 4, 5, 6, 7], [None, 1, 2, 3, 4, 5, 2],
+                [(0, 0, 0), (10, 0, 0), (20, 0, 0), (1020, 0, 0),
+                 (1030, 0, 0), (1040, 0, 0), (10, 5, 0)])
+        D, id2index = distanceMatrix(arbor, [6, 1])
+        for row, node in enumerate(sorted((1, 6), key=id2index.get)):
+            self.assertEqual([D[row, id2index[n]] for n in range(1, 8)],
+                    expected[node])
+
+        groups = tree_max_density(arbor, [1, 2, 3, 7, 4, 5, 6, 6],
+                [11, 12, 13, 17, 14, 15, 16, 18],
+                ['pre', 'post', 'pre', 'pre', 'pre', 'pre', 'post', 'post'],
+                [5, 100000])
+        by_nodes = {tuple(g.node_ids): g.local_max for g in groups[5].itervalues()}
+        self.assertEqual(by_nodes, {(1, 2, 3, 7): 2, (4, 5, 6, 6): 5})
+        self.assertEqual(len(groups[100000]), 1)
+
+    def test_split_by_confidence(self):
+        # Skeleton 10: 1 -> 2 -> 3 (low confidence) -> 4, 2 -> 5
+        # Skeleton 20: 6 -> 7
+        rows = [(1, None, 5, 10), (2, 1, 5, 10), (3, 2, 1, 10), (4, 3, 5, 10),
+                (5, 2, 4, 10), (6, None, 5, 20), (7, 6, 2, 20)]
+        reviews = {2: [3], 6: [3, 4]}
+        arbors, fragments = split_by_confidence_and_add_edges(3, rows, reviews)
+        self.assertEqual(sorted(arbors.keys()), [10, 20])
+        self.assertEqual(sorted(sorted(g.edges()) for g in arbors[10]),
+                [[(1, 2), (2, 5)], [(3, 4)]])
+        self.assertEqual(sorted(sorted(g.nodes()) for g in arbors[20]),
+                [[6], [7]])
+        self.assertEqual(arbors[10][0].node[2]['reviewer_ids'], [3])
+        self.assertEqual(arbors[10][0].node[1]['reviewer_ids'], [])
+
+        arbor_of = fragments.lookup([1, 5, 4, 7, 8])
+        self.assertEqual(sorted(arbor_of.keys()), [1, 4, 5, 7])
+        self.assertTrue(arbor_of[1] is arbor_of[5])
+        self.assertTrue(4 in arbor_of[4])
+        self.assertFalse(arbor_of[1] is arbor_of[4])
+
+        # Without a threshold, skeletons aren't split
+        arbors, fragments = split_by_confidence_and_add_edges(0, rows, reviews)
+        self.assertEqual([len(arbors[10]), len(arbors[20])], [1, 1])
+
+    def test_split_by_synapse_domain(self):
+        # Skeleton 10: 1 -> 2 -> 3 -> 4 -> 5 -> 6 with a synapse on each node
+        # and a long edge between 3 and 4.
+        rows = [(1, None, 5, 10), (2, 1, 5, 10), (3, 2, 5, 10),
+                (4, 3, 5, 10), (5, 4, 5, 10), (6, 5, 5, 10)]
+        arbors, fragments = split_by_confidence_and_add_edges(0, rows, {})
+        locations = {1: (0, 0, 0), 2: (10, 0, 0), 3: (20, 0, 0),
+                4: (1020, 0, 0), 5: (1030, 0, 0), 6: (1040, 0, 0)}
+        treenode_connector = {1: [(11, 'pre')], 2: [(12, 'post')],
+                3: [(13, 'pre')], 4: [(14, 'pre')], 5: [(15, 'post')],
+                6: [(16, 'post')]}
+        arbors2, minis = split_by_synapse_domain(5, locations, arbors,
+                treenode_connector, defaultdict(list))
+        self.assertEqual(sorted(sorted(g.nodes()) for g in arbors2[10]),
+                [[1, 2, 3], [4, 5, 6]])
+        self.assertEqual(len(minis[10]), 1)
+        self.assertEqual(sorted(minis[10][0].nodes()), [2, 5])
+
+    def test_arbor_patches(self):
+        # 1 -> 2 -> 3 -> 4, 2 -> 5
+        arbor = Arbor([1, 2, 3, 4, 5], [None, 1, 2, 3, 2])
+        def parents(a):
+            return dict(zip(a.node_ids.tolist(), a.parent_ids().tolist()))
+
+        self.assertEqual(arbor_cache._structure(arbor), (5, 1, 3, 1))
+
+        added = arbor_cache._add_node(arbor, 6, 3)
+        self.assertEqual(parents(added)[6], 3)
+        self.assertEqual(added.children(3), [4, 6])
+        self.assertRaises(ValueError, arbor_cache._add_node, arbor, 6, 7)
+
+        removed = arbor_cache._remove_node(arbor, 2)
+        self.assertEqual(parents(removed), {1: -1, 3: 1, 4: 3, 5: 1})
+
+        moved = arbor_cache._with_parents(arbor, [5], [4])
+        self.assertEqual(moved.parent(5), 4)
+        self.assertEqual(arbor.parent(5), 2)
+
+        upstream, downstream = arbor_cache._split(arbor, 3)
+        self.assertEqual(parents(upstream), {1: -1, 2: 1, 5: 2})
+        self.assertEqual(parents(downstream), {3: -1, 4: 3})
+
+        joined = arbor_cache._join(upstream, 5, downstream, 4)
+        self.assertEqual(parents(joined),
+                {1: -1, 2: 1, 5: 2, 4: 5, 3: 4})
+        self.assertEqual(downstream.find_root(), 3)
+
+        # Only arbors of the version an edit was made on are patched, others
+        # are removed from the cache.
+        version = (5, 1, 3, 1, None)
+        with self.settings(ARBOR_CACHE_SIZE=1024 * 1024):
+            arbor_cache._store(-10, version, arbor)
+            self.assertTrue(arbor_cache._current(-10, {-10: version}) is arbor)
+            self.assertIsNone(arbor_cache._current(-10, {}))
+            arbor_cache.on_reroot(-10, 3, versions={-10: (5, 1, 3, 2, None)})
+            self.assertIsNone(arbor_cache._current(-10, {-10: version}))
+
+    def test_tile_cache(self):
+        media_root = tempfile.mkdtemp()
+        try:
+            with self.settings(MEDIA_ROOT=media_root, TILE_CACHE_SIZE=25):
+                tile_cache.clear()
+                self.assertIsNone(tile_cache.get('http://tiles/0/0_0_0.jpg'))
+                tile_cache.put('http://tiles/0/0_0_0.jpg', b'0' * 10)
+                tile_cache.put('http://tiles/0/0_1_0.jpg', b'1' * 10)
+                # Mark the first tile as used after the second one
+                path = tile_cache._cache_path('http://tiles/0/0_1_0.jpg')
+                os.utime(path, (0, 0))
+                self.assertEqual(b'0' * 10,
+                        tile_cache.get('http://tiles/0/0_0_0.jpg'))
+
+                # Adding a third tile evicts the least recently used one
+                tile_cache.put('http://tiles/0/1_0_0.jpg', b'2' * 10)
+                self.assertEqual(b'0' * 10,
+                        tile_cache.get('http://tiles/0/0_0_0.jpg'))
+                self.assertIsNone(tile_cache.get('http://tiles/0/0_1_0.jpg'))
+                self.assertEqual(b'2' * 10,
+                        tile_cache.get('http://tiles/0/1_0_0.jpg'))
+
+                # Tiles larger than the cache aren't stored
+                tile_cache.put('http://tiles/0/1_1_0.jpg', b'3' * 30)
+                self.assertIsNone(tile_cache.get('http://tiles/0/1_1_0.jpg'))
+
+                tile_cache.clear()
+                self.assertIsNone(tile_cache.get('http://tiles/0/0_0_0.jpg'))
+
+            with self.settings(MEDIA_ROOT=media_root, TILE_CACHE_SIZE=0):
+                tile_cache.put('http://tiles/0/0_0_0.jpg', b'0' * 10)
+                self.assertIsNone(tile_cache.get('http://tiles/0/0_0_0.jpg'))
+        finally:
+            shutil.rmtree(media_root)
+
+    def test_hdf5_tile_region(self):
+        class ChunkedDataset(np.ndarray):
+            chunks = (32, 16)
+        data = np.arange(100 * 70, dtype=np.uint16).reshape(100, 70)
+        dataset = data.view(ChunkedDataset)
+
+        with self.settings(HDF5_CHUNK_CACHE_SIZE=1024 * 1024):
+            region = tile.read_region(dataset, ('test', 1, '/0/0/data'),
+                    40, -5, 50, 60)
+            expected = np.zeros((50, 60), dtype=np.uint16)
+            expected[:, 5:] = data[40:90, 0:55]
+            self.assertTrue((region == expected).all())
+
+            # Regions beyond the dataset are filled with zeros
+            region = tile.read_region(dataset, ('test', 1, '/0/0/data'),
+                    90, 60, 20, 20)
+            expected = np.zeros((20, 20), dtype=np.uint16)
+            expected[:10, :10] = data[90:100, 60:70]
+            self.assertTrue((region == expected).all())
+
+        with self.settings(HDF5_CHUNK_CACHE_SIZE=0):
+            region = tile.read_region(dataset, ('test', 2, '/0/0/data'),
+                    0, 0, 100, 70)
+            self.assertTrue((region == data).all())
+
+    def test_hdf5_pyramid_without_broker(self):
+        calls = []
+        class UnreachableBrokerTask(object):
+            def delay(self, *args):
+                calls.append(args)
+                raise IOError("Broker not reachable")
+
+        lock_id = tile.create_pyramid_lock_name(tile.get_hdf5_path(1, 2, 'test'))
+        build_pyramid_task = tile.build_pyramid_task
+        tile.build_pyramid_task = UnreachableBrokerTask()
+        try:
+            self.assertFalse(tile.build_pyramid(1, 2, 'test'))
+            self.assertEqual(1, len(calls))
+            # The task isn't launched again right away
+            self.assertFalse(tile.build_pyramid(1, 2, 'test'))
+            self.assertEqual(1, len(calls))
+        finally:
+            tile.build_pyramid_task = build_pyramid_task
+            tile.cache.delete(lock_id)
+
+    def test_hdf5_pyramid_downsampling(self):
+        data = np.array([[1, 3, 5], [3, 5, 7], [10, 10, 10]], dtype=np.uint8)
+        self.assertEqual(tile.downsample(data).tolist(), [[3, 6], [10, 10]])
+        self.assertEqual(tile.downsample(data, False).tolist(),
+                [[1, 5], [10, 10]])
+
+    def test_label_stroke_coalescing(self):
+        class ChunkedDataset(np.ndarray):
+            chunks = (16, 16, 1)
+        dataset = np.zeros((50, 40, 3), dtype=np.uint8).view(ChunkedDataset)
+        strokes = [
+            (5, 5, np.full((20, 20), 1, dtype=np.uint8)),
+            (10, -3, np.full((10, 10), 2, dtype=np.uint8)),
+            (45, 35, np.full((10, 10), 3, dtype=np.uint8))]
+        label_store.write_strokes(dataset, 1, strokes)
+
+        # Later strokes overwrite earlier ones, strokes are clipped at the
+        # dataset's border.
+        expected = np.zeros((50, 40), dtype=np.uint8)
+        expected[5:25, 5:25] = 1
+        expected[10:20, 0:7] = 2
+        expected[45:50, 35:40] = 3
+        self.assertTrue((np.asarray(dataset[:, :, 1]) == expected).all())
+        self.assertFalse(dataset[:, :, 0].any())
+
+        # Queued strokes are visible in regions read
+        region = np.zeros((10, 10), dtype=np.uint8)
+        for stroke in strokes:
+            label_store.apply_stroke(region, 15, 0, stroke)
+        self.assertTrue((region == expected[15:25, 0:10]).all())
+
+    def test_label_flush_failures(self):
+        class Dataset(np.ndarray):
+            chunks = None
+        class BrokenDataset(Dataset):
+            def __setitem__(self, key, value):
+                raise IOError("Write failed")
+        class File(dict):
+            def close(self):
+                pass
+        files = []
+        class H5py(object):
+            @staticmethod
+            def File(path, mode):
+                if not files:
+                    raise IOError("File not accessible")
+                return files[0]
+
+        datasets = File({
+            label_store.get_dataset_path(0): np.zeros((10, 10, 2),
+                    dtype=np.uint8).view(Dataset),
+            label_store.get_dataset_path(1): np.zeros((10, 10, 2),
+                    dtype=np.uint8).view(BrokenDataset)})
+        stroke = np.full((2, 2), 1, dtype=np.uint8)
+        storage_path = tempfile.mkdtemp()
+        store = label_store.LabelStore(os.path.join(storage_path, '1_2.hdf'))
+        h5py = getattr(label_store, 'h5py', None)
+        label_store.h5py = H5py
+        try:
+            # Nothing is lost if the file can't be opened
+            store.put(0, 1, 0, 0, stroke)
+            store.flush()
+            self.assertEqual(1, len(store.get_queued(0, 1)))
+            self.assertEqual(stroke.nbytes, store.pending_size)
+
+            # Only strokes of slices that couldn't be written stay queued, in
+            # front of newer strokes. Strokes without dataset are dropped.
+            files.append(datasets)
+            store.put(1, 1, 0, 0, stroke)
+            store.put(2, 1, 0, 0, stroke)
+            store.put(0, 0, 5, 5, stroke * 2)
+            store.flush()
+            self.assertEqual([], store.get_queued(0, 1))
+            self.assertEqual([], store.get_queued(0, 0))
+            self.assertEqual([], store.get_queued(2, 1))
+            self.assertEqual(1, len(store.get_queued(1, 1)))
+            self.assertEqual(1, datasets['/labels/scale/0/data'][0, 0, 1])
+            self.assertEqual(2, datasets['/labels/scale/0/data'][5, 5, 0])
+            store.put(1, 1, 1, 1, stroke * 3)
+            self.assertEqual([(0, 0), (1, 1)],
+                    [s[:2] for s in store.get_queued(1, 1)])
+
+            # Written and queued strokes are read
+            open(store.path, 'w').close()
+            store.put(0, 1, 1, 1, stroke * 4)
+            region = store.read(0, 1, 0, 0, 3, 3)
+            self.assertEqual([[1, 1, 0], [1, 4, 4], [0, 4, 4]],
+                    region.tolist())
+            self.assertEqual(None, store.read(2, 1, 0, 0, 3, 3))
+
+            datasets['/labels/scale/1/data'] = \
+                    np.zeros((10, 10, 2), dtype=np.uint8).view(Dataset)
+            store.flush()
+            self.assertEqual(0, store.pending_size)
+            self.assertEqual(3, datasets['/labels/scale/1/data'][1, 1, 1])
+            self.assertEqual(1, datasets['/labels/scale/1/data'][0, 0, 1])
+        finally:
+            if h5py:
+                label_store.h5py = h5py
+            else:
+                del label_store.h5py
+            shutil.rmtree(storage_path)
+
+    def test_tiff_writer(self):
+        # Odd image sizes need padding to word boundaries
+        stacks = {
+            'L': [np.arange(15, dtype=np.uint8).reshape(3, 5) * i
+                    for i in (1, 2, 3)],
+            'RGB': [np.arange(45, dtype=np.uint8).reshape(3, 5, 3) + i
+                    for i in (0, 100)],
+        }
+        output_dir = tempfile.mkdtemp()
+        try:
+            for mode, images in stacks.iteritems():
+                path = os.path.join(output_dir, mode + '.tiff')
+                writer = cropping.TiffWriter(path, x_resolution=0.25,
+                        y_resolution=0.5, description="ImageJ=1.45p\nunit=nm\n",
+                        software="Created with CATMAID")
+                try:
+                    for image in images:
+                        writer.write(image)
+                    self.assertRaises(ValueError, writer.write,
+                            np.zeros((3, 5), dtype=np.uint16))
+                finally:
+                    writer.close()
+
+                tiff = Image.open(path)
+                for i, image in enumerate(images):
+                    tiff.seek(i)
+                    self.assertEqual((5, 3), tiff.size)
+                    self.assertEqual(mode, tiff.mode)
+                    self.assertEqual((0.25, 0.5),
+                            tuple(float(r) for r in tiff.info['resolution']))
+                    self.assertTrue((np.asarray(tiff) == image).all())
+                self.assertRaises(EOFError, tiff.seek, len(images))
+                tiff.close()
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_crop_composition(self):
+        class Job(object):
+            needs_initialization = False
+            single_channel = False
+            rotation_cw = 0
+            zoom_level = 0
+            x_min, x_max, y_min, y_max = 0, 8, 0, 8
+            class ref_stack(object):
+                class resolution(object):
+                    x, y, z = 1.0, 1.0, 1.0
+                class dimension(object):
+                    x, y, z = 64, 64, 1
+        class BB(object):
+            def __init__(self, width, height):
+                self.width = width
+                self.height = height
+
+        # An 8x8 image whose pixel values are their index, stored in a 2x2
+        # grid of 4x4 tiles, plus a uniform 64x64 RGB tile.
+        image = np.arange(64, dtype=np.uint8).reshape(8, 8)
+        tile_dir = tempfile.mkdtemp()
+        def tile_url(name):
+            return 'file://' + os.path.join(tile_dir, name + '.png')
+        for y in range(2):
+            for x in range(2):
+                Image.fromarray(image[4 * y:4 * y + 4, 4 * x:4 * x + 4]).save(
+                        os.path.join(tile_dir, '%s_%s.png' % (y, x)))
+        Image.new('RGB', (64, 64), (200, 100, 50)).save(
+                os.path.join(tile_dir, 'rgb.png'))
+
+        def get_image_parts(x0, y0, x1, y1):
+            """ Image parts of a region of <image>. """
+            parts = []
+            for y in range(y0 // 4, (y1 - 1) // 4 + 1):
+                for x in range(x0 // 4, (x1 - 1) // 4 + 1):
+                    src_x0, src_y0 = max(x0 - 4 * x, 0), max(y0 - 4 * y, 0)
+                    parts.append(cropping.ImagePart(
+                            tile_url('%s_%s' % (y, x)), src_x0,
+                            min(x1 - 4 * x, 4), src_y0, min(y1 - 4 * y, 4),
+                            max(4 * x - x0, 0), max(4 * y - y0, 0)))
+            return parts
+
+        get_substack_parts = cropping.get_substack_parts
+        try:
+            # Parts of multiple tiles are composed, parts reaching beyond the
+            # image are clipped. Tiles are converted to the mode of the first
+            # tile of an image.
+            job = Job()
+            slices = [
+                (BB(7, 5), get_image_parts(1, 2, 8, 8)),
+                (BB(3, 2), [cropping.ImagePart(tile_url('rgb'), 0, 3, 0, 2,
+                        0, 0), cropping.ImagePart(tile_url('0_0'), 0, 4, 0, 4,
+                        2, 1)]),
+                (BB(2, 2), [])]
+            composed = list(cropping.compose_substack(job, slices))
+            self.assertEqual(2, len(composed))
+            self.assertTrue((composed[0] == image[2:7, 1:8]).all())
+            self.assertEqual((2, 3, 3), composed[1].shape)
+            self.assertEqual([200, 100, 50], composed[1][0, 0].tolist())
+            self.assertEqual([0, 0, 0], composed[1][1, 2].tolist())
+            job.single_channel = True
+            composed = list(cropping.compose_substack(job, slices[1:]))
+            self.assertEqual([[200, 200, 200], [200, 200, 0]],
+                    composed[0].tolist())
+
+            # Rotating the view clockwise rotates the image counterclockwise
+            cropping.get_substack_parts = lambda job: [
+                    (BB(8, 8), get_image_parts(0, 0, 8, 8))]
+            job = Job()
+            for rotation_cw, rotation_ccw in ((90, 1), (180, 2), (-90, 3)):
+                job.rotation_cw = rotation_cw % 360
+                n_images, images = cropping.iter_substack(job)
+                self.assertEqual(1, n_images)
+                self.assertTrue((next(images) ==
+                        np.rot90(image, rotation_ccw)).all())
+
+            # Other rotations crop the rotated bounding box of the region.
+            # Regions are scaled by the zoom level.
+            def get_rotated_parts(job):
+                x0 = cropping.to_x_index(job.x_min, job, False)
+                x1 = cropping.to_x_index(job.x_max, job, False)
+                y0 = cropping.to_y_index(job.y_min, job, False)
+                y1 = cropping.to_y_index(job.y_max, job, False)
+                return [(BB(x1 - x0, y1 - y0), [cropping.ImagePart(
+                        tile_url('rgb'), x0, x1, y0, y1, 0, 0)])]
+            cropping.get_substack_parts = get_rotated_parts
+            job = Job()
+            job.x_min, job.x_max, job.y_min, job.y_max = 16, 48, 24, 40
+            for zoom_level, size in ((0, (16, 32)), (1, (8, 16))):
+                job.zoom_level = zoom_level
+                job.rotation_cw = 30
+                n_images, images = cropping.iter_substack(job)
+                rotated = next(images)
+                self.assertEqual(size + (3,), rotated.shape)
+                self.assertEqual([200, 100, 50],
+                        rotated[size[0] // 2, size[1] // 2].tolist())
+                # The region of the job isn't changed
+                self.assertEqual((16, 48, 24, 40),
+                        (job.x_min, job.x_max, job.y_min, job.y_max))
+        finally:
+            cropping.get_substack_parts = get_substack_parts
+            shutil.rmtree(tile_dir)
+
+    def test_metadata_cache(self):
+        loads = []
+        def load():
+            loads.append(len(loads))
+            return len(loads)
+
+        with self.settings(METADATA_CACHE=None, METADATA_CACHE_TIMEOUT=300,
+                METADATA_CACHE_MAX_AGE=600):
+            self.assertEqual(1, metadata_cache.get('test', 'key', load))
+            self.assertEqual(1, metadata_cache.get('test', 'key', load))
+            self.assertEqual(1, len(loads))
+
+            # Invalidated namespaces are loaded again
+            metadata_cache.invalidate('test')
+            self.assertEqual(2, metadata_cache.get('test', 'key', load))
+
+        # Expired values are returned while they are refreshed in the
+        # background.
+        with self.settings(METADATA_CACHE=None, METADATA_CACHE_TIMEOUT=0,
+                METADATA_CACHE_MAX_AGE=600):
+            time.sleep(0.01)
+            self.assertEqual(2, metadata_cache.get('test', 'key', load))
+            for i in range(500):
+                if len(loads) == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(3, len(loads))
+        metadata_cache.invalidate('test')
+
+        # Values whose background refresh fails are removed, the next request
+        # loads them again and sees the error.
+        def fail():
+            loads.append(len(loads))
+            raise Http404("Stack not found")
+
+        with self.settings(METADATA_CACHE=None, METADATA_CACHE_TIMEOUT=0,
+                METADATA_CACHE_MAX_AGE=600):
+            del loads[:]
+            self.assertEqual(1, metadata_cache.get('test', 'key', load))
+            time.sleep(0.01)
+            self.assertEqual(1, metadata_cache.get('test', 'key', fail))
+            for i in range(500):
+                if not metadata_cache._refreshing:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(2, len(loads))
+            self.assertRaises(Http404, metadata_cache.get, 'test', 'key', fail)
+            self.assertEqual(3, len(loads))
+        metadata_cache.invalidate('test')
+
+        # Least recently used entries are dropped first
+        with self.settings(METADATA_CACHE=None, METADATA_CACHE_TIMEOUT=300,
+                METADATA_CACHE_MAX_AGE=600, METADATA_CACHE_MAX_ENTRIES=2):
+            del loads[:]
+            self.assertEqual(1, metadata_cache.get('test', 'a', load))
+            self.assertEqual(2, metadata_cache.get('test', 'b', load))
+            self.assertEqual(1, metadata_cache.get('test', 'a', load))
+            self.assertEqual(3, metadata_cache.get('test', 'c', load))
+            self.assertEqual(1, metadata_cache.get('test', 'a', load))
+            self.assertEqual(4, metadata_cache.get('test', 'b', load))
+            self.assertEqual(4, len(loads))
+        metadata_cache.invalidate('test')
+
+
 class InternalApiTests(TestCase):
     fixtures = ['catmaid_testdata']
 
     def setUp(self):
         self.test_user = User.objects.get(username="test0")
         self.test_project = Project.objects.get(id=3)
+        clear_id_map_cache()
+        arbor_cache.invalidate([373])
+
+    def test_id_map_cache(self):
+        relation_map = get_relation_to_id_map(self.test_project.id)
+        annotated_with = Relation.objects.get(project=self.test_project,
+                                              relation_name='annotated_with')
+        self.assertEqual(annotated_with.id, relation_map['annotated_with'])
+        self.assertEqual({'annotated_with': annotated_with.id},
+                get_relation_to_id_map(self.test_project.id,
+                    ('annotated_with', 'non-existing')))
+
+        # Created, renamed and deleted relations and classes have to be
+        # reflected by the cached maps.
+        relation = Relation.objects.create(project=self.test_project,
+                user=self.test_user, relation_name='test_relation')
+        self.assertEqual(relation.id,
+                get_relation_to_id_map(self.test_project.id)['test_relation'])
+        relation.relation_name = 'renamed_test_relation'
+        relation.save()
+        relation_map = get_relation_to_id_map(self.test_project.id)
+        self.assertNotIn('test_relation', relation_map)
+        self.assertEqual(relation.id, relation_map['renamed_test_relation'])
+        relation.delete()
+        self.assertNotIn('renamed_test_relation',
+                get_relation_to_id_map(self.test_project.id))
+
+        test_class = Class.objects.create(project=self.test_project,
+                user=self.test_user, class_name='test_class')
+        self.assertEqual(test_class.id,
+                get_class_to_id_map(self.test_project.id)['test_class'])
+        test_class.delete()
+        self.assertNotIn('test_class',
+                get_class_to_id_map(self.test_project.id))
+
+    def test_arbor_cache(self):
+        arbor = arbor_cache.get_arbor(373)
+        self.assertEqual(sorted(arbor.node_ids.tolist()),
+                [377, 403, 405, 407, 409])
+        self.assertTrue(arbor_cache.get_arbor(373) is arbor)
+
+        # Rerooting patches the cached arbor, which stays current
+        patches = arbor_cache.get_arbor_cache_stats()['patches']
+        _reroot_skeleton(407, self.test_project.id)
+        self.assertEqual(arbor_cache.get_arbor_cache_stats()['patches'],
+                patches + 1)
+        rerooted = arbor_cache.get_arbor(373)
+        self.assertFalse(rerooted is arbor)
+        self.assertEqual(rerooted.find_root(), 407)
+        self.assertEqual(rerooted.parent(377), 405)
+        self.assertEqual(rerooted.parent(409), 407)
+
+        # Edits that bypass the cache are picked up by the version check
+        Treenode.objects.filter(id=403).update(parent=407)
+        reloaded = arbor_cache.get_arbor(373)
+        self.assertFalse(reloaded is rerooted)
+        self.assertEqual(reloaded.parent(403), 407)
+
+    def test_arbor_cache_reparent(self):
+        # Skeleton 373: 377 -> 403, 377 -> 405 -> 407 -> 409. Moving 403 to
+        # the other end and back keeps the number of nodes, branches and ends
+        # as well as the root. Edits by other processes are made like this,
+        # without patching the cache of this process. Both edits have the same
+        # edition time, because they are part of the same transaction.
+        arbor = arbor_cache.get_arbor(373)
+        self.assertEqual(arbor.parent(403), 377)
+
+        Treenode.objects.filter(id=403).update(parent=409)
+        reparented = arbor_cache.get_arbor(373)
+        self.assertEqual(reparented.parent(403), 409)
+        self.assertEqual(arbor_cache._structure(arbor),
+                arbor_cache._structure(reparented))
+        self.assertTrue(arbor_cache.get_arbor(373) is reparented)
+
+        Treenode.objects.filter(id=403).update(parent=377)
+        self.assertEqual(arbor_cache.get_arbor(373).parent(403), 377)
+
+    def test_lazy_load_arbors(self):
+        arbors = dict(lazy_load_arbors([235, 361], with_locations=True))
+        self.assertEqual(sorted(arbors.keys()), [235, 361])
+        self.assertEqual(len(arbors[235]), 28)
+        self.assertEqual(len(arbors[361]), 9)
+        self.assertEqual(arbors[235].find_root(), 237)
+        self.assertEqual(int(arbors[235].cable_length()), 11243)
+
+        # Closing a partially consumed generator leaves the transaction of
+        # the cursor.
+        savepoints = len(connection.savepoint_ids)
+        arbors = lazy_load_arbors([235, 361])
+        skeleton_id, arbor = next(arbors)
+        self.assertEqual(skeleton_id, 235)
+        self.assertEqual(len(connection.savepoint_ids), savepoints + 1)
+        arbors.close()
+        self.assertEqual(len(connection.savepoint_ids), savepoints)
+
+    def test_lazy_load_trees(self):
+        # A small fetch size makes skeletons span multiple batches
+        trees = dict(lazy_load_trees([235, 361, 373], ('location_x',),
+                fetch_size=5))
+        self.assertEqual(sorted(trees.keys()), [235, 361, 373])
+        self.assertEqual(trees[235].number_of_nodes(), 28)
+        self.assertEqual(trees[235].number_of_edges(), 27)
+        self.assertEqual(trees[361].number_of_nodes(), 9)
+        self.assertEqual(trees[235].node[237], {'location_x': 1065.0})
+        # Edges run from child to parent
+        self.assertEqual(trees[235].successors(237), [])
+
+        with self.assertRaises(ValueError):
+            list(lazy_load_trees([235], ('location_x; DROP TABLE treenode',)))
 
     def test_annotation_deletion(self):
         annotation_class = Class.objects.get(project=self.test_project,
@@ -14,7 +14,7 @@ from catmaid.control import (authentication, user, log, message, client, common,
         suppressed_virtual_treenode, skeleton, skeletonexport, treenodeexport,
         cropping, data_view, ontology, classification, notifications, roi,
         clustering, volume, flytem, dvid, useranalytics, user_evaluation,
-        search, graphexport, transaction, graph2, circles, analytics, review,
+        search, graphexport, transaction, graph, graph2, circles, analytics, review,
         wiringdiagram, object, treenodetable)
 
 from catmaid.views import CatmaidView
@@ -43,6 +43,7 @@ urlpatterns += [
     url(r'^accounts/logout$', authentication.logout_user),
     url(r'^accounts/(?P<project_id>\d+)/all-usernames$', authentication.all_usernames),
     url(r'^permissions$', authentication.user_project_permissions),
+    url(r'^permissions/cache-stats$', authentication.permission_cache_stats),
     url(r'^classinstance/(?P<ci_id>\d+)/permissions$', authentication.get_object_permissions),
     url(r'^register$', authentication.register),
 ]
@@ -194,6 +195,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/node/nearest$', node.node_nearest),
     url(r'^(?P<project_id>\d+)/node/update$', record_view("nodes.update_location")(node.node_update)),
     url(r'^(?P<project_id>\d+)/node/list$', node.node_list_tuples),
+    url(r'^(?P<project_id>\d+)/node/list/sections$', node.node_list_tuples_sections),
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
     url(r'^(?P<project_id>\d+)/node/user-info$', node.user_info),
     url(r'^(?P<project_id>\d+)/nodes/find-labels$', node.find_labels),
@@ -244,6 +246,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeleton/ancestry$', skeleton.skeleton_ancestry),
     url(r'^(?P<project_id>\d+)/skeleton/join$', record_view("skeletons.merge")(skeleton.join_skeleton)),
     url(r'^(?P<project_id>\d+)/skeleton/reroot$', record_view("skeletons.reroot")(skeleton.reroot_skeleton)),
+    url(r'^(?P<project_id>\d+)/skeletons/edit$', record_view("skeletons.edit")(skeleton.edit_skeletons)),
     url(r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/permissions$', skeleton.get_skeleton_permissions),
     url(r'^(?P<project_id>\d+)/skeletons/import$', record_view("skeletons.import")(skeleton.import_skeleton)),
     url(r'^(?P<project_id>\d+)/skeleton/annotationlist$', skeleton.annotation_list),
@@ -266,6 +269,10 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/review$', skeletonexport.export_review_skeleton),
     url(r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/reviewed-nodes$', skeletonexport.export_skeleton_reviews),
     url(r'^(?P<project_id>\d+)/skeletons/measure$', skeletonexport.measure_skeletons),
+    url(r'^(?P<project_id>\d+)/skeletons/export$', skeletonexport.export_skeletons_stream),
+    url(r'^(?P<project_id>\d+)/skeletons/3d-versions$', skeletonexport.skeleton_3d_versions),
+    url(r'^(?P<project_id>\d+)/skeletons/compact-arbor$', skeletonexport.compact_arbors),
+    url(r'^(?P<project_id>\d+)/skeletons/synapse-centrality$', graph.synapse_centrality),
     url(r'^(?P<project_id>\d+)/skeleton/connectors-by-partner$', skeletonexport.skeleton_connectors_by_partner),
     url(r'^(?P<project_id>\d+)/skeletons/partners-by-connector$', skeletonexport.partners_by_connector),
 ]
@@ -186,6 +186,71 @@ ROI_AUTO_CREATE_IMAGE = False
 # result; that will be between 1x and 2x this value.
 NODE_LIST_MAXIMUM_COUNT = 3500
 
+# The maximum number of sections for which node lists can be requested at once
+# by clients that prefetch sections ahead of the current one. Each section is
+# limited by NODE_LIST_MAXIMUM_COUNT individually.
+NODE_LIST_MAXIMUM_SECTIONS = 10
+
+# Node list responses for the tracing overlay can be cached per section and
+# spatial tile. To enable this, set NODE_LIST_CACHE to the name of a cache
+# defined in CACHES (e.g. 'default'). Tiles are invalidated when nodes in them
+# are edited. If more than one worker process serves CATMAID, a cache backend
+# shared between processes (e.g. memcached) has to be used, otherwise edits
+# will only invalidate tiles of the process they were made in. The tile size
+# is given in project space units (X, Y, Z). Views that cover more than
+# NODE_LIST_CACHE_MAX_TILES tiles bypass the cache and cached tiles expire
+# after NODE_LIST_CACHE_TIMEOUT seconds.
+NODE_LIST_CACHE = None
+NODE_LIST_CACHE_TILE_SIZE = (8192, 8192, 100)
+NODE_LIST_CACHE_MAX_TILES = 16
+NODE_LIST_CACHE_TIMEOUT = 300
+
+# Relation and class name to ID maps of projects are cached, because they are
+# needed by most requests but change rarely. By default, each process keeps its
+# own cache, which is updated if a process changes relations or classes. If
+# more than one worker process serves CATMAID, ID_MAP_CACHE can be set to the
+# name of a cache shared between processes (defined in CACHES). Cached maps
+# are reloaded after ID_MAP_CACHE_TIMEOUT seconds at the latest.
+ID_MAP_CACHE = None
+ID_MAP_CACHE_TIMEOUT = 600
+
+# Roles of users in projects are cached for PERMISSION_CACHE_TIMEOUT seconds to
+# avoid permission queries on every request. A process clears its cache when
+# it changes permissions, group memberships or users, other processes pick up
+# such changes once their cached entries expire. Set to 0 to disable caching.
+PERMISSION_CACHE_TIMEOUT = 30
+
+# Flow and synapse centrality of skeleton nodes can be kept in a cache until a
+# skeleton or its synapses are edited. To enable this, set
+# SYNAPSE_CENTRALITY_CACHE to the name of a cache defined in CACHES. Cached
+# results expire after SYNAPSE_CENTRALITY_CACHE_TIMEOUT seconds.
+SYNAPSE_CENTRALITY_CACHE = None
+SYNAPSE_CENTRALITY_CACHE_TIMEOUT = 86400
+
+# Skeleton data loaded by the 3D viewer can be cached per skeleton version, which
+# changes with every edit of the skeleton, its connectors, tags, reviews or
+# neuron name. To enable this, set SKELETON_3D_CACHE to the name of a cache
+# defined in CACHES, which can use any cache backend (e.g. local memory, the
+# file system or memcached). Cached data expires after
+# SKELETON_3D_CACHE_TIMEOUT seconds.
+SKELETON_3D_CACHE = None
+SKELETON_3D_CACHE_TIMEOUT = 86400
+
+# CPU bound per-skeleton work, like splitting skeletons by confidence and
+# synapse domain for the graph widget, can be run in parallel in a pool of
+# PROCESS_POOL_SIZE worker processes. Each server process creates its own pool
+# on first use. With a value below two, all work is done in the request's
+# process.
+PROCESS_POOL_SIZE = 0
+
+# Topology of recently used skeletons (as needed e.g. for navigating to the
+# next branch node) is kept in memory by each process, up to an estimated
+# ARBOR_CACHE_SIZE bytes. Least recently used skeletons are evicted first.
+# Cached skeletons are patched by edits of the same process and validated
+# against the skeleton summary table on every use, which makes edits of other
+# processes visible as well. Set to 0 to disable the cache.
+ARBOR_CACHE_SIZE = 64 * 1024 * 1024
+
 # Default importer tile width, tile height and tile source type
 IMPORTER_DEFAULT_DATA_SOURCE = 'filesystem'
 IMPORTER_DEFAULT_TILE_WIDTH = 256
@@ -201,6 +266,57 @@ MEDIA_HDF5_SUBDIRECTORY = 'hdf5'
 MEDIA_CROPPING_SUBDIRECTORY = 'cropping'
 MEDIA_ROI_SUBDIRECTORY = 'roi'
 MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
+MEDIA_TILE_CACHE_SUBDIRECTORY = 'tile_cache'
+
+# Tiles needed to create these files (cropping, ROIs and treenode export) are
+# fetched by a pool of TILE_FETCH_THREADS threads per process, which keep their
+# connections to tile servers alive. With a value below two, tiles are fetched
+# one after the other. Fetched tiles are stored in MEDIA_TILE_CACHE_SUBDIRECTORY,
+# which is shared by all processes and holds up to about TILE_CACHE_SIZE bytes.
+# Least recently used tiles are removed first. Set to 0 to disable the cache.
+TILE_FETCH_THREADS = 8
+TILE_CACHE_SIZE = 512 * 1024 * 1024
+
+# Tiles served from HDF5 files in HDF5_STORAGE_PATH are read through a pool of
+# up to HDF5_FILE_HANDLES open files per process. Chunks read from these files
+# are kept in memory by each process, up to HDF5_CHUNK_CACHE_SIZE bytes. To also
+# cache encoded tiles, set HDF5_TILE_CACHE to the name of a cache defined in
+# CACHES. Cached tiles expire after HDF5_TILE_CACHE_TIMEOUT seconds and aren't
+# used anymore once their file changes. Missing scale levels are built by a
+# Celery task when they are first requested.
+HDF5_FILE_HANDLES = 16
+HDF5_CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+HDF5_TILE_CACHE = None
+HDF5_TILE_CACHE_TIMEOUT = 86400
+
+# Labels painted into HDF5 stacks are queued and written by a single thread per
+# process, at the latest after LABEL_WRITE_INTERVAL seconds or once more than
+# LABEL_WRITE_BUFFER_SIZE bytes are queued. Labels that can't be written stay
+# queued for the next write. Label tiles are read from the same datasets and
+# include queued labels only if they are served by the process the labels were
+# painted in. Queued labels are written when a process exits normally, but are
+# lost if it is killed (e.g. by SIGKILL or a worker timeout).
+LABEL_WRITE_INTERVAL = 2
+LABEL_WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Stack information, stack lists and metadata of remote services (tile sources
+# of type 2, the FlyTEM render service and DVID servers) are cached. Cached data
+# older than METADATA_CACHE_TIMEOUT seconds is reloaded in the background by the
+# first request that uses it, which still gets the old data. Requests only wait
+# for data that isn't cached or is older than METADATA_CACHE_MAX_AGE seconds.
+# Data whose reload fails, e.g. of a deleted stack, is removed from the cache and
+# loaded again by the next request. By default, data is cached per process, in
+# at most METADATA_CACHE_MAX_ENTRIES entries. Changes to stacks and projects
+# then only invalidate the data cached by the process that made them. Other
+# processes can use outdated data until their background reload of it has
+# finished, for rarely used data up to METADATA_CACHE_MAX_AGE seconds. To share
+# cached data and invalidations between processes, set METADATA_CACHE to the
+# name of a cache defined in CACHES that all processes use, e.g. a memcached or
+# database cache.
+METADATA_CACHE = None
+METADATA_CACHE_TIMEOUT = 300
+METADATA_CACHE_MAX_AGE = 86400
+METADATA_CACHE_MAX_ENTRIES = 1000
 
 # The maximum allowed size in Bytes for generated files. The cropping tool, for
 # instance, uses this to cancel a request if the generated file grows larger
@@ -222,6 +338,7 @@ NEW_USER_DEFAULT_GROUPS = []
 CELERY_IMPORTS = (
     'catmaid.control.cropping',
     'catmaid.control.roi',
+    'catmaid.control.tile',
     'catmaid.control.treenodeexport',
     'celerysopnet.tasks',
 )